@@ -1,4 +1,5 @@
 import pygame
+import assets_fightinggame as assets
 
 class Character:
     def __init__(self, name, x, y):
@@ -49,26 +50,7 @@ class Character:
             self.attack_range = 250
 
     def load_sprite(self):
-
-        character_colors = {
-            'Lucario': (0, 0, 255),
-            'Mewtwo': (255, 0, 255),
-            'Zeraora': (255, 255, 0),
-            'Cinderace': (255, 0, 0)
-        }
-
-        try:
-            sprite_path = f"sprites/{self.name.lower()}_sprite.png"
-            img = pygame.image.load(sprite_path).convert_alpha()
-            return pygame.transform.scale(img, self.scale)
-
-        except Exception as e:
-            print(f"Error loading sprite for {self.name}: {str(e)}")
-
-            surface = pygame.surface.Surface(self.scale)
-            color = character_colors.get(self.name, (255, 0, 0))
-            surface.fill(color)
-            return surface
+        return assets.character_sprite(self.name, self.scale)
 
     def check_platform_collision(self, platforms):
         self.rect.x = self.x - self.scale[0] // 2
@@ -0,0 +1,149 @@
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import pygame
+
+# Sprites live next to this module, so the game starts from any working directory
+ASSET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sprites')
+# Converted surfaces kept, one per (asset, size, flip); every sprite at every size the
+# game draws fits several times over
+CACHE_SIZE = 64
+# Size characters are drawn at in a match, and next to their name in the menu
+SPRITE_SIZE = (100, 100)
+MENU_SIZE = (50, 50)
+# Stand-ins for a character whose sprite is missing or unreadable
+CHARACTER_COLORS = {
+    'Lucario': (0, 0, 255),
+    'Mewtwo': (255, 0, 255),
+    'Zeraora': (255, 255, 0),
+    'Cinderace': (255, 0, 0)
+}
+FALLBACK_COLOR = (255, 0, 0)
+
+
+def character_asset(name):
+    return f'{name.lower()}_sprite.png'
+
+
+class AssetManager:
+    """Images from the sprites directory, each read from disk once.
+
+    Decoding a PNG does not touch the display, so preload() does it for
+    every asset on a background thread. Converting to the display's pixel
+    format, scaling and flipping do, so surface() does those on the calling
+    (main) thread, at most once per (asset, size, flip), and keeps the
+    results in a least-recently-used cache.
+    """
+
+    def __init__(self, directory=ASSET_DIR, cache_size=CACHE_SIZE):
+        self.logger = logging.getLogger('Assets')
+        self.directory = directory
+        self.cache_size = cache_size
+        # Decoded images, shared with the preload thread; None for assets that failed to load
+        self.images = {}
+        self.lock = threading.Lock()
+        self.surfaces = OrderedDict()
+        self.loaded = 0
+        self.total = 0
+
+    def assets(self):
+        try:
+            return sorted(name for name in os.listdir(self.directory) if name.endswith('.png'))
+        except OSError:
+            return []
+
+    def load(self, asset):
+        """The decoded image, or None if it cannot be read."""
+        with self.lock:
+            if asset in self.images:
+                return self.images[asset]
+        try:
+            image = pygame.image.load(os.path.join(self.directory, asset))
+        except (pygame.error, OSError) as e:
+            self.logger.info(f'Error loading {asset}: {str(e)}')
+            image = None
+        with self.lock:
+            self.images[asset] = image
+            self.loaded += 1
+        return image
+
+    def preload(self, assets=None):
+        """Starts decoding every asset on a background thread and returns it."""
+        assets = self.assets() if assets is None else assets
+        with self.lock:
+            self.loaded = sum(1 for asset in assets if asset in self.images)
+            self.total = len(assets)
+        thread = threading.Thread(target=self.load_all, args=(assets,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def load_all(self, assets):
+        for asset in assets:
+            self.load(asset)
+
+    def progress(self):
+        with self.lock:
+            return min(self.loaded / self.total, 1.0) if self.total else 1.0
+
+    def surface(self, asset, size=None, flip=False, fallback=FALLBACK_COLOR):
+        """The asset converted for the display, scaled to size and mirrored if flip.
+
+        Shared between callers, so blit it but never draw on it. An asset
+        that cannot be loaded comes back as a block of the fallback colour.
+        """
+        key = (asset, size, flip)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+        image = self.load(asset)
+        if image is None:
+            surface = pygame.Surface(size or SPRITE_SIZE).convert()
+            surface.fill(fallback)
+        else:
+            surface = image.convert_alpha()
+            if size is not None and surface.get_size() != size:
+                surface = pygame.transform.scale(surface, size)
+            if flip:
+                surface = pygame.transform.flip(surface, True, False)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.cache_size:
+            self.surfaces.popitem(last=False)
+        return surface
+
+
+manager = AssetManager()
+
+
+def character_sprite(name, size=SPRITE_SIZE, flip=False):
+    return manager.surface(character_asset(name), size, flip, CHARACTER_COLORS.get(name, FALLBACK_COLOR))
+
+
+def preload(screen, sizes=(SPRITE_SIZE,)):
+    """Decodes every sprite behind a progress bar, then prepares each at the given sizes."""
+    thread = manager.preload()
+    font = pygame.font.Font(None, 36)
+    clock = pygame.time.Clock()
+    width, height = screen.get_size()
+    while thread.is_alive():
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                sys.exit()
+        screen.fill((0, 0, 0))
+        text = font.render('Loading...', True, (255, 255, 255))
+        screen.blit(text, text.get_rect(center=(width / 2, height / 2 - 40)))
+        bar = pygame.Rect(0, 0, width // 2, 20)
+        bar.center = (width / 2, height / 2)
+        pygame.draw.rect(screen, (0, 255, 0), (bar.x, bar.y, bar.width * manager.progress(), bar.height))
+        pygame.draw.rect(screen, (255, 255, 255), bar, 1)
+        pygame.display.flip()
+        clock.tick(30)
+    # Conversion needs the display, so it happens here rather than on the thread
+    for asset in manager.assets():
+        for size in sizes:
+            manager.surface(asset, size)
@@ -0,0 +1,248 @@
+import asyncio
+import concurrent.futures
+import copy
+
+import history_fightinggame as history
+import inputs_fightinggame as inputs
+import matchmaking_fightinggame as matchmaking
+import metrics_fightinggame as metrics
+import outbound_fightinggame as outbound
+import protocol_fightinggame as protocol
+import replay_fightinggame as replay
+import session_fightinggame as session
+import tick_fightinggame as tick_clock
+from server_fightinggame import GameServer
+
+
+class AsyncConnection:
+    """Gives an asyncio stream the sendall/close calls GameServer uses on sockets.
+
+    With a queue, sendall() only queues and the server's writer task does
+    the writing; without one it writes straight to the transport.
+    """
+
+    def __init__(self, reader, writer, queue=None):
+        self.reader = reader
+        self.writer = writer
+        self.queue = queue
+
+    def sendall(self, data):
+        if self.queue is not None:
+            self.queue.put(data)
+            if self.queue.overflowed:
+                self.shutdown()
+        elif not self.writer.is_closing():
+            self.writer.write(data)
+
+    def shutdown(self):
+        # Ends the reading side too, like shutdown() on a socket
+        self.writer.transport.abort()
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.close()
+        else:
+            self.writer.close()
+
+    def __repr__(self):
+        return f"<AsyncConnection {self.writer.get_extra_info('peername')}>"
+
+
+class AsyncGameServer(GameServer):
+    """GameServer on a single event loop.
+
+    Accepting, per-client reads and writes and the tick loop all run as
+    coroutines on one thread, so room state is only ever touched from that
+    thread and an idle connection costs a socket and two tasks instead of
+    two OS threads. Database calls run on a single database thread so they
+    never stall the tick.
+    """
+
+    def __init__(self, host='0.0.0.0', port=5555, max_rooms=100, tick_rate=tick_clock.TICK_RATE,
+                 max_rewind=history.MAX_REWIND, replay_dir=replay.REPLAY_DIR, spectator_port=None,
+                 metrics_port=None, metrics_interval=metrics.DUMP_INTERVAL, reconnect_grace=session.RECONNECT_GRACE,
+                 max_queued=matchmaking.MAX_QUEUED):
+        super().__init__(host, port, max_rooms, tick_rate, max_rewind, replay_dir, spectator_port,
+                         metrics_port, metrics_interval, reconnect_grace, max_queued)
+        self.loop = None
+        self.tasks = set()
+        # GameDatabase reuses one connection and cursor, so its calls must not overlap
+        self.db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close_server()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(128)
+        self.server_socket.setblocking(False)
+        self.logger.info(f'Server started (asyncio), listening on {self.host}:{self.port}')
+        self.start_metrics()
+        self.start_matchmaking()
+
+        server = await asyncio.start_server(self.accept_client, sock=self.server_socket)
+        if self.spectator_port:
+            await asyncio.start_server(self.accept_spectator, self.host, self.spectator_port)
+            self.logger.info(f'Accepting spectators on {self.host}:{self.spectator_port}')
+        self.spawn(self.update_game_state())
+        async with server:
+            await server.serve_forever()
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def accept_client(self, reader, writer):
+        connection = AsyncConnection(reader, writer, outbound.OutboundQueue())
+        self.spawn(self.write_frames(connection))
+        address = writer.get_extra_info('peername')
+        # The first message says whether this is a new player or one coming back
+        decoder = protocol.FrameDecoder()
+        try:
+            frames = []
+            while not frames:
+                data = await asyncio.wait_for(reader.read(65536), session.HELLO_TIMEOUT)
+                if not data:
+                    raise ConnectionError('closed before saying hello')
+                frames = decoder.feed_raw(data)
+            hello = protocol.decode_payload(*frames.pop(0))
+        except (asyncio.TimeoutError, ConnectionError, protocol.ProtocolError) as e:
+            self.logger.info(f'Dropped connection from {address}: {str(e) or type(e).__name__}')
+            connection.close()
+            return
+        player = self.register_client(connection, address, hello)
+        if player is not None:
+            await self.handle_client(connection, player, decoder, frames)
+
+    async def handle_client(self, client_socket, player, decoder, frames):
+        keepalive = self.start_keepalive(client_socket, player)
+        budget = inputs.TokenBucket()
+        self.logger.info(f'Client socket: {client_socket}')
+
+        try:
+            while True:
+                for message_type, payload in frames:
+                    # Until a queued player is seated there is no room to send anything to
+                    if message_type == protocol.MSG_HEARTBEAT or player.room is None:
+                        continue
+                    self.handle_frame(client_socket, player.room, player.player_num, message_type, payload)
+                data = await client_socket.reader.read(65536)
+                if not data:
+                    break
+                keepalive.received()
+                frames = decoder.feed_raw(data)
+                if not budget.take(len(frames)):
+                    self.over_budget(client_socket, player)
+                    break
+
+        except Exception as e:
+            self.logger.info(f'Error handling client {player.player_num}:{str(e)}')
+            try:
+                error_msg = {'status': 'server_error', 'message': f'Server error: {str(e)}'}
+                protocol.send_message(client_socket, error_msg)
+            except Exception:
+                pass
+        finally:
+            keepalive.stop()
+            self.sessions.drop(player, client_socket)
+            self.logger.info(f'Player {player.player_num} outbound: {outbound.describe(client_socket.queue.stats())}, '
+                             f'{keepalive.heartbeats} heartbeats')
+
+    async def write_frames(self, connection):
+        queue = connection.queue
+        ready = asyncio.Event()
+        queue.wakeup = ready.set
+        # Anything queued before this task first ran
+        ready.set()
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                batch = queue.take()
+                if connection.writer.is_closing():
+                    break
+                if batch:
+                    # One sendmsg() for the whole batch where the platform has it
+                    connection.writer.writelines([frame for frame, _, _ in batch])
+                    await connection.writer.drain()
+                    queue.done(batch)
+                if queue.closed and queue.drained():
+                    break
+        except ConnectionError:
+            queue.close()
+        finally:
+            connection.writer.close()
+
+    async def accept_spectator(self, reader, writer):
+        connection = AsyncConnection(reader, writer)
+        decoder = protocol.FrameDecoder()
+        try:
+            messages = []
+            while not messages:
+                data = await asyncio.wait_for(reader.read(65536), 5)
+                if not data:
+                    return
+                messages = decoder.feed(data)
+        except (asyncio.TimeoutError, ConnectionError, protocol.ProtocolError):
+            connection.close()
+            return
+
+        room, viewer = self.add_spectator(connection, messages[0])
+        if room is None:
+            connection.close()
+            return
+        ready = asyncio.Event()
+        viewer.wakeup = ready.set
+        read_task = self.spawn(self.watch_spectator(connection, viewer))
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                for frame in viewer.take():
+                    writer.write(frame)
+                if viewer.closed:
+                    break
+                # While the socket is backed up this waits and the queue fills instead of the tick stalling
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            read_task.cancel()
+            self.remove_spectator(room, viewer)
+            connection.close()
+
+    async def watch_spectator(self, connection, viewer):
+        # Spectators are read-only; anything they send is ignored until they hang up
+        try:
+            while await connection.reader.read(65536):
+                pass
+        except ConnectionError:
+            pass
+        viewer.close()
+
+    def handle_frame(self, client_socket, room, player_num, message_type, payload):
+        client_data = protocol.decode_payload(message_type, payload)
+        room.handle_client_data(client_socket, player_num, client_data)
+
+    async def update_game_state(self):
+        self.scheduler.restart()
+        while True:
+            await asyncio.sleep(self.scheduler.delay())
+            self.scheduler.run_due(self.tick)
+
+    def record_match_start(self, room, player1_character, player2_character):
+        self.loop.run_in_executor(self.db_executor, super().record_match_start, room, player1_character,
+                                  player2_character)
+
+    def record_game_over(self, room, winner):
+        # The tick resets game_state right after this call, so the executor gets its own copy
+        game_state = copy.deepcopy(room.game_state)
+        self.loop.run_in_executor(self.db_executor, self.db_handler.handle_game_over, game_state, winner)
@@ -0,0 +1,1348 @@
+import argparse
+import heapq
+import logging
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import random
+import selectors
+import socket
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+import clocksync_fightinggame as clocksync
+import history_fightinggame as history
+import inputs_fightinggame as inputs
+import interpolation_fightinggame as interpolation
+import log_fightinggame as log
+import matchmaking_fightinggame as matchmaking
+import metrics_fightinggame as metrics
+import outbound_fightinggame as outbound
+import protocol_fightinggame as protocol
+import room_fightinggame as room_manager
+import session_fightinggame as session
+import shard_fightinggame as shard
+import snapshot_fightinggame as snapshot
+import spectator_fightinggame as spectator
+import tick_fightinggame as tick_clock
+import timers_fightinggame as timers
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Pokemon Fighting Game Benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    protocol_parser = subparsers.add_parser('protocol', help='Wire protocol vs raw pickle')
+    protocol_parser.add_argument('--iterations', '-n', type=int, default=100000,
+                                 help='Messages to encode/decode per measurement')
+
+    snapshot_parser = subparsers.add_parser('snapshot', help='Full state broadcasts vs delta snapshots')
+    snapshot_parser.add_argument('--ticks', '-t', type=int, default=20 * 60 * 3,
+                                 help='Broadcast ticks to simulate (default: a 3 minute match)')
+
+    connections_parser = subparsers.add_parser('connections', help='Memory and threads per idle connection')
+    connections_parser.add_argument('--connections', '-c', type=int, default=2000,
+                                    help='Idle connections to hold open')
+    connections_parser.add_argument('--port', '-p', type=int, default=5600,
+                                    help='Port for the benchmark server')
+    connections_parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='asyncio',
+                                    help='Server mode to measure')
+
+    rooms_parser = subparsers.add_parser('rooms', help='Batched room ticks on one core')
+    rooms_parser.add_argument('--rooms', '-r', type=int, default=200,
+                              help='Concurrent matches to step per tick')
+    rooms_parser.add_argument('--ticks', '-t', type=int, default=200,
+                              help='Ticks to measure')
+
+    shards_parser = subparsers.add_parser('shards', help='Room ticks per second across worker processes')
+    shards_parser.add_argument('--rooms', '-r', type=int, default=100,
+                               help='Rooms hosted by each worker')
+    shards_parser.add_argument('--workers', '-w', type=int, default=os.cpu_count() or 1,
+                               help='Measure with 1..N worker processes')
+    shards_parser.add_argument('--duration', '-d', type=float, default=3.0,
+                               help='Seconds to measure each worker count')
+
+    ticks_parser = subparsers.add_parser('ticks', help='Tick period drift and jitter: sleep-after-work vs scheduler')
+    ticks_parser.add_argument('--rate', type=int, default=60,
+                              help='Target ticks per second')
+    ticks_parser.add_argument('--duration', '-d', type=float, default=3.0,
+                              help='Seconds to run each loop')
+    ticks_parser.add_argument('--work', type=float, default=0.4,
+                              help='Mean work per tick as a fraction of the tick period')
+
+    interpolation_parser = subparsers.add_parser('interpolation', help='Opponent motion smoothness at 60 FPS')
+    interpolation_parser.add_argument('--jitter', type=float, default=0.02,
+                                      help='Max random extra network delay per snapshot, in seconds')
+    interpolation_parser.add_argument('--duration', '-d', type=float, default=10.0,
+                                      help='Simulated seconds')
+
+    rewind_parser = subparsers.add_parser('rewind', help='Hits the attacker saw land that the server also counts')
+    rewind_parser.add_argument('--rtt', type=int, default=150,
+                               help='Round trip time in ms')
+    rewind_parser.add_argument('--ticks', '-t', type=int, default=2000,
+                               help='Server ticks to simulate')
+
+    spectators_parser = subparsers.add_parser('spectators', help='Tick cost of streaming one match to many viewers')
+    spectators_parser.add_argument('--spectators', '-s', type=int, default=500,
+                                   help='Largest audience to measure')
+    spectators_parser.add_argument('--ticks', '-t', type=int, default=400,
+                                   help='Ticks to measure per audience size')
+    spectators_parser.add_argument('--slow', type=float, default=0.1,
+                                   help='Share of viewers that stop reading')
+
+    outbound_parser = subparsers.add_parser('outbound', help='Tick time with one stalled client: direct vs queued sends')
+    outbound_parser.add_argument('--rooms', '-r', type=int, default=50,
+                                 help='Matches on real socket pairs')
+    outbound_parser.add_argument('--ticks', '-t', type=int, default=300,
+                                 help='Ticks to measure, paced at 100 Hz')
+
+    timers_parser = subparsers.add_parser('timers', help='Heartbeat and idle timeout cost per tick: polling vs timer wheel')
+    timers_parser.add_argument('--connections', '-c', type=int, default=10000,
+                               help='Largest number of connections to measure')
+    timers_parser.add_argument('--busy', type=float, default=0.8,
+                               help='Share of connections in a match, getting a snapshot every tick')
+    timers_parser.add_argument('--ticks', '-t', type=int, default=600,
+                               help='Simulated 20 Hz ticks (default: 30 seconds)')
+
+    logging_parser = subparsers.add_parser('logging', help='Cost of the per-message log on the thread reading inputs')
+    logging_parser.add_argument('--iterations', '-n', type=int, default=100000,
+                                help='Client messages to log per measurement')
+
+    metrics_parser = subparsers.add_parser('metrics', help='Cost of recording metrics and of a scrape')
+    metrics_parser.add_argument('--iterations', '-n', type=int, default=100000,
+                                help='Observations per measurement')
+    metrics_parser.add_argument('--rooms', '-r', type=int, default=200,
+                                help='Concurrent matches to step per tick')
+    metrics_parser.add_argument('--ticks', '-t', type=int, default=200,
+                                help='Ticks to measure')
+
+    reconnect_parser = subparsers.add_parser('reconnect', help='Back in the match after a drop: resume vs a new lobby')
+    reconnect_parser.add_argument('--rounds', '-n', type=int, default=20,
+                                  help='Drops to measure per flow')
+    reconnect_parser.add_argument('--port', '-p', type=int, default=5650,
+                                  help='Port for the benchmark server; the next one serves its metrics')
+    reconnect_parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='asyncio',
+                                  help='Server mode to measure')
+
+    matchmaking_parser = subparsers.add_parser('matchmaking', help='Cost of pairing queued players as the queue grows')
+    matchmaking_parser.add_argument('--queued', '-q', type=int, default=matchmaking.MAX_QUEUED,
+                                    help='Largest queue to measure')
+    matchmaking_parser.add_argument('--pairs', '-n', type=int, default=2000,
+                                    help='Pairs to take off the queue per measurement')
+
+    inputs_parser = subparsers.add_parser('inputs', help='Server CPU for one player as it sends faster and faster')
+    inputs_parser.add_argument('--duration', '-d', type=float, default=5.0,
+                               help='Seconds of simulated play per send rate')
+
+    clock_parser = subparsers.add_parser('clock', help="Error of the client's estimate of the server tick")
+    clock_parser.add_argument('--duration', '-d', type=float, default=120.0,
+                              help='Seconds of simulated play')
+    clock_parser.add_argument('--delay', type=float, default=30.0,
+                              help='One-way network delay in ms, before jitter')
+    clock_parser.add_argument('--spikes', type=float, default=0.1,
+                              help='Share of packets held up by a queue on one side')
+
+    render_parser = subparsers.add_parser('render', help='Client frame time: stage redrawn every frame vs cached layers, '
+                                                         'whole window vs dirty rectangles')
+    render_parser.add_argument('--frames', '-n', type=int, default=600,
+                               help='Frames drawn per measurement')
+
+    assets_parser = subparsers.add_parser('assets', help='Getting a character sprite: load and scale vs asset cache')
+    assets_parser.add_argument('--iterations', '-n', type=int, default=200,
+                               help='Sprites fetched per measurement')
+
+    text_parser = subparsers.add_parser('text', help='Text of the error popup per frame: rendered every frame vs cached')
+    text_parser.add_argument('--frames', '-n', type=int, default=600,
+                             help='Frames drawn per measurement')
+    return parser.parse_args()
+
+
+def sample_game_state():
+    return {
+        'players': {
+            1: {'connected': True, 'character': 'Lucario', 'x': 312, 'y': 580, 'health': 85,
+                'is_dead': False, 'is_attacking': True, 'is_special_attacking': False, 'facing_right': False,
+                'input_seq': 412},
+            2: {'connected': True, 'character': 'Mewtwo', 'x': 655, 'y': 471.4, 'health': 62.5,
+                'is_dead': False, 'is_attacking': False, 'is_special_attacking': False, 'facing_right': True,
+                'input_seq': 398}
+        },
+        'ready': 2,
+        'platforms': [
+            {'x': 200, 'y': 600, 'width': 600, 'height': 20},
+            {'x': 400, 'y': 300, 'width': 100, 'height': 20},
+            {'x': 600, 'y': 450, 'width': 100, 'height': 20}
+        ]
+    }
+
+
+def sample_messages():
+    return {
+        'game_state_update': {'status': 'game_state_update', 'game_state': sample_game_state()},
+        'player_action': {'player_action': {'x': 317, 'facing_right': True, 'y': 571.2, 'velocity_y': -8.4,
+                                             'input_seq': 413}},
+        'heartbeat': dict(protocol.HEARTBEAT)
+    }
+
+
+def time_per_call(function, argument, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function(argument)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def decode_frame(data):
+    return protocol.FrameDecoder().feed(data)
+
+
+def run_protocol_benchmark(iterations):
+    print(f"{'message':<20}{'codec':<10}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for name, message in sample_messages().items():
+        pickled = pickle.dumps(message)
+        framed = protocol.encode_message(message)
+        rows = [
+            ('pickle', len(pickled), time_per_call(pickle.dumps, message, iterations),
+             time_per_call(pickle.loads, pickled, iterations)),
+            ('binary', len(framed), time_per_call(protocol.encode_message, message, iterations),
+             time_per_call(decode_frame, framed, iterations))
+        ]
+        for codec, size, encode_us, decode_us in rows:
+            print(f'{name:<20}{codec:<10}{size:>8}{encode_us:>12.2f}{decode_us:>12.2f}')
+
+    # One tick at 20 Hz: the server broadcasts one state update to both players
+    state = sample_messages()['game_state_update']
+    pickle_tick = 2 * len(pickle.dumps(state))
+    binary_tick = 2 * len(protocol.encode_message(state))
+    print(f'\nbytes per tick (2 clients): pickle={pickle_tick} binary={binary_tick} '
+          f'({pickle_tick / binary_tick:.1f}x smaller)')
+
+
+def simulate_tick(game_state, rng):
+    # Typical match traffic: one player moving, the other mostly idle, rare hits
+    mover = game_state['players'][1]
+    mover['x'] = max(50, min(950, mover['x'] + rng.choice((-5, 0, 5))))
+    # Three 60 FPS client inputs land per 20 Hz tick
+    mover['input_seq'] += 3
+    mover['facing_right'] = rng.random() < 0.5 if rng.random() < 0.1 else mover['facing_right']
+    if rng.random() < 0.05:
+        target = game_state['players'][2]
+        target['health'] = max(0, target['health'] - 10) or 100
+
+
+def run_snapshot_benchmark(ticks):
+    rng = random.Random(1)
+    game_state = sample_game_state()
+    encoder = snapshot.SnapshotEncoder()
+    receivers = {1: snapshot.SnapshotReceiver(), 2: snapshot.SnapshotReceiver()}
+    acks = {}
+    pickle_bytes = 0
+    full_bytes = 0
+    delta_bytes = 0
+    keyframes = 0
+
+    for _ in range(ticks):
+        simulate_tick(game_state, rng)
+        message = {'status': 'game_state_update', 'game_state': game_state}
+        pickle_bytes += 2 * len(pickle.dumps(message))
+        full_bytes += 2 * len(protocol.encode_message(message))
+
+        encoder.capture(game_state)
+        keyframes += encoder.is_keyframe_due()
+        # Acks reach the server one tick after the snapshot they acknowledge
+        next_acks = {}
+        for player_num, receiver in receivers.items():
+            data = encoder.frame_for(acks.get(player_num))
+            delta_bytes += len(data)
+            for message in protocol.FrameDecoder().feed(data):
+                if receiver.apply(message) is not None:
+                    next_acks[player_num] = message['seq']
+        acks = next_acks
+
+    print(f'ticks={ticks} keyframes={keyframes}')
+    for label, total in (('pickle', pickle_bytes), ('binary full', full_bytes), ('binary delta', delta_bytes)):
+        print(f'{label:<14}{total:>10} bytes {total / ticks:>8.1f} per tick '
+              f'{pickle_bytes / total:>6.1f}x vs pickle')
+
+
+def process_status(pid):
+    # Linux only: resident memory and thread count straight from the kernel
+    status = {}
+    with open(f'/proc/{pid}/status') as status_file:
+        for line in status_file:
+            key, _, value = line.partition(':')
+            status[key] = value.split()[0] if value.split() else ''
+    return int(status['VmRSS']), int(status['Threads'])
+
+
+def run_server(mode, port, max_rooms):
+    if mode == 'asyncio':
+        from async_server_fightinggame import AsyncGameServer as server_class
+    else:
+        from server_fightinggame import GameServer as server_class
+    server_class(host='127.0.0.1', port=port, max_rooms=max_rooms).start()
+
+
+def run_connections_benchmark(mode, count, port):
+    server = multiprocessing.Process(target=run_server, args=(mode, port, count // 2 + 1), daemon=True)
+    server.start()
+    time.sleep(1)
+    base_rss, base_threads = process_status(server.pid)
+
+    sockets = []
+    start = time.perf_counter()
+    try:
+        for _ in range(count):
+            sock = socket.create_connection(('127.0.0.1', port))
+            protocol.send_message(sock, session.JOIN)
+            decoder = protocol.FrameDecoder()
+            while not protocol.recv_messages(sock, decoder):
+                pass
+            sockets.append(sock)
+        connect_time = time.perf_counter() - start
+        time.sleep(2)
+        rss, threads = process_status(server.pid)
+    finally:
+        for sock in sockets:
+            sock.close()
+        server.terminate()
+
+    print(f'mode:               {mode}')
+    print(f'connections:        {len(sockets)} (accepted in {connect_time:.2f}s)')
+    print(f'server threads:     {base_threads} idle -> {threads} with connections')
+    print(f'server RSS:         {base_rss} KiB idle -> {rss} KiB with connections')
+    print(f'memory/connection:  {(rss - base_rss) / len(sockets):.1f} KiB')
+
+
+class NullSocket:
+    def __init__(self):
+        self.bytes_sent = 0
+
+    def sendall(self, data):
+        self.bytes_sent += len(data)
+
+    def close(self):
+        pass
+
+
+class BenchmarkServer:
+    """Just enough of GameServer for rooms to run without sockets or a database."""
+
+    def __init__(self):
+        self.logger = logging.getLogger('Benchmark')
+        self.max_rewind_ticks = 4
+
+    def record_match_start(self, room, player1_character, player2_character):
+        pass
+
+    def record_game_over(self, room, winner):
+        pass
+
+    def open_replay(self, room):
+        return None
+
+
+def start_benchmark_rooms(count):
+    logging.getLogger('Benchmark').setLevel(logging.WARNING)
+    manager = room_manager.RoomManager(BenchmarkServer(), count)
+    sockets = []
+    for _ in range(count * 2):
+        sock = NullSocket()
+        room, player_num = manager.admit(sock)
+        room.handle_client_data(sock, player_num, {f'player{player_num}_character': 'Lucario'})
+        room.handle_client_data(sock, player_num, {'ready': True})
+        sockets.append((sock, room, player_num))
+    return manager, sockets
+
+
+def step_benchmark_rooms(manager, sockets, rng):
+    # One input per player per tick, then one batched step over every room
+    for sock, room, player_num in sockets:
+        action = {'x': 300 + rng.randrange(-5, 6), 'facing_right': rng.random() < 0.5}
+        room.handle_client_data(sock, player_num, {'player_action': action})
+    for room in manager.snapshot_active():
+        room.tick()
+
+
+def run_rooms_benchmark(count, ticks):
+    rng = random.Random(1)
+    manager, sockets = start_benchmark_rooms(count)
+    step_benchmark_rooms(manager, sockets, rng)
+
+    start = time.perf_counter()
+    for _ in range(ticks):
+        step_benchmark_rooms(manager, sockets, rng)
+    tick_time = (time.perf_counter() - start) / ticks
+
+    rooms_per_core = count * 0.05 / tick_time
+    print(f'rooms: {count}  tick time: {tick_time * 1000:.2f} ms  ({tick_time / count * 1e6:.1f} us per room)')
+    print(f'capacity at 20 Hz: ~{rooms_per_core:.0f} matches per core')
+
+
+def run_benchmark_worker(conn, worker_id):
+    logging.disable(logging.INFO)
+    shard.run_worker(conn, worker_id, tick_rate=None, use_database=False)
+
+
+def input_record(room_id, player_num, message):
+    frame = protocol.encode_message(message)
+    _, message_type, _ = protocol.HEADER.unpack_from(frame)
+    return shard.pack_record(shard.OP_INPUT, room_id, player_num, bytes((message_type,)) + frame[protocol.HEADER.size:])
+
+
+def measure_shards(worker_count, rooms_per_worker, duration):
+    workers = []
+    for worker_id in range(worker_count):
+        front_conn, worker_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=run_benchmark_worker, args=(worker_conn, worker_id), daemon=True)
+        process.start()
+        worker_conn.close()
+
+        setup = []
+        inputs = []
+        for index in range(rooms_per_worker):
+            room_id = worker_id * rooms_per_worker + index + 1
+            for player_num in (1, 2):
+                setup.append(shard.pack_record(shard.OP_JOIN, room_id, player_num))
+                setup.append(input_record(room_id, player_num, {f'player{player_num}_character': 'Mewtwo'}))
+                setup.append(input_record(room_id, player_num, {'ready': True}))
+                inputs.append(input_record(room_id, player_num, {'player_action': {'x': 400, 'facing_right': True}}))
+        front_conn.send_bytes(b''.join(setup))
+        workers.append((process, front_conn, b''.join(inputs)))
+
+    # Each worker gets one batch of inputs back for every tick it reports
+    ticks = 0
+    conns = {conn: batch for _, conn, batch in workers}
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for conn in multiprocessing.connection.wait(list(conns), timeout=0.1):
+            conn.recv_bytes()
+            conn.send_bytes(conns[conn])
+            ticks += 1
+    elapsed = time.perf_counter() - start
+
+    for process, conn, _ in workers:
+        conn.close()
+        process.join(timeout=1)
+        if process.is_alive():
+            process.terminate()
+    return ticks * rooms_per_worker / elapsed
+
+
+def run_shards_benchmark(rooms_per_worker, max_workers, duration):
+    print(f'{os.cpu_count()} cores, {rooms_per_worker} rooms per worker')
+    baseline = None
+    for worker_count in range(1, max_workers + 1):
+        room_ticks = measure_shards(worker_count, rooms_per_worker, duration)
+        baseline = baseline or room_ticks
+        print(f'workers={worker_count:<3} room ticks/s={room_ticks:>10.0f}  '
+              f'speedup={room_ticks / baseline:.2f}x  matches at 20 Hz={room_ticks / 20:.0f}')
+
+
+def simulate_work(rng, mean):
+    # Busy-wait so the work shows up as tick time rather than idle time
+    end = time.perf_counter() + rng.uniform(0, 2 * mean)
+    while time.perf_counter() < end:
+        pass
+
+
+def tick_period_stats(starts, interval):
+    periods = [b - a for a, b in zip(starts, starts[1:])]
+    mean = sum(periods) / len(periods)
+    jitter = sum(abs(period - interval) for period in periods) / len(periods)
+    return (len(starts) - 1) / (starts[-1] - starts[0]), mean, jitter
+
+
+def run_ticks_benchmark(rate, duration, work):
+    interval = 1.0 / rate
+    rng = random.Random(1)
+
+    # The old loop: do the work, then sleep a whole period
+    starts = []
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        starts.append(time.monotonic())
+        simulate_work(rng, work * interval)
+        time.sleep(interval)
+    results = [('sleep after work', tick_period_stats(starts, interval))]
+
+    starts = []
+    scheduler = tick_clock.TickScheduler(rate)
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        time.sleep(scheduler.delay())
+        scheduler.run_due(lambda tick: (starts.append(time.monotonic()), simulate_work(rng, work * interval)))
+    results.append(('TickScheduler', tick_period_stats(starts, interval)))
+
+    print(f'target: {rate} Hz ({interval * 1000:.2f} ms), work ~{work * 100:.0f}% of a tick')
+    for label, (achieved, mean, jitter) in results:
+        print(f'{label:<18} rate={achieved:>7.2f} Hz  mean period={mean * 1000:>6.2f} ms  '
+              f'mean |period - target|={jitter * 1000:>5.2f} ms')
+    stats = scheduler.stats()
+    print(f"scheduler: ticks={stats['tick']} skipped={stats['skipped']} "
+          f"tick duration={stats['tick_duration'] * 1000:.2f} ms (max {stats['max_tick_duration'] * 1000:.2f}) "
+          f"jitter={stats['jitter'] * 1000:.2f} ms (max {stats['max_jitter'] * 1000:.2f})")
+
+
+def render_errors(send_rate, jitter, duration, interpolate):
+    # The opponent walks at a steady 300 px/s; snapshots leave the server at
+    # send_rate and arrive 50 ms + random jitter later; frames render at 60 FPS
+    rng = random.Random(3)
+    speed = 300.0
+    arrivals = []
+    for index in range(int(duration * send_rate)):
+        sent = index / send_rate
+        arrivals.append((sent + 0.05 + rng.uniform(0, jitter), sent))
+    arrivals.sort()
+
+    buffer = interpolation.InterpolationBuffer()
+    shown_x = None
+    steps = []
+    errors = []
+    next_arrival = 0
+    for frame in range(int(duration * 60)):
+        now = frame / 60
+        while next_arrival < len(arrivals) and arrivals[next_arrival][0] <= now:
+            sent = arrivals[next_arrival][1]
+            buffer.push(sent, arrivals[next_arrival][0], speed * sent, 0)
+            if not interpolate and (shown_x is None or speed * sent > shown_x):
+                shown_x = speed * sent
+            next_arrival += 1
+        if interpolate:
+            position = buffer.sample(now)
+            if position is None:
+                continue
+            x = position[0]
+        elif shown_x is None:
+            continue
+        else:
+            x = shown_x
+        if frame > 60:
+            steps.append(x - previous_x)
+            errors.append(speed * now - x)
+        previous_x = x
+
+    expected = speed / 60
+    stutter = (sum((step - expected) ** 2 for step in steps) / len(steps)) ** 0.5
+    lag = sum(errors) / len(errors)
+    return stutter, lag
+
+
+def run_interpolation_benchmark(jitter, duration):
+    print(f'opponent at 300 px/s, 60 FPS, 50 ms latency + up to {jitter * 1000:.0f} ms jitter')
+    print(f"{'send rate':<12}{'render':<16}{'stutter px/frame':>18}{'behind px':>12}")
+    for send_rate in (20, 10):
+        for label, interpolate in (('last snapshot', False), ('interpolated', True)):
+            stutter, lag = render_errors(send_rate, jitter, duration, interpolate)
+            print(f'{send_rate:<12}{label:<16}{stutter:>18.2f}{lag:>12.1f}')
+
+
+def confirmed_hits(rtt, ticks, compensate):
+    # Defender sways across the attacker's range; the attacker sees it one-way
+    # latency + one interpolation interval late and its attack arrives one-way
+    # latency after it is sent. Count attacks that looked like hits to the
+    # attacker and the share of them the server agrees with.
+    tick_rate = tick_clock.TICK_RATE
+    manager, sockets = start_benchmark_rooms(1)
+    room = next(iter(manager.rooms.values()))
+    room.server.max_rewind_ticks = round(history.MAX_REWIND * tick_rate)
+    room.position_history = history.PositionHistory(room.server.max_rewind_ticks + 1)
+    room.tick(1)
+    attacker, defender = room.game_state['players'][1], room.game_state['players'][2]
+    attacker['x'] = 300
+    one_way = round(rtt / 2000 * tick_rate)
+    view_lag = one_way + 1
+
+    in_flight = []
+    seen = 0
+    landed = 0
+    for tick in range(2, ticks):
+        defender['x'] = 500 + 200 * math.sin(2 * math.pi * tick / (2 * tick_rate))
+        room.tick(tick)
+        view_tick = tick - view_lag
+        shown = room.position_history.position(2, view_tick)
+        if shown is not None and abs(attacker['x'] - shown[0]) <= 150:
+            action = {'attack': True, 'damage': 10, 'attack_range': 150}
+            if compensate:
+                action['view_tick'] = view_tick
+            in_flight.append((tick + one_way, action))
+        while in_flight and in_flight[0][0] <= tick:
+            action = in_flight.pop(0)[1]
+            defender['health'] = 100
+            room.handle_attack(1, action)
+            seen += 1
+            landed += defender['health'] < 100
+    return seen, landed
+
+
+def run_rewind_benchmark(rtt, ticks):
+    print(f'rtt {rtt} ms, {tick_clock.TICK_RATE} Hz, max rewind {history.MAX_REWIND * 1000:.0f} ms')
+    for label, compensate in (('no rewind', False), ('rewound', True)):
+        seen, landed = confirmed_hits(rtt, ticks, compensate)
+        print(f'{label:<10} attacks that looked like hits={seen}  server agreed={landed} ({landed / seen:.1%})')
+
+    positions = history.PositionHistory(5)
+    positions.record(1, {1: {'x': 1.0, 'y': 2.0}, 2: {'x': 3.0, 'y': 4.0}})
+    lookups = 200000
+    start = time.perf_counter()
+    for _ in range(lookups):
+        positions.position(2, 1)
+    print(f'history lookup: {(time.perf_counter() - start) / lookups * 1e9:.0f} ns')
+
+
+def spectator_tick_time(count, ticks, fan_out, slow):
+    rng = random.Random(1)
+    manager, sockets = start_benchmark_rooms(1)
+    room = next(iter(manager.rooms.values()))
+    step_benchmark_rooms(manager, sockets, rng)
+    viewers = []
+    for index in range(count):
+        viewer = spectator.Spectator() if fan_out else NullSocket()
+        if fan_out:
+            room.add_spectator(viewer)
+        viewers.append((viewer, index < count * slow))
+
+    elapsed = 0.0
+    for _ in range(ticks):
+        start = time.perf_counter()
+        step_benchmark_rooms(manager, sockets, rng)
+        if not fan_out:
+            # Every viewer treated like a player: its own encode and send inside the tick
+            for viewer, _ in viewers:
+                viewer.sendall(protocol.encode_message(room.snapshots.message_for(room.snapshots.seq - 1)))
+        elapsed += time.perf_counter() - start
+        # Fast viewers' connections drain their queue between ticks, slow ones never do
+        for viewer, is_slow in viewers:
+            if fan_out and not is_slow:
+                viewer.take()
+
+    stalled = [viewer for viewer, is_slow in viewers if is_slow and fan_out]
+    return elapsed / ticks, stalled
+
+
+def run_spectators_benchmark(max_spectators, ticks, slow):
+    print(f'one match, {ticks} ticks, {slow:.0%} of viewers stop reading')
+    print(f"{'viewers':>8}{'per-viewer send ms':>20}{'shared fan-out ms':>19}")
+    for count in sorted({0, 10, 100, max_spectators}):
+        naive, _ = spectator_tick_time(count, ticks, False, slow)
+        shared, stalled = spectator_tick_time(count, ticks, True, slow)
+        print(f'{count:>8}{naive * 1000:>20.3f}{shared * 1000:>19.3f}')
+    if stalled:
+        queued = max(len(viewer.frames) for viewer in stalled)
+        dropped = sum(viewer.dropped for viewer in stalled)
+        closed = sum(viewer.closed for viewer in stalled)
+        print(f'stalled viewers: {len(stalled)}, longest queue {queued} frames, '
+              f'{dropped} frames dropped, {closed} disconnected')
+
+
+def drain_sockets(client_ends, stop):
+    selector = selectors.DefaultSelector()
+    for client_end in client_ends:
+        selector.register(client_end, selectors.EVENT_READ)
+    while not stop.is_set():
+        for key, _ in selector.select(0.1):
+            try:
+                key.fileobj.recv(65536)
+            except OSError:
+                selector.unregister(key.fileobj)
+
+
+def outbound_tick_times(rooms, ticks, queued):
+    rng = random.Random(1)
+    manager, sockets = start_benchmark_rooms(rooms)
+    logging.getLogger('Benchmark').setLevel(logging.CRITICAL)
+    client_ends = []
+    stalled = None
+    for index, (_, room, player_num) in enumerate(sockets):
+        server_end, client_end = socket.socketpair()
+        client_ends.append(client_end)
+        if index == 0:
+            # This client stops reading; its buffers are tiny so it fills up fast
+            server_end.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            client_end.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            if not queued:
+                # A real stalled peer blocks forever; cap each blocked send so the run ends
+                server_end.settimeout(0.05)
+        if not queued:
+            room.clients[player_num] = server_end
+        elif index == 0:
+            # Watermarks scaled down so a short run reaches them
+            room.clients[player_num] = outbound.QueuedSocket(server_end, outbound.OutboundQueue(8192, 2048))
+        else:
+            room.clients[player_num] = outbound.QueuedSocket(server_end)
+        if index == 0:
+            stalled = room.clients[player_num]
+    stop = threading.Event()
+    threading.Thread(target=drain_sockets, args=(client_ends[1:], stop), daemon=True).start()
+
+    times = []
+    for _ in range(ticks):
+        start = time.perf_counter()
+        with outbound.held_wakeups():
+            step_benchmark_rooms(manager, sockets, rng)
+        times.append(time.perf_counter() - start)
+        time.sleep(max(0.0, 0.01 - times[-1]))
+    stop.set()
+    backlog = stalled.queue.stats() if queued else None
+    for room in manager.rooms.values():
+        for client_socket in room.clients.values():
+            client_socket.close()
+    for client_end in client_ends:
+        client_end.close()
+    return times, backlog
+
+
+def run_outbound_benchmark(rooms, ticks):
+    print(f'{rooms} rooms on socket pairs, one client stops reading, {ticks} ticks at 100 Hz')
+    print(f"{'sends':<10}{'mean tick ms':>14}{'p99 ms':>10}{'max ms':>10}")
+    for label, queued in (('direct', False), ('queued', True)):
+        times, backlog = outbound_tick_times(rooms, ticks, queued)
+        ordered = sorted(times)
+        print(f'{label:<10}{sum(times) / len(times) * 1000:>14.2f}'
+              f'{ordered[int(len(ordered) * 0.99)] * 1000:>10.2f}{ordered[-1] * 1000:>10.2f}')
+    print(f"stalled client's queue: {outbound.describe(backlog)}")
+
+
+class KeepaliveConnection:
+    """A connection whose queue is itself: Keepalive only reads last_put and calls sendall()."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.queue = self
+        self.last_put = clock()
+        self.heartbeats = 0
+
+    def sendall(self, data):
+        self.last_put = self.clock()
+        if data is timers.HEARTBEAT_FRAME:
+            self.heartbeats += 1
+
+
+def keepalive_tick_times(count, busy, ticks):
+    now = [0.0]
+    clock = lambda: now[0]
+    timer_wheel = timers.TimerWheel(clock=clock)
+    connections = [KeepaliveConnection(clock) for _ in range(count)]
+    keepalives = []
+    for index, connection in enumerate(connections):
+        # Clients connect over the first second, not all at once
+        now[0] = index / count
+        keepalives.append(timers.Keepalive(timer_wheel, connection, lambda idle: None))
+    active = keepalives[:int(count * busy)]
+    interval = 1.0 / tick_clock.TICK_RATE
+    times = []
+    for _ in range(ticks):
+        now[0] += interval
+        for keepalive in active:
+            # A snapshot out and an ack back
+            keepalive.connection.sendall(b'')
+            keepalive.received()
+        start = time.perf_counter()
+        timer_wheel.run_due()
+        times.append(time.perf_counter() - start)
+    heartbeats = sum(connection.heartbeats for connection in connections)
+    return times, heartbeats / (ticks * interval)
+
+
+def heartbeat_thread_cpu(count, duration):
+    """CPU seconds per second spent by the old thread-per-client heartbeat loop."""
+    stop = threading.Event()
+
+    def send_heartbeats(client_socket):
+        while not stop.is_set():
+            protocol.send_message(client_socket, protocol.HEARTBEAT)
+            stop.wait(1)
+
+    threads = [threading.Thread(target=send_heartbeats, args=(NullSocket(),), daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    time.sleep(1)
+    start = time.process_time()
+    time.sleep(duration)
+    used = time.process_time() - start
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return used / duration
+
+
+def run_timers_benchmark(max_connections, busy, ticks):
+    print(f'{busy:.0%} of connections get a snapshot every tick, {ticks} ticks at {tick_clock.TICK_RATE} Hz')
+    print(f"{'connections':>12}{'threads CPU ms/s':>18}{'wheel CPU ms/s':>16}{'wheel max ms/tick':>19}"
+          f"{'heartbeats/s before':>21}{'heartbeats/s now':>18}")
+    for count in sorted({100, 1000, max_connections}):
+        threads = heartbeat_thread_cpu(count, 3.0)
+        times, heartbeats = keepalive_tick_times(count, busy, ticks)
+        # The old threads sent a heartbeat every second whether or not snapshots were flowing
+        print(f'{count:>12}{threads * 1000:>18.2f}{sum(times) / ticks * tick_clock.TICK_RATE * 1000:>16.2f}'
+              f'{max(times) * 1000:>19.3f}{count:>21}{heartbeats:>18.0f}')
+
+
+def run_logging_benchmark(iterations):
+    client_data = sample_messages()['player_action']
+    devnull = open(os.devnull, 'w')
+    # The old setup: basicConfig's stream handler, formatting and writing on the calling thread
+    sync_logger = logging.getLogger('LogBenchmark.sync')
+    sync_logger.propagate = False
+    handler = logging.StreamHandler(devnull)
+    handler.setFormatter(logging.Formatter('%(asctime)s [SERVER] %(message)s', datefmt='%H:%M:%S'))
+    sync_logger.addHandler(handler)
+    log.setup('BENCHMARK', stream=devnull)
+    queued_logger = logging.getLogger('LogBenchmark.queued')
+    message_logger = logging.getLogger(log.MESSAGES)
+    fields = {'room': 1, 'player': 1}
+
+    def before(data):
+        sync_logger.info(f'client data: {data}')
+
+    def queued(data):
+        queued_logger.info('client data: %s', data, extra={'fields': fields})
+
+    def sampled(data):
+        suppressed = log.message_limit.take() if message_logger.isEnabledFor(logging.INFO) else None
+        if suppressed is not None:
+            message_logger.info('client data: %s', data, extra={'fields': dict(fields, suppressed=suppressed)})
+
+    def cpu_per_message(function):
+        # The caller's own CPU time, then the whole process's once the writer has caught up
+        start_thread, start_process = time.thread_time(), time.process_time()
+        for _ in range(iterations):
+            function(client_data)
+        caller = time.thread_time() - start_thread
+        while not log.listener.queue.empty():
+            time.sleep(0.01)
+        return caller / iterations * 1e6, (time.process_time() - start_process) / iterations * 1e6
+
+    print(f'{iterations} player_action messages logged, CPU per message')
+    print(f"{'logging':<34}{'caller us':>11}{'total us':>10}")
+    for label, function in (('sync handler, f-string (before)', before), ('queue, every message', queued),
+                            ('queue, rate limited (now)', sampled)):
+        caller, total = cpu_per_message(function)
+        print(f'{label:<34}{caller:>11.2f}{total:>10.2f}')
+    message_logger.setLevel(logging.WARNING)
+    caller, total = cpu_per_message(sampled)
+    print(f"{f'{log.MESSAGES}=WARNING':<34}{caller:>11.2f}{total:>10.2f}")
+    log.stop()
+    devnull.close()
+
+
+def run_metrics_benchmark(iterations, rooms, ticks):
+    histogram = metrics.Histogram('benchmark_seconds', 'Benchmark observations')
+    counter = metrics.Counter('benchmark_total', 'Benchmark increments')
+    rng = random.Random(1)
+    values = [rng.expovariate(1000) for _ in range(iterations)]
+
+    def per_call(function):
+        start = time.perf_counter()
+        for value in values:
+            function(value)
+        return (time.perf_counter() - start) / iterations * 1e6
+
+    baseline = per_call(lambda value: None)
+    print(f'{iterations} calls, us per call over an empty call ({baseline:.3f} us)')
+    print(f'histogram observe: {per_call(histogram.observe) - baseline:.3f} us')
+    print(f'counter inc: {per_call(lambda value: counter.inc()) - baseline:.3f} us')
+
+    # Floats are freed again straight away; anything the histogram kept would show up here
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for value in values:
+        histogram.observe(value)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    kept = sum(stat.size_diff for stat in after.compare_to(before, 'filename')
+               if stat.traceback[0].filename == metrics.__file__)
+    print(f'bytes kept by {iterations} observations: {kept}')
+
+    manager, sockets = start_benchmark_rooms(rooms)
+    step_benchmark_rooms(manager, sockets, rng)
+    start = time.perf_counter()
+    for _ in range(ticks):
+        step_benchmark_rooms(manager, sockets, rng)
+    tick_time = (time.perf_counter() - start) / ticks
+    observed = room_manager.broadcast_seconds.count
+    print(f'rooms: {rooms}  tick time with metrics: {tick_time * 1000:.2f} ms  '
+          f'({observed} broadcasts timed, p50 {room_manager.broadcast_seconds.quantile(0.5) * 1e6:.0f} us)')
+
+    start = time.perf_counter()
+    text = metrics.registry.render()
+    print(f'scrape: {len(metrics.registry.metrics)} metrics, {len(text)} bytes rendered in '
+          f'{(time.perf_counter() - start) * 1000:.2f} ms')
+
+
+def run_reconnect_server(mode, port, reconnect_grace):
+    logging.disable(logging.INFO)
+    if mode == 'asyncio':
+        from async_server_fightinggame import AsyncGameServer as server_class
+    else:
+        from server_fightinggame import GameServer as server_class
+    server_class(host='127.0.0.1', port=port, max_rooms=1, replay_dir='', metrics_port=port + 1,
+                 reconnect_grace=reconnect_grace).start()
+
+
+class BenchmarkPlayer:
+    """A blocking player connection that counts what it takes to get back into a match."""
+
+    def __init__(self, port, hello):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.decoder = protocol.FrameDecoder()
+        self.pending = []
+        self.messages = 0
+        self.bytes = 0
+        self.send(hello)
+        self.reply = self.wait_for('connected', 'error')
+
+    def send(self, message):
+        data = protocol.encode_message(message)
+        self.messages += 1
+        self.bytes += len(data)
+        self.sock.sendall(data)
+
+    def wait_for(self, *statuses):
+        while True:
+            while self.pending:
+                message = self.pending.pop(0)
+                if message.get('status') in statuses:
+                    return message
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError('server closed the connection')
+            self.bytes += len(data)
+            self.pending = self.decoder.feed(data)
+            self.messages += len(self.pending)
+
+    def join_match(self):
+        player_num = self.reply['player_num']
+        self.send({f'player{player_num}_character': 'Lucario'})
+        self.send({'ready': True})
+
+
+def matches_started(port):
+    # Read from the server's own metrics; every new match also saves the character selection
+    text = urllib.request.urlopen(f'http://127.0.0.1:{port + 1}/metrics').read().decode()
+    return next(float(line.split()[-1]) for line in text.splitlines()
+                if line.startswith('fightinggame_matches_started_total '))
+
+
+def reconnect_rounds(mode, port, rounds, reconnect_grace):
+    server = multiprocessing.Process(target=run_reconnect_server, args=(mode, port, reconnect_grace), daemon=True)
+    server.start()
+    time.sleep(1)
+    try:
+        first = BenchmarkPlayer(port, session.JOIN)
+        second = BenchmarkPlayer(port, session.JOIN)
+        first.join_match()
+        second.join_match()
+        second.wait_for('match_start')
+        first.wait_for('match_start')
+        matches_before = matches_started(port)
+
+        times, messages, traffic = [], 0, 0
+        for _ in range(rounds):
+            first.sock.close()
+            if reconnect_grace:
+                second.wait_for('player_dropped')
+            else:
+                second.wait_for('server_error')
+            start = time.perf_counter()
+            if reconnect_grace:
+                first = BenchmarkPlayer(port, {'resume': first.reply['session']})
+                first.wait_for('match_start')
+            else:
+                # The old way back: a new player in the lobby, and the opponent readying up again
+                first = BenchmarkPlayer(port, session.JOIN)
+                first.join_match()
+                second.send({'ready': True})
+                second.wait_for('match_start')
+                first.wait_for('match_start')
+            times.append(time.perf_counter() - start)
+            messages += first.messages
+            traffic += first.bytes
+            second.messages = second.bytes = 0
+        return times, messages / rounds, traffic / rounds, (matches_started(port) - matches_before) / rounds
+    finally:
+        server.terminate()
+        server.join()
+
+
+def run_reconnect_benchmark(mode, port, rounds):
+    print(f'mode={mode}, {rounds} drops of player 1 in a running match')
+    print(f"{'flow':<30}{'p50 ms':>8}{'max ms':>8}{'messages':>10}{'bytes':>8}{'new matches':>13}")
+    for label, grace in (('new connection + lobby (old)', 0), ('resume session (now)', session.RECONNECT_GRACE)):
+        times, messages, traffic, matches = reconnect_rounds(mode, port, rounds, grace)
+        times.sort()
+        print(f'{label:<30}{times[len(times) // 2] * 1000:>8.1f}{times[-1] * 1000:>8.1f}'
+              f'{messages:>10.1f}{traffic:>8.0f}{matches:>13.1f}')
+
+
+class ScanQueue:
+    """Matchmaking without an index: the oldest player gets the closest rating anywhere in the queue."""
+
+    def __init__(self, clock=None):
+        self.waiting = []
+
+    def push(self, player, skill):
+        self.waiting.append((player, skill))
+
+    def pop_pair(self):
+        head, head_skill = self.waiting[0]
+        index = min(range(1, len(self.waiting)), key=lambda index: abs(self.waiting[index][1] - head_skill))
+        opponent = self.waiting.pop(index)[0]
+        self.waiting.pop(0)
+        return head, opponent
+
+
+def matchmaking_pairing_time(queue_class, queued, pairs):
+    """Microseconds per pair taken off a queue kept at `queued` players, one arrival per player leaving."""
+    rng = random.Random(1)
+    now = [0.0]
+    queue = queue_class(clock=lambda: now[0])
+    for player in range(queued):
+        queue.push(player, round(rng.gauss(1200, 300)))
+    skills = [round(rng.gauss(1200, 300)) for _ in range(2 * pairs)]
+    start = time.perf_counter()
+    for pair in range(pairs):
+        # One pair per matching pass, so tolerances widen as they would on a server
+        now[0] += matchmaking.MATCH_INTERVAL
+        queue.pop_pair()
+        queue.push(queued + 2 * pair, skills[2 * pair])
+        queue.push(queued + 2 * pair + 1, skills[2 * pair + 1])
+    return (time.perf_counter() - start) / pairs * 1e6, queue
+
+
+def run_matchmaking_benchmark(max_queued, pairs):
+    print(f'{pairs} pairs taken off a full queue, ratings ~ N(1200, 300), '
+          f'{matchmaking.SKILL_BUCKET}-point buckets')
+    print(f"{'queued':>8}{'scan us/pair':>14}{'indexed us/pair':>17}{'positions ms/pass':>19}")
+    for queued in sorted({1000, 10000, max_queued}):
+        scan, _ = matchmaking_pairing_time(ScanQueue, queued, min(pairs, 200))
+        indexed, queue = matchmaking_pairing_time(matchmaking.MatchQueue, queued, pairs)
+        # Position updates walk the whole queue, but only every few seconds and off the pairing path
+        start = time.perf_counter()
+        for _ in queue.changed_positions():
+            pass
+        positions = time.perf_counter() - start
+        print(f'{queued:>8}{scan:>14.1f}{indexed:>17.1f}{positions * 1000:>19.2f}')
+
+
+def input_handling_time(rate, duration, coalesce, limit):
+    """CPU seconds per second of play spent on one player sending `rate` actions a second, and when it was cut off."""
+    manager, sockets = start_benchmark_rooms(1)
+    room = manager.snapshot_active()[0]
+    sock = sockets[0][0]
+    rng = random.Random(1)
+    now = [0.0]
+    budget = inputs.TokenBucket(clock=lambda: now[0]) if limit else None
+    per_tick = rate / tick_clock.TICK_RATE
+    messages = [{'player_action': {'x': 300 + rng.randrange(-5, 6), 'attack': rng.random() < 0.1, 'damage': 0,
+                                   'input_seq': seq}} for seq in range(1, int(per_tick) + 2)]
+    elapsed = 0.0
+    cut_off = None
+    sent = 0.0
+    for tick in range(1, int(duration * tick_clock.TICK_RATE) + 1):
+        now[0] = tick / tick_clock.TICK_RATE
+        sent += per_tick
+        batch = messages[:int(sent)]
+        sent -= len(batch)
+        start = time.perf_counter()
+        if budget is not None and cut_off is None and not budget.take(len(batch)):
+            # The read loop checks the budget per recv; here, per tick's worth of messages
+            cut_off = now[0]
+        if cut_off is None and coalesce:
+            for message in batch:
+                room.handle_client_data(sock, 1, message)
+            room.apply_inputs()
+        elif cut_off is None:
+            # Every action applied the moment it arrives
+            for message in batch:
+                room.handle_client_data(sock, 1, message)
+                room.apply_inputs()
+        elapsed += time.perf_counter() - start
+    return elapsed / duration, cut_off
+
+
+def run_inputs_benchmark(duration):
+    print(f'One player sending player_action at each rate for {duration:.0f}s at {tick_clock.TICK_RATE} Hz, '
+          f'budget {inputs.MESSAGE_RATE:.0f}/s with a burst of {inputs.MESSAGE_BURST}')
+    print(f"{'sent/s':>8}{'before CPU ms/s':>17}{'coalesced ms/s':>16}{'+ budget ms/s':>15}{'disconnected after':>20}")
+    logging.getLogger(log.MESSAGES).setLevel(logging.WARNING)
+    for rate in (60, 600, 6000, 60000):
+        before, _ = input_handling_time(rate, duration, False, False)
+        coalesced, _ = input_handling_time(rate, duration, True, False)
+        now, cut_off = input_handling_time(rate, duration, True, True)
+        print(f"{rate:>8}{before * 1000:>17.2f}{coalesced * 1000:>16.2f}{now * 1000:>15.2f}"
+              f"{f'{cut_off:.2f}s' if cut_off is not None else '-':>20}")
+
+
+def simulate_clock_estimates(duration, delay, spikes, rng):
+    """Errors in seconds of three estimates of the server timeline, sampled every 100 ms of local time."""
+    offset, drift = 1234.5, 50e-6
+
+    def server_time(local):
+        return offset + local * (1 + drift)
+
+    def one_way():
+        # A base delay, a little jitter, and now and then a queue on one side only
+        extra = rng.uniform(0.02, 0.15) if rng.random() < spikes else 0.0
+        return delay + rng.expovariate(1 / 0.003) + extra
+
+    sync = clocksync.ClockSync()
+    last_ping = None
+    lateness = interpolation.InterpolationBuffer()
+    events = []
+    for tick in range(math.ceil(server_time(0) * tick_clock.TICK_RATE), int(server_time(duration) * tick_clock.TICK_RATE)):
+        # Snapshot of tick n leaves at server time n / rate
+        local_sent = (tick / tick_clock.TICK_RATE - offset) / (1 + drift)
+        heapq.heappush(events, (local_sent + one_way(), 'snapshot', tick / tick_clock.TICK_RATE))
+    errors = {'snapshot lateness (before)': [], 'last ping only': [], 'filtered pings (now)': []}
+    step = 0.001
+    for index in range(int(duration / step)):
+        now = index * step
+        ping = sync.ping(now)
+        if ping is not None:
+            up = one_way()
+            heapq.heappush(events, (now + up + one_way(), 'pong',
+                                   {'ping': ping['clock_ping'], 'server_time': server_time(now + up)}))
+        while events and events[0][0] <= now:
+            _, kind, payload = heapq.heappop(events)
+            if kind == 'snapshot':
+                lateness.push(payload, now, 0, 0)
+            else:
+                sync.pong(payload, now)
+                last_ping = payload['server_time'] - (payload['ping'] + now) / 2
+        if index % 100 == 0 and now > 5.0:
+            actual = server_time(now)
+            errors['snapshot lateness (before)'].append(now - lateness.latency - actual)
+            errors['last ping only'].append(now + last_ping - actual)
+            errors['filtered pings (now)'].append(sync.server_time(now) - actual)
+    return errors, sync
+
+
+def run_clock_benchmark(duration, delay, spikes):
+    errors, sync = simulate_clock_estimates(duration, delay / 1000, spikes, random.Random(1))
+    print(f'{duration:.0f}s simulated, {delay:.0f} ms each way, {spikes:.0%} of packets queued 20-150 ms, '
+          f'server clock 50 ppm fast')
+    print(f"{'estimate of server time':<30}{'p50 ms':>8}{'p99 ms':>8}{'max ms':>8}{'p99 ticks':>11}")
+    for label, samples in errors.items():
+        magnitudes = sorted(abs(error) for error in samples)
+        p50 = magnitudes[len(magnitudes) // 2]
+        p99 = magnitudes[int(len(magnitudes) * 0.99)]
+        print(f'{label:<30}{p50 * 1000:>8.2f}{p99 * 1000:>8.2f}{magnitudes[-1] * 1000:>8.2f}'
+              f'{p99 * tick_clock.TICK_RATE:>11.3f}')
+    print(f'round trip estimate {sync.rtt * 1000:.1f} ms (base {2 * delay:.0f} ms)')
+
+
+def draw_stage_every_frame(screen, platforms, render):
+    # The renderer before: a line per screen row, the mountains and each platform, every frame
+    screen.fill((0, 0, 0))
+    render.draw_sky(screen)
+    render.draw_mountains(screen)
+    for platform in platforms:
+        render.draw_platform(screen, platform)
+
+
+def frame_times(size, platforms, frames, cached):
+    """Wall and CPU milliseconds per frame of drawing the stage and flipping, and the last frame drawn."""
+    import pygame
+    import render_fightinggame as render
+
+    screen = pygame.display.set_mode(size)
+    layers = render.StaticLayers()
+    start, start_cpu = time.perf_counter(), time.process_time()
+    for _ in range(frames):
+        if cached:
+            layers.draw(screen, platforms)
+        else:
+            draw_stage_every_frame(screen, platforms, render)
+        pygame.display.flip()
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+    return elapsed / frames * 1000, cpu / frames * 1000, pygame.image.tobytes(screen, 'RGB')
+
+
+def run_render_benchmark(frames):
+    # Off screen, so it runs on a server or in CI; on a real display flip() costs more but the same for both
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    import render_fightinggame as render
+
+    pygame.init()
+    manager, _ = start_benchmark_rooms(1)
+    platforms = [type('Platform', (), data) for data in manager.snapshot_active()[0].platforms]
+    print(f'{frames} frames of the stage on {os.environ["SDL_VIDEODRIVER"]} video')
+    print(f"{'window':>10}{'every frame ms':>16}{'cpu ms':>8}{'cached ms':>11}{'cpu ms':>8}{'same pixels':>13}")
+    for label, size in (('client', (1000, 650)), ('stadium', (1000, 1000))):
+        before, before_cpu, expected = frame_times(size, platforms, frames, False)
+        now, now_cpu, drawn = frame_times(size, platforms, frames, True)
+        print(f"{label:>10}{before:>16.3f}{before_cpu:>8.3f}{now:>11.3f}{now_cpu:>8.3f}"
+              f"{'yes' if drawn == expected else 'NO':>13}")
+
+    print(f'{frames} frames of a match in the client window, two fighters moving')
+    print(f"{'mode':>10}{'ms/frame':>10}{'cpu ms':>8}{'pixels pushed/frame':>21}")
+    for mode in (render.FULL, render.DIRTY):
+        elapsed, cpu, pushed = match_frame_times(platforms, frames, mode)
+        print(f'{mode:>10}{elapsed:>10.3f}{cpu:>8.3f}{pushed:>21.0f}')
+    pygame.quit()
+
+
+def match_frame_times(platforms, frames, mode):
+    """Wall and CPU milliseconds per frame of a match in progress, and pixels sent to the display per frame."""
+    import pygame
+    import render_fightinggame as render
+
+    screen = pygame.display.set_mode((1000, 650))
+    layers = render.StaticLayers()
+    dirty = render.DirtyRects(mode)
+    sprites = [pygame.Surface((100, 100)).convert() for _ in range(2)]
+    for sprite, color in zip(sprites, ((0, 0, 255), (255, 0, 0))):
+        sprite.fill(color)
+    ping = pygame.font.Font(None, 36).render('Ping 42 ms', True, (255, 255, 255))
+    pushed = 0
+    start, start_cpu = time.perf_counter(), time.process_time()
+    for frame in range(frames):
+        dirty.begin(screen, layers.render_stage(screen.get_size(), platforms))
+        for index, sprite in enumerate(sprites):
+            # Running back and forth along the main platform, as in client.draw_character
+            x = 500 + (-1) ** index * 250 * math.sin(frame / 40 + index)
+            rect = screen.blit(sprite, sprite.get_rect(midbottom=(x, 600)))
+            bar = pygame.draw.rect(screen, (0, 255, 0), (x - 50, 480, 100, 10))
+            dirty.add(rect.union(bar))
+        dirty.add(screen.blit(ping, ping.get_rect(topright=(990, 10))))
+        pushed += dirty.present()
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+    return elapsed / frames * 1000, cpu / frames * 1000, pushed / frames
+
+
+def run_assets_benchmark(iterations):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    import assets_fightinggame as assets
+
+    pygame.init()
+    pygame.display.set_mode((1000, 650))
+    names = list(assets.CHARACTER_COLORS)
+    start = time.perf_counter()
+    for index in range(iterations):
+        # What create_character_sprite and Character.load_sprite did on every call
+        path = os.path.join(assets.ASSET_DIR, assets.character_asset(names[index % len(names)]))
+        pygame.transform.scale(pygame.image.load(path).convert_alpha(), assets.SPRITE_SIZE)
+    by_hand = (time.perf_counter() - start) / iterations
+    manager = assets.AssetManager()
+    start = time.perf_counter()
+    manager.preload().join()
+    decoded = time.perf_counter() - start
+    start = time.perf_counter()
+    for name in names:
+        manager.surface(assets.character_asset(name), assets.SPRITE_SIZE)
+    converted = time.perf_counter() - start
+    start = time.perf_counter()
+    for index in range(iterations):
+        manager.surface(assets.character_asset(names[index % len(names)]), assets.SPRITE_SIZE)
+    cached = (time.perf_counter() - start) / iterations
+    print(f'{len(manager.assets())} sprites, {iterations} fetches at {assets.SPRITE_SIZE[0]}x{assets.SPRITE_SIZE[1]}')
+    print(f'load and scale per call  {by_hand * 1000:10.3f} ms/sprite')
+    print(f'asset cache hit          {cached * 1000:10.5f} ms/sprite')
+    print(f'preload: {decoded * 1000:.1f} ms decoding on the loader thread, '
+          f'{converted * 1000:.1f} ms converting on the main thread')
+    pygame.quit()
+
+
+def popup_text_every_frame(font, small_font, message, width):
+    # What draw_error_popup did each frame: wrap with font.size, then render every line
+    surfaces = [font.render('SERVER ERROR', True, (255, 0, 0))]
+    lines = []
+    line = ''
+    for word in message.split():
+        test_line = line + ' ' + word if line else word
+        if small_font.size(test_line)[0] <= width:
+            line = test_line
+        else:
+            lines.append(line)
+            line = word
+    if line:
+        lines.append(line)
+    surfaces.extend(small_font.render(line, True, (255, 255, 255)) for line in lines)
+    surfaces.append(small_font.render('Press ESC to exit', True, (255, 255, 0)))
+    return surfaces
+
+
+def popup_text_cached(text, font, small_font, message, width):
+    import render_fightinggame as render
+
+    surfaces = [text.render(font, 'SERVER ERROR', (255, 0, 0))]
+    surfaces.extend(text.render(small_font, line, (255, 255, 255))
+                    for line in render.wrap_text(small_font, message, width))
+    surfaces.append(text.render(small_font, 'Press ESC to exit', (255, 255, 0)))
+    return surfaces
+
+
+def run_text_benchmark(frames):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    import render_fightinggame as render
+
+    pygame.init()
+    font, small_font = pygame.font.Font(None, 74), pygame.font.Font(None, 36)
+    message = ('Connection error: [Errno 111] Connection refused while reconnecting to the game server, '
+               'the match is over')
+    text = render.TextCache()
+    print(f'{frames} frames of the error popup text, {len(render.wrap_text(small_font, message, 660))} wrapped lines')
+    for label, draw in (('rendered every frame', lambda: popup_text_every_frame(font, small_font, message, 660)),
+                        ('cached', lambda: popup_text_cached(text, font, small_font, message, 660))):
+        start = time.perf_counter()
+        for _ in range(frames):
+            draw()
+        print(f'{label:<22}{(time.perf_counter() - start) / frames * 1000:>10.4f} ms/frame')
+    print(f'text cache: {len(text.surfaces)} surfaces, {text.bytes / 1024:.0f} KiB')
+    pygame.quit()
+
+
+def main():
+    args = parse_arguments()
+    if args.benchmark == 'protocol':
+        run_protocol_benchmark(args.iterations)
+    elif args.benchmark == 'snapshot':
+        run_snapshot_benchmark(args.ticks)
+    elif args.benchmark == 'connections':
+        run_connections_benchmark(args.mode, args.connections, args.port)
+    elif args.benchmark == 'rooms':
+        run_rooms_benchmark(args.rooms, args.ticks)
+    elif args.benchmark == 'shards':
+        run_shards_benchmark(args.rooms, args.workers, args.duration)
+    elif args.benchmark == 'rewind':
+        run_rewind_benchmark(args.rtt, args.ticks)
+    elif args.benchmark == 'interpolation':
+        run_interpolation_benchmark(args.jitter, args.duration)
+    elif args.benchmark == 'ticks':
+        run_ticks_benchmark(args.rate, args.duration, args.work)
+    elif args.benchmark == 'outbound':
+        run_outbound_benchmark(args.rooms, args.ticks)
+    elif args.benchmark == 'spectators':
+        run_spectators_benchmark(args.spectators, args.ticks, args.slow)
+    elif args.benchmark == 'timers':
+        run_timers_benchmark(args.connections, args.busy, args.ticks)
+    elif args.benchmark == 'logging':
+        run_logging_benchmark(args.iterations)
+    elif args.benchmark == 'metrics':
+        run_metrics_benchmark(args.iterations, args.rooms, args.ticks)
+    elif args.benchmark == 'reconnect':
+        run_reconnect_benchmark(args.mode, args.port, args.rounds)
+    elif args.benchmark == 'matchmaking':
+        run_matchmaking_benchmark(args.queued, args.pairs)
+    elif args.benchmark == 'inputs':
+        run_inputs_benchmark(args.duration)
+    elif args.benchmark == 'clock':
+        run_clock_benchmark(args.duration, args.delay, args.spikes)
+    elif args.benchmark == 'render':
+        run_render_benchmark(args.frames)
+    elif args.benchmark == 'assets':
+        run_assets_benchmark(args.iterations)
+    elif args.benchmark == 'text':
+        run_text_benchmark(args.frames)
+
+
+if __name__ == '__main__':
+    main()
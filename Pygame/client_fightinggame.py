@@ -1,13 +1,22 @@
 import pygame
 import pygame_gui
 import socket
-import pickle
 import threading
 import sys
 import time
 import logging
 import argparse
 from pygame.locals import *
+import protocol_fightinggame as protocol
+import snapshot_fightinggame as snapshot
+import prediction_fightinggame as prediction
+import interpolation_fightinggame as interpolation
+import assets_fightinggame as assets
+import clocksync_fightinggame as clocksync
+import render_fightinggame as render
+import log_fightinggame as log
+import session_fightinggame as session
+import tick_fightinggame as tick_clock
 #from typing import Dict, Any, Optional, Tuple
 #from login_system import LoginSystem
 
@@ -15,19 +24,29 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description='Pokemon Fighting Game Server')
     parser.add_argument('--port', '-p', type=int, default=5555,
                         help='Port to listen on')
+    parser.add_argument('--spectate', type=int, default=None, metavar='ROOM',
+                        help='Watch a match instead of playing (0 for any running match)')
+    parser.add_argument('--spectator-port', type=int, default=5556,
+                        help='Server port for spectators')
+    parser.add_argument('--render', choices=(render.DIRTY, render.FULL), default=render.DIRTY,
+                        help='Push only the changed parts of each frame to the display, or the whole window')
+    log.add_arguments(parser)
     return parser.parse_args()
 
 class GameClient:
-    def __init__(self, host='localhost', port=5555):
-        logging.basicConfig(level=logging.INFO,
-                            format='%(asctime)s [CLIENT] %(message)s',
-                            datefmt='%H:%M:%S')
+    def __init__(self, host='localhost', port=5555, render_mode=render.DIRTY):
+        log.setup('CLIENT')
         self.logger = logging.getLogger('GameClient')
         pygame.init()
 
         self.host = host
         self.port = port
         self.client_socket = None
+        # The receive thread answers heartbeats and acks snapshots while the main
+        # loop sends input; sendall can interleave two threads' partial writes
+        self.send_lock = threading.Lock()
+        self.decoder = protocol.FrameDecoder()
+        self.pending_messages = []
         self.player_num = None
         self.character_name = None
         self.opponent_character = None
@@ -55,11 +74,23 @@ class GameClient:
         self.font = pygame.font.Font(None, 74)
         self.small_font = pygame.font.Font(None, 36)
 
-        self.game_state = {
-            'players':{},
-            'platforms':[]
-        }
+        # Written by the receive thread only; the game loop takes the newest state once per frame
+        self.latest_state = snapshot.LatestSnapshot()
         self.platforms = []
+        # Sky, mountains and platforms, drawn once per window size and stage
+        self.layers = render.StaticLayers()
+        self.dirty = render.DirtyRects(render_mode)
+        # Every string on screen, rasterized once
+        self.text = render.TextCache()
+        self.snapshots = snapshot.SnapshotReceiver()
+        self.predictor = prediction.Predictor()
+        self.tick_rate = tick_clock.TICK_RATE
+        self.opponent_buffer = interpolation.InterpolationBuffer()
+        # Our clock against the server's tick timeline, from pings over the game connection
+        self.clock_sync = clocksync.ClockSync()
+        self.spectating = False
+        self.player_buffers = {}
+        self.player_sprites = {}
         self.ready = False
 
         self.available_characters = ['Lucario', 'Mewtwo', 'Zeraora', 'Cinderace']
@@ -68,33 +99,55 @@ class GameClient:
         self.character_sprite = None
         self.opponent_sprite = None
 
-        self.heartbeat_thread = None
         self.last_server_response = time.time()
-        self.heartbeat_timeout = 1000
+        # Seconds of silence before the server counts as gone; it sends a heartbeat every second it has nothing else
+        self.heartbeat_timeout = 5
         self.server_error = False
         self.error_message = None
+        # Presented on a new connection to take our slot back after a drop
+        self.session = None
+        self.reconnect_grace = 0
+        self.reconnecting = False
+        self.opponent_dropped = False
+        # Place in the matchmaking queue and how many are waiting, while every room is taken
+        self.queue_position = None
+
+    def handshake(self, hello):
+        """Opens a new connection to the server, says hello and returns its reply."""
+        client_socket = socket.create_connection((self.host, self.port), timeout=5)
+        with self.send_lock:
+            protocol.send_message(client_socket, hello)
+        decoder = protocol.FrameDecoder()
+        messages = []
+        while not messages:
+            messages = protocol.recv_messages(client_socket, decoder)
+            if messages is None:
+                client_socket.close()
+                raise ConnectionError('Server closed the connection')
+        # A recv that outlasts this means the server went quiet; no thread has to watch for it
+        client_socket.settimeout(self.heartbeat_timeout)
+        self.client_socket = client_socket
+        self.decoder = decoder
+        self.pending_messages = messages[1:]
+        return messages[0]
 
     def connect_to_server(self):
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.settimeout(5)
-            self.client_socket.connect((self.host, self.port))
-            self.client_socket.settimeout(None)
-
-            data = self.client_socket.recv(4096)
-            response = pickle.loads(data)
+            response = self.handshake(session.JOIN)
+            if response['status'] == 'queued':
+                response = self.wait_in_queue(response)
 
             if response['status'] == 'connected':
                 self.player_num = response['player_num']
+                self.tick_rate = response.get('tick_rate', tick_clock.TICK_RATE)
+                self.clock_sync.rate = self.tick_rate
+                self.session = response.get('session')
+                self.reconnect_grace = response.get('reconnect_grace', 0)
                 self.connected = True
                 self.logger.info(f'Connected to server as Player {self.player_num}')
 
                 #self.send_data({'login_info': user_data})
 
-                self.heartbeat_thread = threading.Thread(target=self.check_server_heartbeat)
-                self.heartbeat_thread.daemon = True
-                self.heartbeat_thread.start()
-
                 receive_thread = threading.Thread(target=self.receive_data)
                 receive_thread.daemon = True
                 receive_thread.start()
@@ -117,56 +170,78 @@ class GameClient:
             self.error_message = f"Connection error: {str(e)}"
             return False
 
-    def check_server_heartbeat(self):
-        while self.connected:
-            if time.time() - self.last_server_response > self.heartbeat_timeout:
-                self.logger.info("Server heartbeat timeout - no response")
-                self.server_error = True
-                self.error_message = "Server connection lost: No response"
-                self.connected = False
-            time.sleep(1)
+    def wait_in_queue(self, response):
+        """Shows our place in the queue until the server seats us; returns the message that ends the wait."""
+        # Short reads, so the window keeps drawing between the server's messages
+        self.client_socket.settimeout(1 / 20)
+        try:
+            while response is None or response['status'] in ('queued', 'heartbeat'):
+                if response is not None:
+                    if response['status'] == 'heartbeat':
+                        with self.send_lock:
+                            protocol.send_message(self.client_socket, protocol.HEARTBEAT)
+                    else:
+                        self.queue_position = (response['position'], response['waiting'])
+                self.draw_queue_screen()
+                response = self.next_message()
+        finally:
+            self.client_socket.settimeout(self.heartbeat_timeout)
+        self.queue_position = None
+        return response
+
+    def next_message(self):
+        """The next message on the handshake connection, or None if nothing arrived yet."""
+        if not self.pending_messages:
+            try:
+                messages = protocol.recv_messages(self.client_socket, self.decoder)
+            except socket.timeout:
+                return None
+            if messages is None:
+                raise ConnectionError('Server closed the connection')
+            self.pending_messages = messages
+        return self.pending_messages.pop(0) if self.pending_messages else None
+
+    def draw_queue_screen(self):
+        if self.dirty.begin(self.screen, self.BLACK, key=('queue', self.queue_position)):
+            wait_text = self.text.render(self.font, 'All matches are full, waiting for a free room...', self.WHITE)
+            self.dirty.add(self.screen.blit(wait_text, wait_text.get_rect(center=(self.SCREEN_WIDTH/2, 300))))
+            if self.queue_position:
+                position, waiting = self.queue_position
+                place_text = self.text.render(self.small_font, f'Place in queue: {position} of {waiting}', self.GREEN)
+                self.dirty.add(self.screen.blit(place_text, place_text.get_rect(center=(self.SCREEN_WIDTH/2, 400))))
+            self.dirty.present()
+        for event in pygame.event.get():
+            if event.type == QUIT or (event.type == KEYDOWN and event.key == K_ESCAPE):
+                pygame.quit()
+                sys.exit()
+        self.clock.tick(60)
 
     def receive_data(self):
+        messages, self.pending_messages = self.pending_messages, []
+        for response in messages:
+            self.handle_server_message(response)
+
         while self.connected:
             try:
-                data = self.client_socket.recv(4096)
-                if not data:
+                messages = protocol.recv_messages(self.client_socket, self.decoder)
+                if messages is None:
                     self.logger.info("Empty data received from server - disconnected")
-                    self.server_error = True
-                    self.error_message = "Server disconnected"
-                    self.connected = False
+                    if self.connection_lost("Server disconnected"):
+                        continue
                     break
                 self.last_server_response = time.time()
-                response = pickle.loads(data)
-
-                if 'status' in response:
-                    if response['status'] == 'match_start':
-                        self.match_started = True
-                        self.game_state = response['game_state']
-                        self.init_platforms()
-                    elif response['status'] == 'game_over':
-                        self.game_over = True
-                        self.winner = response['winner']
-                    elif response['status'] == 'server_error':
-                        self.server_error = True
-                        self.error_message = response.get('message', "Server reported an error")
-                        self.logger.info(f'Server error: {self.error_message}')
-                    elif response['status'] == 'heartbeat':
-                        pass
-                else:
-                    self.game_state = response
-
-                opponent_num = 2 if self.player_num == 1 else 1
-                if (opponent_num in self.game_state['players'] and
-                    self.game_state['players'][opponent_num].get('character') and
-                    not self.opponent_character):
-                    self.opponent_character = self.game_state['players'][opponent_num]['character']
-                    self.opponent_sprite = self.create_character_sprite(self.opponent_character)
+
+                for response in messages:
+                    self.handle_server_message(response)
+            except socket.timeout:
+                self.logger.info("Server heartbeat timeout - no response")
+                if self.connection_lost("Server connection lost: No response"):
+                    continue
+                break
             except (socket.error, ConnectionResetError, ConnectionAbortedError) as e:
                 self.logger.info(f'socket connection error: {str(e)}')
-                self.server_error = True
-                self.error_message = f'Server connection lost: {str(e)}'
-                self.connected = False
+                if self.connection_lost(f'Server connection lost: {str(e)}'):
+                    continue
                 break
 
             except Exception as e:
@@ -176,21 +251,173 @@ class GameClient:
                 self.connected = False
                 break
 
+    def connection_lost(self, error_message):
+        """True if the session was resumed on a new connection; otherwise the error is shown."""
+        if self.reconnect():
+            return True
+        self.server_error = True
+        self.error_message = error_message
+        self.connected = False
+        return False
+
+    def reconnect(self):
+        """Takes our slot back while the server holds it; the match carries on without a new lobby."""
+        if self.session is None or self.spectating:
+            return False
+        self.reconnecting = True
+        self.connected = False
+        try:
+            self.client_socket.close()
+        except OSError:
+            pass
+        deadline = time.monotonic() + self.reconnect_grace
+        delay = session.RECONNECT_DELAY
+        try:
+            while time.monotonic() < deadline:
+                try:
+                    response = self.handshake({'resume': self.session})
+                except (OSError, protocol.ProtocolError) as e:
+                    self.logger.info(f'Reconnect failed: {str(e)}')
+                    time.sleep(delay)
+                    delay = min(delay * 2, session.MAX_RECONNECT_DELAY)
+                    continue
+                if response.get('status') != 'connected':
+                    self.logger.info(f"Could not resume: {response.get('message', 'Unknown error')}")
+                    return False
+                self.logger.info(f'Resumed as Player {self.player_num}')
+                self.connected = True
+                # The server follows its reply with the match as it is now
+                messages, self.pending_messages = self.pending_messages, []
+                for message in messages:
+                    self.handle_server_message(message)
+                return True
+            return False
+        finally:
+            self.reconnecting = False
+
+    def handle_server_message(self, response):
+        if 'status' in response:
+            if response['status'] == 'match_start':
+                game_state = self.latest_state.publish(response['game_state'])
+                self.init_platforms(game_state)
+                if self.player_num in game_state['players']:
+                    self.predictor.reset(game_state['players'][self.player_num])
+                self.opponent_buffer.clear()
+                if self.spectating:
+                    self.player_buffers.clear()
+                    self.game_over = False
+                self.match_started = True
+            elif response['status'] in ('game_state_update', 'game_state_delta') and 'seq' in response:
+                self.apply_snapshot(response)
+            elif response['status'] == 'game_state_update':
+                self.latest_state.publish(response['game_state'])
+            elif response['status'] == 'game_over':
+                self.game_over = True
+                self.winner = response['winner']
+            elif response['status'] == 'server_error':
+                self.server_error = True
+                self.error_message = response.get('message', "Server reported an error")
+                self.logger.info(f'Server error: {self.error_message}')
+            elif response['status'] == 'heartbeat':
+                # The server only hears from an idle client through these answers
+                self.send_data(protocol.HEARTBEAT)
+            elif response['status'] == 'player_dropped':
+                self.opponent_dropped = True
+            elif response['status'] == 'player_resumed':
+                self.opponent_dropped = False
+            elif response['status'] == 'clock_pong':
+                synced = self.clock_sync.synced
+                self.clock_sync.pong(response)
+                if not synced:
+                    # Timestamps so far were on our own clock; start over on the server's
+                    self.opponent_buffer.clear()
+        else:
+            self.latest_state.publish(response)
+
+        opponent_num = 2 if self.player_num == 1 else 1
+        players = self.latest_state.take()['players']
+        if (opponent_num in players and
+            players[opponent_num].get('character') and
+            not self.opponent_character):
+            self.opponent_character = players[opponent_num]['character']
+            self.opponent_sprite = self.create_character_sprite(self.opponent_character)
+
+    def apply_snapshot(self, response):
+        game_state = self.snapshots.apply(response)
+        if self.spectating:
+            # Read-only: the server resyncs spectators with a keyframe on its own
+            if game_state is not None:
+                self.latest_state.publish(game_state)
+                for player_num, player in game_state['players'].items():
+                    buffer = self.player_buffers.setdefault(player_num, interpolation.InterpolationBuffer())
+                    buffer.push(response['tick'] / self.tick_rate, time.monotonic(), player['x'], player['y'])
+            return
+        if game_state is None:
+            if not self.snapshots.keyframe_requested:
+                self.snapshots.keyframe_requested = True
+                self.send_data({'keyframe_request': True})
+            return
+
+        self.latest_state.publish(game_state)
+        self.send_data({'snapshot_ack': response['seq']})
+        if self.player_num in game_state['players']:
+            self.predictor.server_state(game_state['players'][self.player_num])
+        opponent = game_state['players'].get(2 if self.player_num == 1 else 1)
+        if opponent is not None and response.get('tick') is not None:
+            self.opponent_buffer.push(response['tick'] / self.tick_rate, self.timeline(), opponent['x'], opponent['y'])
+
+    def timeline(self):
+        """Now on the server's tick timeline once the clock is synced, on our own clock until then."""
+        now = time.monotonic()
+        server_time = self.clock_sync.server_time(now)
+        return now if server_time is None else server_time
+
+    def sync_clock(self):
+        # Called every frame; only sends when a ping is due
+        ping = self.clock_sync.ping()
+        if ping is not None:
+            self.send_data(ping)
+
     def send_data(self, data):
+        client_socket = self.client_socket
         try:
-            if self.client_socket and self.connected:
-                self.client_socket.send(pickle.dumps(data))
+            if client_socket and self.connected:
+                with self.send_lock:
+                    protocol.send_message(client_socket, data)
         except Exception as e:
             self.logger.info(f'Error sending data: {str(e)}')
+            if self.session is not None and not self.spectating:
+                # Wakes the receive thread, which tries to resume the session
+                try:
+                    client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
             self.server_error = True
             self.error_message = f'Cannot send data to server: {str(e)}'
             self.connected = False
 
+    def draw_connection_status(self):
+        if self.reconnecting:
+            message = 'Connection lost, reconnecting...'
+        elif self.opponent_dropped:
+            message = 'Opponent disconnected, waiting for them to return...'
+        else:
+            return
+        text = self.text.render(self.small_font, message, self.YELLOW)
+        return self.screen.blit(text, text.get_rect(center=(self.SCREEN_WIDTH / 2, 30)))
+
+    def draw_ping(self):
+        if self.clock_sync.rtt is None:
+            return
+        text = self.text.render(self.small_font, f'Ping {self.clock_sync.rtt * 1000:.0f} ms', self.WHITE)
+        return self.screen.blit(text, text.get_rect(topright=(self.SCREEN_WIDTH - 10, 10)))
+
     def draw_error_popup(self):
         overlay = pygame.Surface((self.SCREEN_WIDTH, self.SCREEN_HEIGHT))
         overlay.fill(self.BLACK)
         overlay.set_alpha(180)
-        self.screen.blit(overlay, (0, 0))
+        self.dirty.add(self.screen.blit(overlay, (0, 0)))
 
         popup_width, popup_height = 700, 300
         popup_x = (self.SCREEN_WIDTH - popup_width) // 2
@@ -201,29 +428,18 @@ class GameClient:
         pygame.draw.rect(self.screen, self.RED,
                          (popup_x, popup_y, popup_width, popup_height), 4)
 
-        title_text = self.font.render("SERVER ERROR", True, self.RED)
+        title_text = self.text.render(self.font, "SERVER ERROR", self.RED)
         title_rect = title_text.get_rect(center=(self.SCREEN_WIDTH //2, popup_y + 60))
         self.screen.blit(title_text, title_rect)
 
-        error_lines = []
-        words = self.error_message.split()
-        line = ""
-        for word in words:
-            test_line = line + " " + word if line else word
-            if self.small_font.size(test_line)[0] <= popup_width - 40:
-                line = test_line
-            else:
-                error_lines.append(line)
-                line = word
-        if line:
-            error_lines.append(line)
+        error_lines = render.wrap_text(self.small_font, self.error_message, popup_width - 40)
 
         for i, line in enumerate(error_lines):
-            msg_text = self.small_font.render(line, True, self.WHITE)
+            msg_text = self.text.render(self.small_font, line, self.WHITE)
             msg_rect = msg_text.get_rect(center=(self.SCREEN_WIDTH // 2, popup_y + 120 + i * 30))
             self.screen.blit(msg_text, msg_rect)
 
-        exit_text = self.small_font.render("Press ESC to exit", True, self.YELLOW)
+        exit_text = self.text.render(self.small_font, "Press ESC to exit", self.YELLOW)
         exit_rect = exit_text.get_rect(center=(self.SCREEN_WIDTH // 2, popup_y + popup_height - 50))
         self.screen.blit(exit_text, exit_rect)
 
@@ -294,23 +510,12 @@ class GameClient:
         selecting = True
 
         while selecting and self.connected:
-            self.screen.fill(self.BLACK)
-
-            title_text = self.font.render(f'Player {self.player_num} - Select Character', True, self.WHITE)
-            title_rect = title_text.get_rect(center=(self.SCREEN_WIDTH/2, 100))
-            self.screen.blit(title_text, title_rect)
-
-            for i, char_name in enumerate(self.available_characters):
-                color = self.GREEN if i == self.selected_character_index else self.WHITE
-                char_text = self.small_font.render(char_name, True, color)
-                char_rect = char_text.get_rect(center=(self.SCREEN_WIDTH/2, 300 + i*50))
-                self.screen.blit(char_text, char_rect)
-            instr_text = self.small_font.render('Press UP/DOWN to select, ENTER to confirm', True, self.WHITE)
-            instr_rect = instr_text.get_rect(center=(self.SCREEN_WIDTH/2, 600))
-            self.screen.blit(instr_text, instr_rect)
-
-            if self.server_error:
-                self.draw_error_popup()
+            self.sync_clock()
+            # Drawn again only when something on it changed
+            if self.dirty.begin(self.screen, self.BLACK, full=self.server_error,
+                                key=('select', self.selected_character_index, self.server_error, self.error_message)):
+                self.draw_character_select()
+                self.dirty.present()
 
             for event in pygame.event.get():
                 if event.type == QUIT:
@@ -325,32 +530,34 @@ class GameClient:
                         self.character = self.available_characters[self.selected_character_index]
                         self.send_data({'character_select': self.character})
                         selecting = False
-            pygame.display.flip()
             self.clock.tick(60)
 
+    def draw_character_select(self):
+        title_text = self.text.render(self.font, f'Player {self.player_num} - Select Character', self.WHITE)
+        title_rect = title_text.get_rect(center=(self.SCREEN_WIDTH/2, 100))
+        self.dirty.add(self.screen.blit(title_text, title_rect))
+
+        for i, char_name in enumerate(self.available_characters):
+            color = self.GREEN if i == self.selected_character_index else self.WHITE
+            char_text = self.text.render(self.small_font, char_name, color)
+            char_rect = char_text.get_rect(center=(self.SCREEN_WIDTH/2, 300 + i*50))
+            self.dirty.add(self.screen.blit(char_text, char_rect))
+        instr_text = self.text.render(self.small_font, 'Press UP/DOWN to select, ENTER to confirm', self.WHITE)
+        instr_rect = instr_text.get_rect(center=(self.SCREEN_WIDTH/2, 600))
+        self.dirty.add(self.screen.blit(instr_text, instr_rect))
+
+        if self.server_error:
+            self.draw_error_popup()
+
     def wait_for_match(self):
         waiting = True
-        while waiting and self.connected and not self.match_started:
-            self.screen.fill(self.BLACK)
-            wait_text = self.font.render('Waiting for opponent...', True, (self.WHITE))
-            wait_rect = wait_text.get_rect(center=(self.SCREEN_WIDTH/2, 300))
-            self.screen.blit(wait_text, wait_rect)
-
-            char_text = self.small_font.render(f'Your character: {self.character}', True, self.GREEN)
-            char_rect = char_text.get_rect(center=(self.SCREEN_WIDTH/2, 400))
-            self.screen.blit(char_text, char_rect)
-
-            if not self.ready:
-                ready_text = self.small_font.render('Press SPACE to ready up', True, self.WHITE)
-                ready_rect = ready_text.get_rect(center=(self.SCREEN_WIDTH/2, 500))
-                self.screen.blit(ready_text, ready_rect)
-            else:
-                ready_text = self.small_font.render('You are READY!', True, self.GREEN)
-                ready_rect = ready_text.get_rect(center=(self.SCREEN_WIDTH/2, 500))
-                self.screen.blit(ready_text, ready_rect)
-
-            if self.server_error:
-                self.draw_error_popup()
+        while waiting and (self.connected or self.reconnecting) and not self.match_started:
+            self.sync_clock()
+            key = ('wait', self.ready, self.server_error, self.error_message,
+                   self.reconnecting, self.opponent_dropped)
+            if self.dirty.begin(self.screen, self.BLACK, full=self.server_error, key=key):
+                self.draw_wait_screen()
+                self.dirty.present()
 
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
@@ -364,78 +571,67 @@ class GameClient:
                         self.ready = True
                         self.send_data({'ready': True})
 
-            pygame.display.flip()
             self.clock.tick(60)
 
-    def draw_background(self):
-        for y in range(self.SCREEN_HEIGHT):
-            color = (
-                self.DARK_BLUE[0] + (self.BLUE[0] - self.DARK_BLUE[0]) * y // self.SCREEN_HEIGHT,
-                self.DARK_BLUE[1] + (self.BLUE[1] - self.DARK_BLUE[1]) * y // self.SCREEN_HEIGHT,
-                self.DARK_BLUE[2] + (self.BLUE[2] - self.DARK_BLUE[2]) * y // self.SCREEN_HEIGHT
-            )
-            pygame.draw.line(self.screen, color, (0, y), (self.SCREEN_WIDTH, y))
+    def draw_wait_screen(self):
+        wait_text = self.text.render(self.font, 'Waiting for opponent...', self.WHITE)
+        wait_rect = wait_text.get_rect(center=(self.SCREEN_WIDTH/2, 300))
+        self.dirty.add(self.screen.blit(wait_text, wait_rect))
 
-        pygame.draw.polygon(self.screen, self.GRAY, [(0, self.SCREEN_HEIGHT), (300, 500), (500, self.SCREEN_HEIGHT)])
-        pygame.draw.polygon(self.screen, self.GRAY, [(500, self.SCREEN_HEIGHT), (700, 400), (900, self.SCREEN_HEIGHT)])
+        char_text = self.text.render(self.small_font, f'Your character: {self.character}', self.GREEN)
+        char_rect = char_text.get_rect(center=(self.SCREEN_WIDTH/2, 400))
+        self.dirty.add(self.screen.blit(char_text, char_rect))
 
-    def init_platforms(self):
-        self.platforms = []
-        for platform_data in self.game_state['platforms']:
-            platform = type('Platform', (), platform_data)
-            self.platforms.append(platform)
-
-    def draw_platforms(self):
-        for platform in self.platforms:
-            pygame.draw.rect(self.screen, self.DARK_BLUE, (platform.x, platform.y, platform.width, platform.height))
-            pygame.draw.rect(self.screen, self.WHITE, (platform.x, platform.y, platform.width, 5))
-
-    def create_character_sprite(self, character_name):
-        character_colors = {
-            'Lucario': (0, 0, 255),
-            'Mewtwo': (255, 0, 255),
-            'Zeraora': (255, 255, 0),
-            'Cinderace': (255, 0, 0)
-        }
+        if not self.ready:
+            ready_text = self.text.render(self.small_font, 'Press SPACE to ready up', self.WHITE)
+            ready_rect = ready_text.get_rect(center=(self.SCREEN_WIDTH/2, 500))
+            self.dirty.add(self.screen.blit(ready_text, ready_rect))
+        else:
+            ready_text = self.text.render(self.small_font, 'You are READY!', self.GREEN)
+            ready_rect = ready_text.get_rect(center=(self.SCREEN_WIDTH/2, 500))
+            self.dirty.add(self.screen.blit(ready_text, ready_rect))
 
-        try:
-            sprite = f"sprites/{character_name.lower()}_sprite.png"
-            img = pygame.image.load(sprite).convert_alpha()
-            return pygame.transform.scale(img, (100, 100))
+        if self.server_error:
+            self.draw_error_popup()
+        else:
+            self.dirty.add(self.draw_connection_status())
 
-        except Exception as e:
-            self.logger.info(f"Error loading sprite for {character_name}: {str(e)}")
+    def init_platforms(self, game_state):
+        # Built before it is assigned: the game loop may be reading self.platforms on the other thread
+        self.platforms = [type('Platform', (), dict(platform_data)) for platform_data in game_state['platforms']]
 
-            surface = pygame.surface.Surface((100, 100))
-            color = character_colors.get(character_name, (255, 0, 0))
-            surface.fill(color)
-            return surface
+    def create_character_sprite(self, character_name):
+        return assets.character_sprite(character_name)
 
-    def draw_character(self, player_data, sprite):
+    def draw_character(self, player_data, sprite, position=None):
+        """Draws a player from its snapshot, at position instead of the snapshot's if one is given."""
         if not player_data:
             return
+        x, y = position if position is not None else (player_data['x'], player_data['y'])
 
         # Draw the character sprite
-        self.screen.blit(sprite, (player_data['x'] - sprite.get_width() // 2,
-                                  player_data['y'] - sprite.get_height()))
+        sprite_rect = sprite.get_rect(bottomleft=(x - sprite.get_width() // 2, y))
+        self.screen.blit(sprite, sprite_rect)
 
         # Draw health bar
         bar_width = 100
         bar_height = 10
-        bar_x = player_data['x'] - bar_width // 2
-        bar_y = player_data['y'] - sprite.get_height() - 20
+        bar_x = x - bar_width // 2
+        bar_y = y - sprite.get_height() - 20
 
         pygame.draw.rect(self.screen, self.RED, (bar_x, bar_y, bar_width, bar_height))
         health_width = (player_data['health'] / 100) * bar_width
         if health_width > 0:
             pygame.draw.rect(self.screen, self.GREEN, (bar_x, bar_y, health_width, bar_height))
         pygame.draw.rect(self.screen, self.BLACK, (bar_x, bar_y, bar_width, bar_height), 1)
+        # Everything drawn, for the dirty rectangles; off screen once the player falls
+        return sprite_rect.union((bar_x, bar_y, bar_width, bar_height)).clip(self.screen.get_rect())
 
     def draw_game_over_screen(self):
         overlay = pygame.Surface((self.SCREEN_WIDTH, self.SCREEN_HEIGHT))
         overlay.fill(self.BLACK)
         overlay.set_alpha(128)
-        self.screen.blit(overlay, (0, 0))
+        self.dirty.add(self.screen.blit(overlay, (0, 0)))
 
         if self.winner:
             if self.winner == int(self.player_num):
@@ -443,36 +639,14 @@ class GameClient:
             else:
                 winner_text = "YOU LOSE!"
 
-            text = self.font.render(winner_text, True, self.GREEN)
+            text = self.text.render(self.font, winner_text, self.GREEN)
             text_rect = text.get_rect(center=(self.SCREEN_WIDTH / 2, self.SCREEN_HEIGHT / 2))
             self.screen.blit(text, text_rect)
 
-        exit_text = self.small_font.render("Press ESC to exit", True, self.WHITE)
+        exit_text = self.text.render(self.small_font, "Press ESC to exit", self.WHITE)
         exit_rect = exit_text.get_rect(center=(self.SCREEN_WIDTH / 2, self.SCREEN_HEIGHT / 2 + 60))
         self.screen.blit(exit_text, exit_rect)
 
-    def check_on_platform(self, player_x, player_y, feet_offset):
-        if len(self.platforms) == 0:
-            self.logger.info('Warning: No platform available')
-            return True, None
-
-        player_width = 50
-        player_feet_y = player_y + feet_offset
-        player_prev_feet_y = player_feet_y - (self.game_state['players'][self.player_num].get('velocity_y', 0) if self.player_num in self.game_state['players'] else 0)
-
-        for platform in self.platforms:
-            if (player_x + player_width > platform.x and
-            player_x - player_width < platform.x + platform.width):
-                if (player_prev_feet_y <= platform.y and
-                    player_feet_y >= platform.y and
-                    player_feet_y <= platform.y + 15):
-                    return True, platform.y
-
-                if (platform.y - 15 <= player_feet_y <= platform.y + 10):
-                    return True, platform.y
-
-        return False, None
-
     def check_death(self, player_y):
         if len(self.platforms) == 0:
             return False
@@ -490,8 +664,9 @@ class GameClient:
             self.opponent_sprite.fill((255, 0, 0))
 
         opponent_num = 2 if self.player_num == 1 else 1
-        if opponent_num in self.game_state['players'] and self.game_state['players'][opponent_num]['character']:
-            opponent_character = self.game_state['players'][opponent_num]['character']
+        players = self.latest_state.take()['players']
+        if opponent_num in players and players[opponent_num]['character']:
+            opponent_character = players[opponent_num]['character']
             if not self.opponent_character or self.opponent_character != opponent_character:
                 self.opponent_character = opponent_character
                 self.opponent_sprite = self.create_character_sprite(opponent_character)
@@ -500,13 +675,6 @@ class GameClient:
         last_attack_time = 0
         last_special_attack_time = 0
         special_attack_cooldown = 3000
-        is_jumping = False
-        jump_velocity = 0
-        gravity = 0.8
-        jump_strength = 18
-        player_width = 50
-        player_feet_offset = 10
-        player_data = None
 
         while running:
             for event in pygame.event.get():
@@ -520,16 +688,30 @@ class GameClient:
                         pygame.quit()
                         sys.exit()
 
-            self.screen.fill(self.BLACK)
-            self.draw_background()
-            self.draw_platforms()
-
-            if self.player_num in self.game_state['players']:
-                self.draw_character(self.game_state['players'][self.player_num], self.character_sprite)
+            self.sync_clock()
+            stage = self.layers.render_stage(self.screen.get_size(), self.platforms)
+            self.dirty.begin(self.screen, stage, full=self.server_error or self.game_over)
+
+            # The whole frame is drawn from one state, however many arrive meanwhile
+            players = self.latest_state.take()['players']
+            player_data = players.get(self.player_num)
+            self.predictor.reconcile(self.platforms)
+            if player_data is not None:
+                # The local player is drawn where we predict it, not where the last snapshot had it
+                position = None
+                if self.predictor.state is not None:
+                    position = self.predictor.state['x'], self.predictor.state['y']
+                self.dirty.add(self.draw_character(player_data, self.character_sprite, position))
 
             opponent_num = 2 if self.player_num == 1 else 1
-            if opponent_num in self.game_state['players']:
-                self.draw_character(self.game_state['players'][opponent_num], self.opponent_sprite)
+            if opponent_num in players:
+                # Drawn between the last two snapshots instead of jumping to each one as it arrives
+                position = self.opponent_buffer.sample(self.timeline())
+                self.dirty.add(self.draw_character(players[opponent_num], self.opponent_sprite, position))
+
+            if not self.server_error:
+                self.dirty.add(self.draw_connection_status())
+                self.dirty.add(self.draw_ping())
 
             if self.server_error:
                 self.draw_error_popup()
@@ -539,16 +721,9 @@ class GameClient:
                 current_time = pygame.time.get_ticks()
                 keys = pygame.key.get_pressed()
 
-                if self.player_num not in self.game_state['players']:
+                if player_data is None:
                     continue
 
-                player_data = self.game_state['players'][self.player_num]
-
-                if 'velocity_y' not in player_data:
-                    player_data['velocity_y'] = 0
-
-                action = {}
-
                 if self.player_num == 1:
                     left_key = K_q
                     right_key = K_d
@@ -562,59 +737,14 @@ class GameClient:
                     attack_key = K_k
                     special_attack_key = K_l
 
-                if keys[left_key]:
-                    if 'x' in player_data:
-                        player_data['x'] = max(50, player_data['x']-5)
-                        action['x'] = player_data['x']
-                        action['facing_right'] = False
-
-                elif keys[right_key]:
-                    if 'x' in player_data:
-                        player_data['x'] = min(950, player_data['x']+5)
-                        action['x'] = player_data['x']
-                        action['facing_right'] = True
-
-                on_platform, platform_y = self.check_on_platform(
-                    player_data.get('x', 0),
-                    player_data.get('y', 0),
-                    player_feet_offset
-                )
-
-                if keys[jump_key] and on_platform and not is_jumping:
-                    is_jumping = True
-                    player_data['velocity_y'] = -jump_strength
-                    jump_velocity = -jump_strength
-                    action['is_jumping'] = True
-                    action['velocity'] = player_data['velocity_y']
-
-                if is_jumping or not on_platform:
-                    player_data['y'] += jump_velocity
-                    jump_velocity += gravity
-                    player_data['velocity_y'] = jump_velocity
-                    action['y'] = player_data['y']
-                    action['velocity_y'] = player_data['velocity_y']
-
-                on_platform_now, landing_y = self.check_on_platform(
-                    player_data.get('x', 0),
-                    player_data.get('y', 0),
-                    player_feet_offset
-                )
-
-                if not on_platform:
-                    player_data['y'] += gravity
-                    player_data['velocity_y'] = player_data['velocity_y']
-                    action['velocity_y'] = player_data['velocity_y']
-
-                if on_platform_now and jump_velocity > 0:
-                    is_jumping = False
-                    jump_velocity = 0
-                    player_data['velocity_y'] = 0
-                    player_data['y'] = landing_y
-                    action['y'] = landing_y
-                    action['is_jumping'] = False
-                    action['velocity_y'] = 0
-
-                if self.check_death(player_data.get('y', 0)):
+                if self.predictor.state is None:
+                    self.predictor.reset(player_data)
+
+                command = {'left': keys[left_key], 'right': keys[right_key], 'jump': keys[jump_key]}
+                action = self.predictor.predict(command, self.platforms) or {}
+                predicted = self.predictor.state
+
+                if self.check_death(predicted['y']):
                     action['died'] = True
                     self.send_data({'player_died': True})
                     self.game_over = True
@@ -642,23 +772,93 @@ class GameClient:
                         action['attack_range'] = 150
                     elif self.character == 'Cinderace':
                         opponent_num = 2 if self.player_num == 1 else 1
-                        opponent_data = self.game_state['players'].get(opponent_num, {})
+                        opponent_data = players.get(opponent_num, {})
                         if opponent_data:
-                            distance = abs(player_data.get('x', 0) - opponent_data.get('x', 0))
+                            distance = abs(predicted['x'] - opponent_data.get('x', 0))
                             action['damage'] = 22 * (1 + distance / 250)
                             action['attack_range'] = 250
 
                     last_special_attack_time = current_time
 
+                if action.get('attack'):
+                    # Lets the server judge the hit against the opponent position we were shown
+                    render_time = self.opponent_buffer.render_time(self.timeline())
+                    if render_time is not None:
+                        action['view_tick'] = max(1, round(render_time * self.tick_rate))
+
                 if action and self.connected:
                     self.send_data({'player_action': action})
 
-            pygame.display.flip()
+            self.dirty.present()
             self.clock.tick(60)
 
 
+    def spectate(self, room_id, spectator_port):
+        assets.preload(self.screen)
+        try:
+            self.client_socket = socket.create_connection((self.host, spectator_port), timeout=5)
+            with self.send_lock:
+                protocol.send_message(self.client_socket, {'spectate': room_id})
+            self.decoder = protocol.FrameDecoder()
+            messages = []
+            while not messages:
+                messages = protocol.recv_messages(self.client_socket, self.decoder)
+                if messages is None:
+                    raise ConnectionError('Server closed the connection')
+            self.client_socket.settimeout(None)
+            response = messages.pop(0)
+            if response['status'] == 'spectating':
+                self.spectating = True
+                self.connected = True
+                self.tick_rate = response.get('tick_rate', tick_clock.TICK_RATE)
+                self.pending_messages = messages
+                self.logger.info(f"Spectating room {response['room_id']}")
+                receive_thread = threading.Thread(target=self.receive_data)
+                receive_thread.daemon = True
+                receive_thread.start()
+            else:
+                self.server_error = True
+                self.error_message = response.get('message', 'Cannot spectate')
+        except Exception as e:
+            self.logger.info(f'Error connecting to server: {str(e)}')
+            self.server_error = True
+            self.error_message = f'Connection error: {str(e)}'
+
+        while True:
+            for event in pygame.event.get():
+                if event.type == QUIT or (event.type == KEYDOWN and event.key == K_ESCAPE):
+                    pygame.quit()
+                    sys.exit()
+
+            game_state = self.latest_state.take()
+            if not self.platforms and game_state['platforms']:
+                # Joined mid-match: the first keyframe carries the stage
+                self.init_platforms(game_state)
+            stage = self.layers.render_stage(self.screen.get_size(), self.platforms)
+            self.dirty.begin(self.screen, stage, full=self.server_error)
+            now = time.monotonic()
+            for player_num, player in game_state['players'].items():
+                if not player.get('character'):
+                    continue
+                sprite = self.player_sprites.get(player_num)
+                if sprite is None:
+                    sprite = self.player_sprites[player_num] = self.create_character_sprite(player['character'])
+                buffer = self.player_buffers.get(player_num)
+                position = buffer.sample(now) if buffer is not None else None
+                self.dirty.add(self.draw_character(player, sprite, position))
+
+            if self.server_error:
+                self.draw_error_popup()
+            elif self.game_over and self.winner:
+                text = self.text.render(self.font, f'PLAYER {self.winner} WINS!', self.GREEN)
+                self.dirty.add(self.screen.blit(text, text.get_rect(center=(self.SCREEN_WIDTH / 2, self.SCREEN_HEIGHT / 2))))
+
+            self.dirty.present()
+            self.clock.tick(60)
+
     def run(self):
         pygame.init()
+        assets.preload(self.screen)
 
         #self.fix_login_system()
 
@@ -676,11 +876,9 @@ class GameClient:
         #login_system = LoginSystem(self.SCREEN_WIDTH, self.SCREEN_HEIGHT, self.client_socket)
 
         try:
+            # Only checks the server is up: without a hello it never seats this connection
             self.client_socket.connect((self.host, self.port))
 
-            data = self.client_socket.recv(4096)
-            pickle.loads(data)
-
         except Exception as e:
             self.logger.info(f'Error connecting to server: {str(e)}')
             self.server_error = True
@@ -716,12 +914,12 @@ class GameClient:
 
             running = True
             while running:
-                self.screen.fill(self.BLACK)
-                self.draw_error_popup()
+                if self.dirty.begin(self.screen, self.BLACK, full=True, key=('error', self.error_message)):
+                    self.draw_error_popup()
+                    self.dirty.present()
                 for event in pygame.event.get():
                     if event.type == QUIT or (event.type == KEYDOWN and event.key == K_ESCAPE):
                         running = False
-                pygame.display.flip()
                 self.clock.tick(60)
 
             pygame.quit()
@@ -729,8 +927,13 @@ class GameClient:
 
 
 if __name__ == '__main__':
-    client = GameClient(host='localhost', port=5555)
-    client.run()
+    args = parse_arguments()
+    log.setup('CLIENT', args.log_level, args.log_format)
+    client = GameClient(host='localhost', port=args.port, render_mode=args.render)
+    if args.spectate is not None:
+        client.spectate(args.spectate, args.spectator_port)
+    else:
+        client.run()
 
 
 
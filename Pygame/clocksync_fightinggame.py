@@ -0,0 +1,74 @@
+import time
+from collections import deque
+
+import tick_fightinggame as tick_clock
+
+# Pings go out quickly until this many samples are in, then one every PING_INTERVAL
+INITIAL_PINGS = 5
+INITIAL_INTERVAL = 0.2
+PING_INTERVAL = 2.0
+# Recent samples the filter picks from; at PING_INTERVAL about the last 16 seconds
+SAMPLE_WINDOW = 8
+# Share of the way the offset moves to a new best sample, so a correction never
+# makes interpolated motion jump
+SLEW = 0.25
+
+
+class ClockSync:
+    """Offset of the server's tick timeline from our monotonic clock, NTP style.
+
+    A ping carries our send time t0, the server answers with where it is on
+    its tick timeline (tick n is at n / rate seconds) and the answer arrives
+    at t3. If the way there and back take equally long, the server read its
+    clock at (t0 + t3) / 2, good to within half the round trip. A sample that
+    waited in a queue somewhere has a long round trip and a skewed offset,
+    so of the last few samples only the one with the shortest round trip is
+    trusted, as NTP's clock filter does.
+    """
+
+    def __init__(self, rate=tick_clock.TICK_RATE, clock=time.monotonic):
+        self.rate = rate
+        self.clock = clock
+        self.samples = deque(maxlen=SAMPLE_WINDOW)
+        self.received = 0
+        self.offset = None
+        # Round trip of the sample the offset comes from: the least queued path
+        self.rtt = None
+        self.next_ping = 0.0
+
+    @property
+    def synced(self):
+        return self.offset is not None
+
+    def ping(self, now=None):
+        """The ping to send now, or None if one is not due yet."""
+        now = self.clock() if now is None else now
+        if now < self.next_ping:
+            return None
+        self.next_ping = now + (INITIAL_INTERVAL if self.received < INITIAL_PINGS else PING_INTERVAL)
+        return {'clock_ping': now}
+
+    def pong(self, message, now=None):
+        now = self.clock() if now is None else now
+        sent, server_time = message['ping'], message['server_time']
+        rtt = now - sent
+        if rtt < 0:
+            return
+        self.received += 1
+        self.samples.append((rtt, server_time - (sent + now) / 2))
+        self.rtt, best_offset = min(self.samples)
+        if self.offset is None or self.received <= INITIAL_PINGS:
+            self.offset = best_offset
+        else:
+            self.offset += (best_offset - self.offset) * SLEW
+
+    def server_time(self, now=None):
+        """Where the server is on its tick timeline now, or None before the first answer."""
+        if self.offset is None:
+            return None
+        return (self.clock() if now is None else now) + self.offset
+
+    def server_tick(self, now=None):
+        """The tick the server is on now, with the fraction of it already gone."""
+        server_time = self.server_time(now)
+        return None if server_time is None else server_time * self.rate
@@ -1,4 +1,3 @@
-import pickle
 import mysql.connector
 import logging
 import os
@@ -6,6 +5,18 @@ import hashlib
 import re
 import time
 from typing import Dict, Any, Optional, Tuple
+import log_fightinggame as log
+import metrics_fightinggame as metrics
+import protocol_fightinggame as protocol
+
+game_over_seconds = metrics.histogram('fightinggame_db_call_seconds', 'Database calls made by ServerDatabaseHandler',
+                                      call='handle_game_over')
+character_selection_seconds = metrics.histogram('fightinggame_db_call_seconds',
+                                                'Database calls made by ServerDatabaseHandler',
+                                                call='save_character_selection')
+player_selection_seconds = metrics.histogram('fightinggame_db_call_seconds',
+                                             'Database calls made by ServerDatabaseHandler',
+                                             call='save_player_selection')
 
 class GameDatabase:
     def __init__(self, db_type="mysql", db_path="fightinggame_database"):
@@ -16,9 +27,7 @@ class GameDatabase:
         :param mysql_config(dict): MySQL connection parameters
         """
 
-        logging.basicConfig(level=logging.INFO,
-                            format='%(asctime)s [DATABASE]%(message)s',
-                            datefmt='%H:%M:%S')
+        log.setup('DATABASE')
         self.logger = logging.getLogger('GameDatabase')
 
         self.db_type = db_type
@@ -507,6 +516,7 @@ class ServerDatabaseHandler:
         Returns:
             bool: True if successfully recorded, False otherwise
         """
+        start = time.perf_counter()
         try:
             success = self.updater.update_from_game_state(game_state, winner)
             if success:
@@ -515,8 +525,11 @@ class ServerDatabaseHandler:
                 self.logger.error("Failed to record game result")
         except Exception as e:
             self.logger.error(f'Error handling game over: {str(e)}')
+        finally:
+            game_over_seconds.observe(time.perf_counter() - start)
 
     def save_character_selection(self, player1_character: str, player2_character: str) -> bool:
+        start = time.perf_counter()
         try:
             success = self.db.save_player_selection(player1_character, player2_character)
             if success:
@@ -527,6 +540,15 @@ class ServerDatabaseHandler:
         except Exception as e:
             self.logger.info(f'Error saving character selection: {str(e)}')
             return False
+        finally:
+            character_selection_seconds.observe(time.perf_counter() - start)
+
+    def save_player_selection(self, player1_character: str, player2_character: str) -> bool:
+        start = time.perf_counter()
+        try:
+            return self.db.save_player_selection(player1_character, player2_character)
+        finally:
+            player_selection_seconds.observe(time.perf_counter() - start)
 
     def authenticate_user(self, username:str, password:str) -> Dict[str, Any]:
         return self.login_manager.login(username, password)
@@ -557,10 +579,10 @@ def integrate_with_server(server_instance):
                     db_handler.save_character_selection(player1_char, player2_char)
 
                 for client_socket in server_instance.clients.values():
-                    client_socket.send(pickle.dumps({
+                    protocol.send_message(client_socket, {
                         "status": "match started",
                         "game state": server_instance.game_state
-                    }))
+                    })
 
             if server_instance.match_started:
                 server_instance.broadcast_game_state()
@@ -576,11 +598,11 @@ def integrate_with_server(server_instance):
                     server_instance.logger.info(f'Game over! Player {winner} wins!')
                     db_handler.handle_game_over(server_instance.game_state, winner)
                     for client_socket in server_instance.clients.values():
-                        client_socket.send(pickle.dumps({
+                        protocol.send_message(client_socket, {
                             "status": "game_over",
                             'winner': winner,
                             'game_state': server_instance.game_state
-                        }))
+                        })
                     server_instance.match_started = False
                     server_instance.game_state['ready'] = 0
 
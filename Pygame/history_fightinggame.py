@@ -0,0 +1,50 @@
+from array import array
+
+# How far back an attack may be resolved, in seconds
+MAX_REWIND = 0.2
+
+
+class PositionHistory:
+    """Ring buffer of player positions per server tick, for lag-compensated hits.
+
+    All slots are allocated up front: tick t lives in slot t % size, and a
+    lookup is one index plus a check that the slot still holds tick t.
+    """
+
+    def __init__(self, size, player_nums=(1, 2)):
+        self.size = size
+        self.ticks = {player_num: array('l', [-1] * size) for player_num in player_nums}
+        self.xs = {player_num: array('d', [0.0] * size) for player_num in player_nums}
+        self.ys = {player_num: array('d', [0.0] * size) for player_num in player_nums}
+
+    def record(self, tick, players):
+        slot = tick % self.size
+        for player_num, player in players.items():
+            ticks = self.ticks.get(player_num)
+            if ticks is None:
+                continue
+            ticks[slot] = tick
+            self.xs[player_num][slot] = player['x']
+            self.ys[player_num][slot] = player['y']
+
+    def position(self, player_num, tick):
+        slot = tick % self.size
+        if self.ticks[player_num][slot] != tick:
+            return None
+        return self.xs[player_num][slot], self.ys[player_num][slot]
+
+    def window(self, tick):
+        """The recorded positions of the ticks before `tick` still in the buffer, oldest first."""
+        entries = []
+        for past in range(tick - self.size + 1, tick):
+            players = {player_num: {'x': self.xs[player_num][past % self.size],
+                                    'y': self.ys[player_num][past % self.size]}
+                       for player_num, ticks in self.ticks.items() if ticks[past % self.size] == past}
+            if players:
+                entries.append((past, players))
+        return entries
+
+    def clear(self):
+        for ticks in self.ticks.values():
+            for slot in range(self.size):
+                ticks[slot] = -1
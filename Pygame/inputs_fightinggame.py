@@ -0,0 +1,77 @@
+import time
+
+# Messages a player connection may send per second, and the burst allowed on top. A
+# client sends at most one player_action per frame at 60 FPS plus an ack per snapshot,
+# so this is about 1.5x normal play, and the burst covers a couple of seconds of
+# inputs arriving at once after a network stall.
+MESSAGE_RATE = 120.0
+MESSAGE_BURST = 240
+
+# Attack flags of a player_action are OR-ed when the inputs of one tick are merged,
+# so an attack pressed between two ticks is never lost. The held ones are part of
+# the player's state and are released again on the following tick.
+HELD_FLAGS = ('is_attacking', 'is_special_attacking')
+ATTACK_FLAGS = ('attack',) + HELD_FLAGS
+# Key of a merged action listing the held flags to release on the next tick
+RELEASE = 'release'
+
+
+class TokenBucket:
+    """Message budget of one connection.
+
+    Only ever used by the thread or task reading that connection, so unlike
+    log.RateLimit it takes no lock.
+    """
+
+    def __init__(self, rate=MESSAGE_RATE, burst=MESSAGE_BURST, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def take(self, count=1):
+        """False once the connection has sent more than its budget."""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - count
+        self.updated = now
+        return self.tokens >= 0
+
+
+def coalesce(pending, action):
+    """Folds a new player_action into the one waiting for the next tick.
+
+    Later values win, so movement is the last one sent, except that attack
+    flags are OR-ed. A held flag that was pressed and released in between is
+    shown for one tick and listed under RELEASE to be cleared on the next.
+    Merges into pending in place, so the room calls it with its input lock
+    held.
+    """
+    if pending is None:
+        pending = dict(action)
+        # Only ever set here; a client sending it gets nothing released
+        pending.pop(RELEASE, None)
+        return pending
+    release = set(pending.get(RELEASE, ()))
+    for flag in HELD_FLAGS:
+        if flag in action:
+            if action[flag]:
+                release.discard(flag)
+            elif pending.get(flag):
+                release.add(flag)
+    attack = pending.get('attack') and not action.get('attack')
+    pending.update(action)
+    if attack:
+        pending['attack'] = True
+    for flag in release:
+        pending[flag] = True
+    pending[RELEASE] = release
+    return pending
+
+
+def released(action):
+    """What a merged action leaves for the next tick: its released held flags, or None."""
+    release = action.pop(RELEASE, None)
+    if not release:
+        return None
+    return {flag: False for flag in HELD_FLAGS if flag in release}
@@ -0,0 +1,90 @@
+from collections import deque
+
+import tick_fightinggame as tick_clock
+
+# Snapshots kept per entity; a second of history at 20 Hz
+BUFFER_SIZE = 20
+# Bounds of the render delay on top of the snapshot interval, in seconds
+MIN_DELAY = 0.0
+MAX_DELAY = 0.25
+# Past the newest snapshot, keep moving for at most this long, then hold
+MAX_EXTRAPOLATION = 0.1
+
+
+class InterpolationBuffer:
+    """Timestamped positions of one remote entity, rendered slightly in the past.
+
+    Snapshots are stamped with the server tick they were taken on, so their
+    spacing is exact no matter how the network delivered them. The buffer
+    tracks how late snapshots arrive (mean and deviation, like a TCP RTT
+    estimator) and renders at server time now - latency - delay, where the
+    delay is one snapshot interval plus enough margin to cover the jitter.
+    """
+
+    def __init__(self, size=BUFFER_SIZE, min_delay=MIN_DELAY, max_delay=MAX_DELAY,
+                 max_extrapolation=MAX_EXTRAPOLATION):
+        self.snapshots = deque(maxlen=size)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_extrapolation = max_extrapolation
+        self.latency = None
+        self.deviation = 0.0
+        self.interval = 1.0 / tick_clock.TICK_RATE
+
+    def clear(self):
+        self.snapshots.clear()
+        self.latency = None
+        self.deviation = 0.0
+
+    def push(self, server_time, local_time, x, y):
+        if self.snapshots:
+            last_time = self.snapshots[-1][0]
+            if server_time <= last_time:
+                return
+            self.interval += (server_time - last_time - self.interval) * 0.125
+        self.snapshots.append((server_time, x, y))
+
+        lateness = local_time - server_time
+        if self.latency is None:
+            self.latency = lateness
+        else:
+            error = lateness - self.latency
+            self.latency += error * 0.125
+            self.deviation += (abs(error) - self.deviation) * 0.25
+
+    def delay(self):
+        return self.interval + min(self.max_delay, max(self.min_delay, 2 * self.deviation))
+
+    def render_time(self, local_time):
+        """Server time being shown at local_time, or None before the first snapshot."""
+        if self.latency is None:
+            return None
+        return local_time - self.latency - self.delay()
+
+    def sample(self, local_time):
+        # The receive thread may push while the game loop samples; copying is atomic
+        snapshots = tuple(self.snapshots)
+        if not snapshots:
+            return None
+        render_time = self.render_time(local_time)
+
+        newest_time, newest_x, newest_y = snapshots[-1]
+        if render_time >= newest_time:
+            if len(snapshots) < 2:
+                return newest_x, newest_y
+            previous_time, previous_x, previous_y = snapshots[-2]
+            ahead = min(render_time - newest_time, self.max_extrapolation)
+            fraction = ahead / (newest_time - previous_time)
+            return (newest_x + (newest_x - previous_x) * fraction,
+                    newest_y + (newest_y - previous_y) * fraction)
+
+        older = snapshots[0]
+        if render_time <= older[0]:
+            return older[1], older[2]
+        for newer in snapshots:
+            if newer[0] >= render_time:
+                fraction = (render_time - older[0]) / (newer[0] - older[0])
+                return (older[1] + (newer[1] - older[1]) * fraction,
+                        older[2] + (newer[2] - older[2]) * fraction)
+            older = newer
+        return newest_x, newest_y
@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import random
+import sys
+import threading
+import time
+
+import prediction_fightinggame as prediction
+import protocol_fightinggame as protocol
+import session_fightinggame as session
+import snapshot_fightinggame as snapshot
+import tick_fightinggame as tick_clock
+
+INPUT_RATE = 60
+CHARACTERS = ('Lucario', 'Mewtwo', 'Zeraora', 'Cinderace')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Pokemon Fighting Game Load Test')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='asyncio',
+                        help='Server mode to load')
+    parser.add_argument('--port', '-p', type=int, default=5620,
+                        help='Port for the server under test')
+    parser.add_argument('--ramp', default='10,50,100',
+                        help='Comma separated bot counts, one measurement phase each')
+    parser.add_argument('--duration', '-d', type=float, default=10.0,
+                        help='Seconds to measure each phase')
+    parser.add_argument('--bot-processes', type=int, default=1,
+                        help='Processes the bots are spread over')
+    parser.add_argument('--tick-rate', type=int, default=tick_clock.TICK_RATE,
+                        help='Server tick rate')
+    parser.add_argument('--max-p99', type=float, default=None,
+                        help='Fail if broadcast latency p99 exceeds this many ms')
+    parser.add_argument('--max-tick', type=float, default=None,
+                        help='Fail if mean server tick time exceeds this many ms')
+    parser.add_argument('--max-dropped', type=int, default=0,
+                        help='Fail if more connections than this drop in any phase')
+    parser.add_argument('--replay-dir', default='',
+                        help='Record every match here, to include replay writing in the measurement')
+    return parser.parse_args()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class BotStats:
+    def __init__(self):
+        self.connected = 0
+        self.matches = 0
+        self.dropped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latencies = []
+
+    def merge(self, other):
+        self.connected += other.connected
+        self.matches += other.matches
+        self.dropped += other.dropped
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.latencies.extend(other.latencies)
+
+
+class Bot:
+    """One headless player speaking the same protocol as GameClient."""
+
+    def __init__(self, bot_id, host, port, stats, origin, interval):
+        self.bot_id = bot_id
+        self.host = host
+        self.port = port
+        self.stats = stats
+        self.origin = origin
+        self.interval = interval
+        self.rng = random.Random(bot_id)
+        self.writer = None
+        self.player_num = None
+        self.platforms = []
+        self.snapshots = snapshot.SnapshotReceiver()
+        self.predictor = prediction.Predictor()
+        self.match_started = False
+        self.command = {'left': False, 'right': False, 'jump': False}
+
+    def send(self, message):
+        data = protocol.encode_message(message)
+        self.stats.bytes_out += len(data)
+        self.writer.write(data)
+
+    async def run(self, stop_at):
+        reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        # Spread over a few skill buckets, so a full server exercises the matchmaking queue
+        self.send(dict(session.JOIN, skill=self.rng.randrange(800, 1600)))
+        decoder = protocol.FrameDecoder()
+        input_task = None
+        dropped = True
+        try:
+            while time.monotonic() < stop_at:
+                try:
+                    data = await asyncio.wait_for(reader.read(65536), stop_at - time.monotonic())
+                except asyncio.TimeoutError:
+                    dropped = False
+                    break
+                if not data:
+                    break
+                arrived = time.monotonic()
+                self.stats.bytes_in += len(data)
+                for message in decoder.feed(data):
+                    self.handle_message(message, arrived)
+                if self.match_started and input_task is None:
+                    input_task = asyncio.ensure_future(self.send_inputs(stop_at))
+            else:
+                dropped = False
+        except (ConnectionError, OSError, protocol.ProtocolError):
+            pass
+        finally:
+            if input_task is not None:
+                input_task.cancel()
+            self.stats.dropped += dropped
+            self.writer.close()
+
+    def handle_message(self, message, arrived):
+        status = message.get('status')
+        if status == 'connected':
+            self.player_num = message['player_num']
+            self.stats.connected += 1
+            self.send({f'player{self.player_num}_character': self.rng.choice(CHARACTERS)})
+            self.send({'ready': True})
+        elif status == 'match_start':
+            game_state = message['game_state']
+            self.platforms = [type('Platform', (), platform) for platform in game_state['platforms']]
+            self.predictor.reset(game_state['players'][self.player_num])
+            self.match_started = True
+            self.stats.matches += 1
+        elif status in ('game_state_update', 'game_state_delta') and 'seq' in message:
+            # Before the match, snapshots also go out between ticks (character selection)
+            if self.match_started:
+                self.stats.latencies.append(arrived - (self.origin + message['tick'] * self.interval))
+            game_state = self.snapshots.apply(message)
+            if game_state is None:
+                if not self.snapshots.keyframe_requested:
+                    self.snapshots.keyframe_requested = True
+                    self.send({'keyframe_request': True})
+                return
+            self.send({'snapshot_ack': message['seq']})
+            if self.player_num in game_state['players']:
+                self.predictor.server_state(game_state['players'][self.player_num])
+        elif status == 'game_over':
+            self.send({'ready': True})
+        elif status == 'heartbeat':
+            self.send(protocol.HEARTBEAT)
+
+    async def send_inputs(self, stop_at):
+        scheduler = tick_clock.TickScheduler(INPUT_RATE)
+        while time.monotonic() < stop_at:
+            await asyncio.sleep(scheduler.delay())
+            scheduler.run_due(self.send_input)
+
+    def send_input(self, frame):
+        # Walk in bursts, sometimes jump, rarely attack
+        if frame % 30 == 0:
+            direction = self.rng.random()
+            self.command = {'left': direction < 0.4, 'right': direction > 0.6, 'jump': False}
+        self.command['jump'] = self.rng.random() < 0.02
+        self.predictor.reconcile(self.platforms)
+        action = self.predictor.predict(self.command, self.platforms) or {}
+        if self.rng.random() < 0.01:
+            action.update({'attack': True, 'is_attacking': True, 'damage': 1, 'attack_range': 150})
+        if action:
+            self.send({'player_action': action})
+
+
+def run_bots(bot_ids, host, port, origin, interval, duration, results):
+    async def main():
+        stats = BotStats()
+        stop_at = time.monotonic() + duration
+        bots = [Bot(bot_id, host, port, stats, origin, interval) for bot_id in bot_ids]
+        outcomes = await asyncio.gather(*(bot.run(stop_at) for bot in bots), return_exceptions=True)
+        stats.dropped += sum(isinstance(outcome, Exception) for outcome in outcomes)
+        return stats
+
+    results.put(asyncio.run(main()))
+
+
+def run_server(mode, port, max_rooms, tick_rate, replay_dir, stats_conn):
+    logging.disable(logging.INFO)
+    if mode == 'asyncio':
+        from async_server_fightinggame import AsyncGameServer as server_class
+    else:
+        from server_fightinggame import GameServer as server_class
+    server = server_class(host='127.0.0.1', port=port, max_rooms=max_rooms, tick_rate=tick_rate,
+                          replay_dir=replay_dir)
+
+    def answer_stats():
+        while True:
+            try:
+                stats_conn.recv()
+            except EOFError:
+                return
+            stats_conn.send(dict(server.scheduler.stats(), outbound=server.outbound_stats()))
+
+    threading.Thread(target=answer_stats, daemon=True).start()
+    server.start()
+
+
+def run_phase(args, bots):
+    stats_conn, server_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=run_server, daemon=True,
+                                     args=(args.mode, args.port, bots // 2 + 1, args.tick_rate,
+                                           args.replay_dir, server_conn))
+    server.start()
+    time.sleep(1)
+    stats_conn.send('stats')
+    server_stats = stats_conn.recv()
+
+    results = multiprocessing.Queue()
+    processes = []
+    for index in range(args.bot_processes):
+        bot_ids = range(index, bots, args.bot_processes)
+        process = multiprocessing.Process(target=run_bots, daemon=True,
+                                          args=(bot_ids, '127.0.0.1', args.port, server_stats['origin'],
+                                                1.0 / args.tick_rate, args.duration, results))
+        process.start()
+        processes.append(process)
+
+    # Queues are per connection, so read them while the bots are still connected
+    time.sleep(max(0.0, args.duration - 0.5))
+    stats_conn.send('stats')
+    outbound_stats = stats_conn.recv()['outbound']
+
+    stats = BotStats()
+    for _ in processes:
+        stats.merge(results.get())
+    for process in processes:
+        process.join()
+
+    stats_conn.send('stats')
+    server_stats = stats_conn.recv()
+    server.terminate()
+    server.join()
+    server_stats['outbound'] = outbound_stats
+    return stats, server_stats
+
+
+def main():
+    args = parse_arguments()
+    failed = False
+    print(f'mode={args.mode} tick rate={args.tick_rate} Hz, {args.duration:.0f}s per phase')
+    print(f"{'bots':>6}{'matches':>9}{'dropped':>9}{'tick ms':>9}{'max ms':>8}{'skipped':>9}"
+          f"{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}{'in KB/s':>9}{'out KB/s':>10}"
+          f"{'queue KB':>10}{'send ms':>9}{'coalesced':>11}")
+    for bots in (int(count) for count in args.ramp.split(',')):
+        stats, server_stats = run_phase(args, bots)
+        tick_ms = server_stats['tick_duration'] * 1000
+        outbound_stats = server_stats['outbound']
+        p50, p95, p99 = (percentile(stats.latencies, fraction) * 1000 for fraction in (0.5, 0.95, 0.99))
+        print(f"{bots:>6}{stats.matches:>9}{stats.dropped:>9}{tick_ms:>9.2f}"
+              f"{server_stats['max_tick_duration'] * 1000:>8.2f}{server_stats['skipped']:>9}"
+              f"{p50:>8.1f}{p95:>8.1f}{p99:>8.1f}"
+              f"{stats.bytes_in / args.duration / 1024:>9.1f}{stats.bytes_out / args.duration / 1024:>10.1f}"
+              f"{outbound_stats['max_backlog_bytes'] / 1024:>10.1f}{outbound_stats['max_latency'] * 1000:>9.1f}"
+              f"{outbound_stats['coalesced']:>11}")
+
+        if args.max_p99 is not None and p99 > args.max_p99:
+            print(f'  FAIL: p99 {p99:.1f} ms > {args.max_p99} ms')
+            failed = True
+        if args.max_tick is not None and tick_ms > args.max_tick:
+            print(f'  FAIL: tick {tick_ms:.2f} ms > {args.max_tick} ms')
+            failed = True
+        if stats.dropped > args.max_dropped:
+            print(f'  FAIL: {stats.dropped} dropped connections')
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
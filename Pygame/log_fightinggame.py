@@ -0,0 +1,157 @@
+import argparse
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+# Logger for records written once per client message; they go through
+# message_limit so a busy server logs a sample instead of every input
+MESSAGES = 'messages'
+# Per-message records let through per second, and the burst allowed on top
+MESSAGE_RATE = 5.0
+MESSAGE_BURST = 20
+
+# The writer thread, once setup() has run in this process
+listener = None
+# What setup() was called with, for passing on to worker processes
+options = None
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread untouched.
+
+    The stock handler formats the message on the logging thread so the
+    record can be pickled; this queue never leaves the process, so the
+    message and its arguments are only turned into text on the writer
+    thread. Arguments must not be changed after they are logged.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, process, logger, level, message and any extra fields."""
+
+    def __init__(self, tag):
+        super().__init__()
+        self.tag = tag
+
+    def format(self, record):
+        entry = {
+            'time': f"{self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}.{int(record.msecs):03d}",
+            'process': self.tag,
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The original console format, with extra fields appended as key=value."""
+
+    def __init__(self, tag):
+        super().__init__(f'%(asctime)s [{tag}] %(message)s', datefmt='%H:%M:%S')
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return text
+
+
+class RateLimit:
+    """Token bucket for log records that would otherwise be written per message.
+
+    Lets `rate` records a second through, with bursts of up to `burst`.
+    Checked before the record is even built, so a record that is dropped
+    costs one call; the rest are only counted.
+    """
+
+    def __init__(self, rate=MESSAGE_RATE, burst=MESSAGE_BURST, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """None if this record should be dropped, else how many were dropped since the last one."""
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return None
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+            return suppressed
+
+
+# Shared by every room in the process
+message_limit = RateLimit()
+
+
+def parse_levels(text):
+    """'INFO' or 'GameServer=DEBUG,messages=WARNING' -> {logger name: level}; '' is the root logger."""
+    levels = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        name, _, level = item.rpartition('=')
+        level = level.upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise argparse.ArgumentTypeError(f'unknown log level {level!r}')
+        levels[name] = level
+    return levels
+
+
+def add_arguments(parser):
+    parser.add_argument('--log-level', type=parse_levels, default={}, metavar='[LOGGER=]LEVEL,...',
+                        help=f'Level overall or per logger, e.g. WARNING,GameServer=INFO,{MESSAGES}=DEBUG')
+    parser.add_argument('--log-format', choices=['json', 'text'], default='json',
+                        help='JSON lines or the plain console format')
+
+
+def setup(tag, levels=None, log_format='json', stream=None):
+    """Sends every record in this process through a queue to one writer thread.
+
+    Like logging.basicConfig, only the first call in a process does anything,
+    so the CLI entry point can configure logging before the classes that
+    also call this on construction.
+    """
+    global listener, options
+    root = logging.getLogger()
+    if listener is not None or root.handlers:
+        return
+    options = (levels, log_format)
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter(tag) if log_format == 'json' else TextFormatter(tag))
+    records = queue.SimpleQueue()
+    root.addHandler(QueueHandler(records))
+    root.setLevel(logging.INFO)
+    for name, level in (levels or {}).items():
+        logging.getLogger(name or None).setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    """Writes out whatever is still queued and ends the writer thread."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
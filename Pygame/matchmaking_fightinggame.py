@@ -0,0 +1,125 @@
+import time
+from collections import OrderedDict
+
+# Rating points per skill bucket; players who send no rating are matched at the default
+SKILL_BUCKET = 100
+MAX_SKILL = 3000
+DEFAULT_SKILL = 1000
+# Every this many seconds of waiting a player accepts opponents one bucket further away,
+# and after the longest wait anyone at all
+WIDEN_INTERVAL = 5.0
+ANY_OPPONENT_AFTER = 30.0
+# Players waiting for a room before new connections are turned away
+MAX_QUEUED = 50000
+# Seconds between matching passes, and between queue position updates to waiting players
+MATCH_INTERVAL = 0.1
+POSITION_INTERVAL = 2.0
+
+
+class Ticket:
+    __slots__ = ('seq', 'player', 'bucket', 'queued_at', 'position')
+
+    def __init__(self, seq, player, bucket, queued_at):
+        self.seq = seq
+        self.player = player
+        self.bucket = bucket
+        self.queued_at = queued_at
+        self.position = 0
+
+
+class MatchQueue:
+    """Players waiting for a room, indexed by skill bucket and by arrival.
+
+    Each bucket is a FIFO, so its head is the longest-waiting player of that
+    skill. Pairing only looks at bucket heads and at the buckets within the
+    head's tolerance, so its cost depends on the number of buckets and never
+    on how many players are waiting.
+    """
+
+    def __init__(self, bucket_width=SKILL_BUCKET, max_skill=MAX_SKILL, widen_interval=WIDEN_INTERVAL,
+                 any_opponent_after=ANY_OPPONENT_AFTER, clock=time.monotonic):
+        self.bucket_width = bucket_width
+        self.widen_interval = widen_interval
+        self.any_opponent_after = any_opponent_after
+        self.clock = clock
+        self.buckets = [OrderedDict() for _ in range(max_skill // bucket_width + 1)]
+        # Every ticket in arrival order, for positions and the longest wait overall
+        self.order = OrderedDict()
+        self.next_seq = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def bucket_of(self, skill):
+        # The rating comes from the client's hello, so anything unusable gets the default
+        try:
+            skill = int(skill)
+        except (TypeError, ValueError, OverflowError):
+            skill = DEFAULT_SKILL
+        return min(max(skill // self.bucket_width, 0), len(self.buckets) - 1)
+
+    def push(self, player, skill=None):
+        self.next_seq += 1
+        ticket = Ticket(self.next_seq, player, self.bucket_of(skill), self.clock())
+        self.buckets[ticket.bucket][ticket.seq] = ticket
+        self.order[ticket.seq] = ticket
+        ticket.position = len(self.order)
+        return ticket
+
+    def remove(self, ticket):
+        if self.order.pop(ticket.seq, None) is None:
+            return False
+        del self.buckets[ticket.bucket][ticket.seq]
+        return True
+
+    def tolerance(self, ticket, now):
+        """How many buckets away this player will accept an opponent from."""
+        waited = now - ticket.queued_at
+        if waited >= self.any_opponent_after:
+            return len(self.buckets)
+        return int(waited // self.widen_interval)
+
+    def pop_oldest(self):
+        _, ticket = self.order.popitem(last=False)
+        del self.buckets[ticket.bucket][ticket.seq]
+        return ticket
+
+    def pop_pair(self):
+        """The longest-waiting player who has an opponent within tolerance, and that opponent; or None."""
+        now = self.clock()
+        heads = sorted((next(iter(bucket.values())) for bucket in self.buckets if bucket), key=lambda head: head.seq)
+        for head in heads:
+            opponent = self.find_opponent(head, self.tolerance(head, now))
+            if opponent is not None:
+                self.remove(head)
+                self.remove(opponent)
+                return head, opponent
+        return None
+
+    def find_opponent(self, head, tolerance):
+        # The closest bucket wins; between two equally close ones, the longer wait
+        for distance in range(min(tolerance, len(self.buckets)) + 1):
+            candidates = []
+            for index in {head.bucket - distance, head.bucket + distance}:
+                if 0 <= index < len(self.buckets):
+                    candidate = self.first_other(self.buckets[index], head)
+                    if candidate is not None:
+                        candidates.append(candidate)
+            if candidates:
+                return min(candidates, key=lambda candidate: candidate.seq)
+        return None
+
+    @staticmethod
+    def first_other(bucket, head):
+        # At most the head itself is skipped, so this looks at two entries
+        for ticket in bucket.values():
+            if ticket is not head:
+                return ticket
+        return None
+
+    def changed_positions(self):
+        """Tickets whose place in the queue moved since they were last told; position is updated."""
+        for position, ticket in enumerate(self.order.values(), 1):
+            if ticket.position != position:
+                ticket.position = position
+                yield ticket
@@ -0,0 +1,183 @@
+import bisect
+import http.server
+import threading
+
+# Upper bounds of the histogram buckets, in seconds and in bytes
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536)
+# Seconds between metric dumps to the log
+DUMP_INTERVAL = 60.0
+# Quantiles reported in the log dump
+QUANTILES = (0.5, 0.99)
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = label_text(labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name + self.labels, self.value
+
+    def summary(self):
+        return self.value
+
+
+class Gauge:
+    """A value read when the metrics are collected, so keeping it current costs nothing."""
+
+    def __init__(self, name, help_text, function, labels=None, kind='gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        self.labels = label_text(labels)
+        self.kind = kind
+
+    def samples(self):
+        yield self.name + self.labels, self.function()
+
+    def summary(self):
+        return self.function()
+
+
+class Histogram:
+    """Fixed buckets allocated up front; observe() only bumps numbers that already exist.
+
+    There is no lock: a rare lost increment when two threads observe at
+    once is cheaper than taking a lock on every event.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, labels=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = label_text(labels)
+        self.bounds = tuple(buckets)
+        # One count per bucket, plus the +Inf bucket
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        label_prefix = self.labels[:-1] + ',' if labels else '{'
+        self.bucket_names = [f'{name}_bucket{label_prefix}le="{bound}"}}' for bound in self.bounds]
+        self.bucket_names.append(f'{name}_bucket{label_prefix}le="+Inf"}}')
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket the quantile falls in; None before any observation."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else float('inf')
+        return float('inf')
+
+    def samples(self):
+        seen = 0
+        for bucket_name, count in zip(self.bucket_names, list(self.counts)):
+            seen += count
+            yield bucket_name, seen
+        yield self.name + '_sum' + self.labels, self.sum
+        yield self.name + '_count' + self.labels, self.count
+
+    def summary(self):
+        summary = {'count': self.count, 'mean': self.sum / self.count if self.count else None}
+        for fraction in QUANTILES:
+            summary[f'p{round(fraction * 100)}'] = self.quantile(fraction)
+        return summary
+
+
+class Registry:
+    """Every metric of the process, in the order they were created."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        # A second server in the same process (benchmarks) takes over the name
+        with self.lock:
+            self.metrics[metric.name + metric.labels] = metric
+        return metric
+
+    def render(self):
+        """The Prometheus text exposition format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        described = set()
+        for metric in metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f'# HELP {metric.name} {metric.help_text}')
+                lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for sample_name, value in metric.samples():
+                lines.append(f'{sample_name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """A compact view of every metric for the periodic log dump."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name + metric.labels: metric.summary() for metric in metrics}
+
+
+registry = Registry()
+
+
+def counter(name, help_text, **labels):
+    return registry.register(Counter(name, help_text, labels))
+
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS, **labels):
+    return registry.register(Histogram(name, help_text, buckets, labels))
+
+
+def gauge(name, help_text, function, kind='gauge', **labels):
+    return registry.register(Gauge(name, help_text, function, labels, kind))
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the server log
+        pass
+
+
+def serve(port, host='127.0.0.1'):
+    """Serves /metrics on its own thread. Local only by default: the endpoint has no authentication."""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,247 @@
+import contextlib
+import socket
+import threading
+import time
+from collections import deque
+
+import protocol_fightinggame as protocol
+
+# Bytes waiting for one client. Above the high watermark a new snapshot
+# replaces the ones still queued instead of joining them, until the backlog
+# is back under the low watermark; past the limit the client is cut off.
+HIGH_WATERMARK = 64 * 1024
+LOW_WATERMARK = 16 * 1024
+MAX_QUEUED_BYTES = 1024 * 1024
+# Buffers handed to one sendmsg() call (the usual IOV_MAX)
+MAX_IOV = 1024
+
+# Only snapshots can be thrown away: each one holds the whole state the
+# client is missing, so the newest makes the older ones redundant
+DROPPABLE = frozenset((protocol.MSG_STATE_KEYFRAME, protocol.MSG_STATE_DELTA))
+
+
+# Queues filled inside held_wakeups() on this thread, waiting to wake their writers
+held = threading.local()
+
+
+@contextlib.contextmanager
+def held_wakeups():
+    """Wakes the writers of every queue filled in the block once, at the end.
+
+    Waking a writer thread mid-tick makes it compete with the tick for the
+    GIL; holding the wakeups lets the tick finish first.
+    """
+    held.queues = {}
+    try:
+        yield
+    finally:
+        queues, held.queues = held.queues, None
+        for queue in queues.values():
+            queue.wakeup()
+
+
+class OutboundQueue:
+    """Frames on their way to one client, drained by that client's own writer.
+
+    Putting a frame never blocks. The writer takes everything queued in one
+    go and writes it as a single vectored send; what it has taken but not
+    yet written still counts towards the backlog.
+    """
+
+    def __init__(self, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK,
+                 max_bytes=MAX_QUEUED_BYTES, clock=time.monotonic):
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.frames = deque()
+        self.queued_bytes = 0
+        self.in_flight = 0
+        self.congested = False
+        self.closed = False
+        self.overflowed = False
+        self.wakeup = lambda: None
+        # When anything last went out; heartbeats are skipped while this is recent
+        self.last_put = clock()
+
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.coalesced = 0
+        self.max_backlog = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def backlog(self):
+        return self.queued_bytes + self.in_flight
+
+    def put(self, frame):
+        droppable = len(frame) > 1 and frame[1] in DROPPABLE
+        with self.lock:
+            if self.closed:
+                return
+            if droppable and (self.congested or self.backlog() >= self.high_watermark):
+                self.congested = True
+                self.drop_snapshots()
+            self.last_put = self.clock()
+            self.frames.append((frame, self.last_put, droppable))
+            self.queued_bytes += len(frame)
+            backlog = self.backlog()
+            self.max_backlog = max(self.max_backlog, backlog)
+            if backlog > self.max_bytes:
+                # Not even control messages are getting through; the client is gone
+                self.closed = True
+                self.overflowed = True
+        queues = getattr(held, 'queues', None)
+        if queues is None or self.overflowed:
+            self.wakeup()
+        else:
+            queues[id(self)] = self
+
+    def drop_snapshots(self):
+        kept = deque(entry for entry in self.frames if not entry[2])
+        dropped = len(self.frames) - len(kept)
+        if dropped:
+            self.coalesced += dropped
+            self.queued_bytes = sum(len(entry[0]) for entry in kept)
+            self.frames = kept
+
+    def take(self):
+        with self.lock:
+            batch = list(self.frames)
+            self.frames.clear()
+            self.in_flight += self.queued_bytes
+            self.queued_bytes = 0
+            return batch
+
+    def done(self, batch):
+        now = self.clock()
+        with self.lock:
+            for frame, queued_at, _ in batch:
+                self.in_flight -= len(frame)
+                self.sent_bytes += len(frame)
+                latency = now - queued_at
+                self.latency += (latency - self.latency) * 0.125
+                self.max_latency = max(self.max_latency, latency)
+            self.sent_frames += len(batch)
+            if self.congested and self.backlog() <= self.low_watermark:
+                self.congested = False
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.wakeup()
+
+    def drained(self):
+        return not self.frames
+
+    def stats(self):
+        return {
+            'queued_frames': len(self.frames),
+            'backlog_bytes': self.backlog(),
+            'max_backlog_bytes': self.max_backlog,
+            'sent_frames': self.sent_frames,
+            'sent_bytes': self.sent_bytes,
+            'coalesced': self.coalesced,
+            'latency': self.latency,
+            'max_latency': self.max_latency
+        }
+
+
+def summarize(queues):
+    """Totals and worst cases over many clients' queues."""
+    summary = {'clients': 0, 'backlog_bytes': 0, 'max_backlog_bytes': 0, 'coalesced': 0,
+               'latency': 0.0, 'max_latency': 0.0}
+    for queue in queues:
+        stats = queue.stats()
+        summary['clients'] += 1
+        summary['backlog_bytes'] += stats['backlog_bytes']
+        summary['max_backlog_bytes'] = max(summary['max_backlog_bytes'], stats['max_backlog_bytes'])
+        summary['coalesced'] += stats['coalesced']
+        summary['latency'] += stats['latency']
+        summary['max_latency'] = max(summary['max_latency'], stats['max_latency'])
+    if summary['clients']:
+        summary['latency'] /= summary['clients']
+    return summary
+
+
+def describe(stats):
+    return (f"{stats['sent_frames']} frames / {stats['sent_bytes'] / 1024:.1f} KiB sent, "
+            f"max backlog {stats['max_backlog_bytes'] / 1024:.1f} KiB, {stats['coalesced']} snapshots coalesced, "
+            f"send latency {stats['latency'] * 1000:.1f} ms avg / {stats['max_latency'] * 1000:.1f} ms max")
+
+
+def send_vectored(sock, buffers):
+    if not hasattr(sock, 'sendmsg'):
+        # Windows sockets have no sendmsg
+        sock.sendall(b''.join(buffers))
+        return
+    buffers = deque(memoryview(buffer) for buffer in buffers)
+    while buffers:
+        sent = sock.sendmsg(list(buffers)[:MAX_IOV])
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.popleft())
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+class QueuedSocket:
+    """A client socket for the threaded server: sendall() queues, a writer thread sends.
+
+    Reads go straight to the socket. close() lets the writer flush what is
+    queued first, unless it is stuck on a client that stopped reading.
+    """
+
+    def __init__(self, sock, queue=None):
+        self.socket = sock
+        self.queue = queue or OutboundQueue()
+        self.ready = threading.Event()
+        self.queue.wakeup = self.ready.set
+        self.writer = threading.Thread(target=self.write_frames)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def recv(self, bufsize):
+        return self.socket.recv(bufsize)
+
+    def sendall(self, data):
+        self.queue.put(data)
+        if self.queue.overflowed:
+            self.shutdown()
+
+    def close(self):
+        self.queue.close()
+        if self.queue.in_flight:
+            self.shutdown()
+
+    def shutdown(self):
+        # Unblocks both the writer and the thread reading this client
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def write_frames(self):
+        try:
+            while True:
+                self.ready.wait()
+                self.ready.clear()
+                batch = self.queue.take()
+                if batch:
+                    send_vectored(self.socket, [frame for frame, _, _ in batch])
+                    self.queue.done(batch)
+                if self.queue.closed and self.queue.drained():
+                    break
+        except OSError:
+            self.queue.close()
+        finally:
+            self.shutdown()
+            self.socket.close()
+
+    def __repr__(self):
+        try:
+            return f'<QueuedSocket {self.socket.getpeername()}>'
+        except OSError:
+            return '<QueuedSocket closed>'
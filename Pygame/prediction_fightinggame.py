@@ -0,0 +1,155 @@
+from collections import deque
+
+MOVE_SPEED = 5
+GRAVITY = 0.8
+JUMP_STRENGTH = 18
+PLAYER_WIDTH = 50
+FEET_OFFSET = 10
+MIN_X = 50
+MAX_X = 950
+# Server positions within this distance of the prediction count as a match
+TOLERANCE = 0.5
+# Two seconds of 60 FPS input; older unacknowledged inputs are dropped
+MAX_PENDING = 120
+
+
+def check_on_platform(platforms, x, y, velocity_y):
+    if len(platforms) == 0:
+        return True, None
+
+    feet_y = y + FEET_OFFSET
+    prev_feet_y = feet_y - velocity_y
+
+    for platform in platforms:
+        if x + PLAYER_WIDTH > platform.x and x - PLAYER_WIDTH < platform.x + platform.width:
+            if prev_feet_y <= platform.y and platform.y <= feet_y <= platform.y + 15:
+                return True, platform.y
+
+            if platform.y - 15 <= feet_y <= platform.y + 10:
+                return True, platform.y
+
+    return False, None
+
+
+def step(state, command, platforms):
+    """Advances one frame of local movement and jump physics.
+
+    state holds x, y, velocity_y, is_jumping and facing_right; command holds
+    the left/right/jump keys of that frame. Returns the new state and the
+    fields that changed, in the shape the server expects as a player_action.
+    """
+    state = dict(state)
+    action = {}
+
+    if command['left']:
+        state['x'] = max(MIN_X, state['x'] - MOVE_SPEED)
+        state['facing_right'] = False
+        action['x'] = state['x']
+        action['facing_right'] = False
+    elif command['right']:
+        state['x'] = min(MAX_X, state['x'] + MOVE_SPEED)
+        state['facing_right'] = True
+        action['x'] = state['x']
+        action['facing_right'] = True
+
+    on_platform, _ = check_on_platform(platforms, state['x'], state['y'], state['velocity_y'])
+
+    if command['jump'] and on_platform and not state['is_jumping']:
+        state['is_jumping'] = True
+        state['velocity_y'] = -JUMP_STRENGTH
+        action['is_jumping'] = True
+        action['velocity'] = state['velocity_y']
+
+    if state['is_jumping'] or not on_platform:
+        state['y'] += state['velocity_y']
+        state['velocity_y'] += GRAVITY
+        action['y'] = state['y']
+        action['velocity_y'] = state['velocity_y']
+
+    on_platform_now, landing_y = check_on_platform(platforms, state['x'], state['y'], state['velocity_y'])
+
+    if not on_platform:
+        state['y'] += GRAVITY
+        action['y'] = state['y']
+        action['velocity_y'] = state['velocity_y']
+
+    if on_platform_now and state['velocity_y'] > 0:
+        state['is_jumping'] = False
+        state['velocity_y'] = 0
+        state['y'] = landing_y
+        action['y'] = landing_y
+        action['is_jumping'] = False
+        action['velocity_y'] = 0
+
+    return state, action
+
+
+class Predictor:
+    """Client side: moves the local player immediately and reconciles with the server.
+
+    Every frame that changes the player gets an input sequence number and is
+    kept until the server acknowledges it. When a snapshot reports the
+    position the server ended up at for an acknowledged input and it
+    disagrees with what was predicted, the player is put there and every
+    newer input is replayed on top.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING):
+        self.state = None
+        self.input_seq = 0
+        self.pending = deque(maxlen=max_pending)
+        self.server_update = None
+        self.corrections = 0
+
+    def reset(self, player_data):
+        self.state = {
+            'x': player_data.get('x', 0),
+            'y': player_data.get('y', 0),
+            'velocity_y': 0,
+            'is_jumping': False,
+            'facing_right': player_data.get('facing_right', False)
+        }
+        self.pending.clear()
+        self.server_update = None
+
+    def predict(self, command, platforms):
+        state, action = step(self.state, command, platforms)
+        self.state = state
+        if not action:
+            return None
+        self.input_seq += 1
+        self.pending.append((self.input_seq, command, dict(state)))
+        action['input_seq'] = self.input_seq
+        return action
+
+    def server_state(self, player_data):
+        # Called from the receive thread; the game loop reconciles once per frame
+        self.server_update = (player_data.get('input_seq', 0), player_data['x'], player_data['y'])
+
+    def reconcile(self, platforms):
+        update, self.server_update = self.server_update, None
+        if update is None or self.state is None:
+            return
+        input_seq, x, y = update
+
+        while self.pending and self.pending[0][0] < input_seq:
+            self.pending.popleft()
+        if self.pending and self.pending[0][0] == input_seq:
+            predicted = self.pending.popleft()[2]
+        elif not self.pending and input_seq >= self.input_seq:
+            predicted = self.state
+        else:
+            # Already reconciled against a newer input
+            return
+
+        if abs(predicted['x'] - x) <= TOLERANCE and abs(predicted['y'] - y) <= TOLERANCE:
+            return
+
+        self.corrections += 1
+        state = dict(predicted, x=x, y=y)
+        replayed = deque(maxlen=self.pending.maxlen)
+        for seq, command, _ in self.pending:
+            state, _ = step(state, command, platforms)
+            replayed.append((seq, command, dict(state)))
+        self.pending = replayed
+        self.state = state
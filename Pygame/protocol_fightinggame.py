@@ -0,0 +1,329 @@
+import json
+import struct
+
+# Every message on the wire is one frame:
+#   version (u8) | message type (u8) | payload length (u32) | payload
+# Hot messages (heartbeat, player_action, game_state_update) use fixed-layout
+# records, everything else (connect, match_start, game_over, errors, ...) is
+# carried as a JSON object inside a frame. Nothing from the network is ever
+# unpickled: a pickle can run code on whoever loads it.
+PROTOCOL_VERSION = 6
+HEADER = struct.Struct('!BBI')
+MAX_FRAME_SIZE = 1 << 20
+
+MSG_CONTROL = 0
+MSG_HEARTBEAT = 1
+MSG_PLAYER_ACTION = 2
+MSG_GAME_STATE_UPDATE = 3
+MSG_SNAPSHOT_ACK = 4
+MSG_STATE_KEYFRAME = 5
+MSG_STATE_DELTA = 6
+
+CHARACTERS = (None, 'Lucario', 'Mewtwo', 'Zeraora', 'Cinderace')
+CHARACTER_IDS = {name: index for index, name in enumerate(CHARACTERS)}
+
+ACTION_FLOAT_FIELDS = ('x', 'y', 'velocity_y', 'velocity', 'damage', 'attack_range')
+ACTION_BOOL_FIELDS = ('facing_right', 'is_attacking', 'is_special_attacking', 'attack', 'is_jumping', 'died')
+ACTION_FIELDS = ACTION_FLOAT_FIELDS + ACTION_BOOL_FIELDS
+ACTION_BITS = {field: bit for bit, field in enumerate(ACTION_FIELDS)}
+# Sent as plain u32s, 0 meaning absent
+ACTION_SEQ_FIELDS = ('input_seq', 'view_tick')
+# input seq, view tick, presence mask, bool values, float slots
+ACTION_RECORD = struct.Struct('!IIHB6f')
+
+PLAYER_BOOL_FIELDS = ('connected', 'is_dead', 'is_attacking', 'is_special_attacking', 'facing_right')
+PLAYER_FIELDS = frozenset(PLAYER_BOOL_FIELDS + ('character', 'x', 'y', 'health', 'input_seq'))
+STATE_FIELDS = frozenset(('players', 'ready', 'platforms'))
+# ready count, player count, platform count
+STATE_HEADER = struct.Struct('!BBB')
+# player number, flags, character id, x, y, health, last input seq applied
+PLAYER_RECORD = struct.Struct('!BBBfffI')
+PLATFORM_RECORD = struct.Struct('!hhhh')
+
+SEQ_RECORD = struct.Struct('!I')
+# seq, server tick the snapshot was taken on
+SNAPSHOT_RECORD = struct.Struct('!II')
+# seq, server tick, distance back to the base seq, ready count, changed player count
+DELTA_HEADER = struct.Struct('!IIBBB')
+READY_UNCHANGED = 255
+# player number, changed field mask
+DELTA_PLAYER_HEADER = struct.Struct('!BH')
+DELTA_FLOAT_FIELDS = ('x', 'y', 'health')
+DELTA_FIELDS = PLAYER_BOOL_FIELDS + ('character',) + DELTA_FLOAT_FIELDS + ('input_seq',)
+DELTA_BITS = {field: bit for bit, field in enumerate(DELTA_FIELDS)}
+DELTA_BOOL_MASK = (1 << len(PLAYER_BOOL_FIELDS)) - 1
+DELTA_CHARACTER_BIT = 1 << DELTA_BITS['character']
+DELTA_INPUT_SEQ_BIT = 1 << DELTA_BITS['input_seq']
+FLOAT32 = struct.Struct('!f')
+
+HEARTBEAT = {'status': 'heartbeat'}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_control(message):
+    return json.dumps(message, separators=(',', ':')).encode()
+
+
+def control_object(pairs):
+    # JSON keys are strings; the only numeric keys in messages are player numbers
+    return {int(key) if key.isdecimal() else key: value for key, value in pairs}
+
+
+def decode_control(payload):
+    message = json.loads(payload, object_pairs_hook=control_object)
+    if not isinstance(message, dict):
+        raise ProtocolError('Control message is not an object')
+    return message
+
+
+def frame(message_type, payload=b''):
+    return HEADER.pack(PROTOCOL_VERSION, message_type, len(payload)) + payload
+
+
+def encode_action(action):
+    mask = 0
+    flags = 0
+    values = [0.0] * len(ACTION_FLOAT_FIELDS)
+    for field, value in action.items():
+        if field in ACTION_SEQ_FIELDS:
+            continue
+        bit = ACTION_BITS[field]
+        mask |= 1 << bit
+        if bit < len(ACTION_FLOAT_FIELDS):
+            values[bit] = value
+        elif value:
+            flags |= 1 << (bit - len(ACTION_FLOAT_FIELDS))
+    return ACTION_RECORD.pack(action.get('input_seq', 0), action.get('view_tick', 0), mask, flags, *values)
+
+
+def decode_action(payload):
+    input_seq, view_tick, mask, flags, *values = ACTION_RECORD.unpack(payload)
+    action = {}
+    if input_seq:
+        action['input_seq'] = input_seq
+    if view_tick:
+        action['view_tick'] = view_tick
+    for bit, field in enumerate(ACTION_FIELDS):
+        if not mask & (1 << bit):
+            continue
+        if bit < len(ACTION_FLOAT_FIELDS):
+            action[field] = values[bit]
+        else:
+            action[field] = bool(flags & (1 << (bit - len(ACTION_FLOAT_FIELDS))))
+    return action
+
+
+def can_encode_state(game_state):
+    if not set(game_state) <= STATE_FIELDS:
+        return False
+    if not 0 <= game_state.get('ready', 0) <= 255:
+        return False
+    for player_num, player in game_state.get('players', {}).items():
+        if not isinstance(player_num, int) or set(player) != PLAYER_FIELDS:
+            return False
+        if player['character'] not in CHARACTER_IDS:
+            return False
+    return True
+
+
+def encode_state(game_state):
+    players = game_state.get('players', {})
+    platforms = game_state.get('platforms', [])
+    parts = [STATE_HEADER.pack(game_state.get('ready', 0), len(players), len(platforms))]
+    for player_num, player in players.items():
+        flags = 0
+        for bit, field in enumerate(PLAYER_BOOL_FIELDS):
+            if player[field]:
+                flags |= 1 << bit
+        parts.append(PLAYER_RECORD.pack(player_num, flags, CHARACTER_IDS[player['character']],
+                                        player['x'], player['y'], player['health'], player['input_seq']))
+    for platform in platforms:
+        parts.append(PLATFORM_RECORD.pack(platform['x'], platform['y'],
+                                          platform['width'], platform['height']))
+    return b''.join(parts)
+
+
+def decode_state(payload):
+    ready, player_count, platform_count = STATE_HEADER.unpack_from(payload, 0)
+    offset = STATE_HEADER.size
+    players = {}
+    for _ in range(player_count):
+        player_num, flags, character_id, x, y, health, input_seq = PLAYER_RECORD.unpack_from(payload, offset)
+        offset += PLAYER_RECORD.size
+        player = {field: bool(flags & (1 << bit)) for bit, field in enumerate(PLAYER_BOOL_FIELDS)}
+        player.update({'character': CHARACTERS[character_id], 'x': x, 'y': y, 'health': health,
+                       'input_seq': input_seq})
+        players[player_num] = player
+    platforms = []
+    for _ in range(platform_count):
+        x, y, width, height = PLATFORM_RECORD.unpack_from(payload, offset)
+        offset += PLATFORM_RECORD.size
+        platforms.append({'x': x, 'y': y, 'width': width, 'height': height})
+    return {'players': players, 'ready': ready, 'platforms': platforms}
+
+
+def can_encode_delta(delta):
+    if not 0 <= delta.get('ready', 0) < READY_UNCHANGED or not 0 < delta['seq'] - delta['base_seq'] <= 255:
+        return False
+    for player_num, changes in delta['players'].items():
+        if not isinstance(player_num, int) or not changes.keys() <= DELTA_BITS.keys():
+            return False
+        if changes.get('character') not in CHARACTER_IDS:
+            return False
+    return True
+
+
+def encode_delta(delta):
+    players = delta['players']
+    parts = [DELTA_HEADER.pack(delta['seq'], delta['tick'], delta['seq'] - delta['base_seq'],
+                               delta.get('ready', READY_UNCHANGED), len(players))]
+    for player_num, changes in players.items():
+        mask = 0
+        flags = 0
+        for field, value in changes.items():
+            bit = DELTA_BITS[field]
+            mask |= 1 << bit
+            if bit < len(PLAYER_BOOL_FIELDS) and value:
+                flags |= 1 << bit
+        parts.append(DELTA_PLAYER_HEADER.pack(player_num, mask))
+        if mask & DELTA_BOOL_MASK:
+            parts.append(bytes((flags,)))
+        if mask & DELTA_CHARACTER_BIT:
+            parts.append(bytes((CHARACTER_IDS[changes['character']],)))
+        for field in DELTA_FLOAT_FIELDS:
+            if field in changes:
+                parts.append(FLOAT32.pack(changes[field]))
+        if mask & DELTA_INPUT_SEQ_BIT:
+            parts.append(SEQ_RECORD.pack(changes['input_seq']))
+    return b''.join(parts)
+
+
+def decode_delta(payload):
+    seq, tick, base_offset, ready, player_count = DELTA_HEADER.unpack_from(payload, 0)
+    offset = DELTA_HEADER.size
+    players = {}
+    for _ in range(player_count):
+        player_num, mask = DELTA_PLAYER_HEADER.unpack_from(payload, offset)
+        offset += DELTA_PLAYER_HEADER.size
+        changes = {}
+        if mask & DELTA_BOOL_MASK:
+            flags = payload[offset]
+            offset += 1
+            for bit, field in enumerate(PLAYER_BOOL_FIELDS):
+                if mask & (1 << bit):
+                    changes[field] = bool(flags & (1 << bit))
+        if mask & DELTA_CHARACTER_BIT:
+            changes['character'] = CHARACTERS[payload[offset]]
+            offset += 1
+        for field in DELTA_FLOAT_FIELDS:
+            if mask & (1 << DELTA_BITS[field]):
+                changes[field] = FLOAT32.unpack_from(payload, offset)[0]
+                offset += FLOAT32.size
+        if mask & DELTA_INPUT_SEQ_BIT:
+            changes['input_seq'] = SEQ_RECORD.unpack_from(payload, offset)[0]
+            offset += SEQ_RECORD.size
+        players[player_num] = changes
+    delta = {'status': 'game_state_delta', 'seq': seq, 'tick': tick, 'base_seq': seq - base_offset,
+             'players': players}
+    if ready != READY_UNCHANGED:
+        delta['ready'] = ready
+    return delta
+
+
+def encode_message(message):
+    if message == HEARTBEAT:
+        return frame(MSG_HEARTBEAT)
+    if set(message) == {'snapshot_ack'}:
+        return frame(MSG_SNAPSHOT_ACK, SEQ_RECORD.pack(message['snapshot_ack']))
+    if message.get('status') == 'game_state_delta' and can_encode_delta(message):
+        return frame(MSG_STATE_DELTA, encode_delta(message))
+    if (message.get('status') == 'game_state_update' and set(message) == {'status', 'game_state', 'seq', 'tick'}
+            and can_encode_state(message['game_state'])):
+        return frame(MSG_STATE_KEYFRAME, SNAPSHOT_RECORD.pack(message['seq'], message['tick'])
+                     + encode_state(message['game_state']))
+    if set(message) == {'player_action'} and message['player_action'].keys() <= ACTION_BITS.keys() | set(ACTION_SEQ_FIELDS):
+        return frame(MSG_PLAYER_ACTION, encode_action(message['player_action']))
+    if (message.get('status') == 'game_state_update' and set(message) == {'status', 'game_state'}
+            and can_encode_state(message['game_state'])):
+        return frame(MSG_GAME_STATE_UPDATE, encode_state(message['game_state']))
+    return frame(MSG_CONTROL, encode_control(message))
+
+
+def decode_payload(message_type, payload):
+    """The message in one frame; ProtocolError if it is malformed, so only its connection is dropped."""
+    try:
+        if message_type == MSG_HEARTBEAT:
+            return dict(HEARTBEAT)
+        if message_type == MSG_PLAYER_ACTION:
+            return {'player_action': decode_action(payload)}
+        if message_type == MSG_GAME_STATE_UPDATE:
+            return {'status': 'game_state_update', 'game_state': decode_state(payload)}
+        if message_type == MSG_SNAPSHOT_ACK:
+            return {'snapshot_ack': SEQ_RECORD.unpack(payload)[0]}
+        if message_type == MSG_STATE_KEYFRAME:
+            seq, tick = SNAPSHOT_RECORD.unpack_from(payload)
+            return {'status': 'game_state_update', 'seq': seq, 'tick': tick,
+                    'game_state': decode_state(payload[SNAPSHOT_RECORD.size:])}
+        if message_type == MSG_STATE_DELTA:
+            return decode_delta(payload)
+        if message_type == MSG_CONTROL:
+            return decode_control(payload)
+    # Truncated records, out-of-range character ids, invalid JSON or UTF-8
+    except (struct.error, IndexError, ValueError, RecursionError) as e:
+        raise ProtocolError(f'Malformed message of type {message_type}: {str(e)}') from e
+    raise ProtocolError(f'Unknown message type {message_type}')
+
+
+class FrameDecoder:
+    """Reassembles frames from a TCP byte stream, however recv() splits or merges them."""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        self.buffer.extend(data)
+        return list(self.frames())
+
+    def feed_raw(self, data):
+        self.buffer.extend(data)
+        return list(self.raw_frames())
+
+    def frames(self):
+        for message_type, payload in self.raw_frames():
+            yield decode_payload(message_type, payload)
+
+    def raw_frames(self):
+        view = memoryview(self.buffer)
+        offset = 0
+        try:
+            while len(view) - offset >= HEADER.size:
+                version, message_type, length = HEADER.unpack_from(view, offset)
+                if version != PROTOCOL_VERSION:
+                    raise ProtocolError(f'Unsupported protocol version {version}')
+                if length > self.max_frame_size:
+                    raise ProtocolError(f'Frame of {length} bytes exceeds limit')
+                end = offset + HEADER.size + length
+                if end > len(view):
+                    break
+                payload = bytes(view[offset + HEADER.size:end])
+                offset = end
+                yield message_type, payload
+        finally:
+            view.release()
+            del self.buffer[:offset]
+
+
+def send_message(sock, message):
+    sock.sendall(encode_message(message))
+
+
+def recv_messages(sock, decoder, bufsize=65536):
+    """Returns every complete message from one recv(), or None once the peer closed."""
+    data = sock.recv(bufsize)
+    if not data:
+        return None
+    return decoder.feed(data)
@@ -0,0 +1,219 @@
+import functools
+from collections import OrderedDict
+
+import pygame
+
+# Colours of the stage, the same in the client and the local stadium
+SKY_TOP = (30, 30, 120)
+SKY_BOTTOM = (50, 150, 255)
+MOUNTAIN = (100, 100, 100)
+PLATFORM = (30, 30, 120)
+PLATFORM_EDGE = (255, 255, 255)
+# Height of the lit strip along the top of each platform
+PLATFORM_EDGE_HEIGHT = 5
+# Past this share of the window changed in one frame, a single flip is cheaper than
+# pushing the rectangles one by one
+FULL_UPDATE_SHARE = 0.4
+# Rendering modes: only the changed rectangles, or the whole window every frame
+DIRTY = 'dirty'
+FULL = 'full'
+# Pixel memory of cached text surfaces; a full screen of text is about 2.5 MB at 32 bits
+TEXT_CACHE_BYTES = 4 * 1024 * 1024
+# Word-wrapped layouts kept; there is rarely more than one error message at a time
+WRAP_CACHE_SIZE = 32
+
+
+def draw_sky(surface):
+    """Vertical gradient, one line per row."""
+    width, height = surface.get_size()
+    for y in range(height):
+        color = tuple(top + (bottom - top) * y // height for top, bottom in zip(SKY_TOP, SKY_BOTTOM))
+        pygame.draw.line(surface, color, (0, y), (width, y))
+
+
+def draw_mountains(surface):
+    height = surface.get_height()
+    pygame.draw.polygon(surface, MOUNTAIN, [(0, height), (300, 500), (500, height)])
+    pygame.draw.polygon(surface, MOUNTAIN, [(500, height), (700, 400), (900, height)])
+
+
+def draw_platform(surface, platform):
+    pygame.draw.rect(surface, PLATFORM, (platform.x, platform.y, platform.width, platform.height))
+    pygame.draw.rect(surface, PLATFORM_EDGE, (platform.x, platform.y, platform.width, PLATFORM_EDGE_HEIGHT))
+
+
+class StaticLayers:
+    """Everything in a frame that does not move, composed once and blitted whole.
+
+    The backdrop (sky and mountains) depends only on the window size and the
+    stage (backdrop plus platforms) on the platforms as well, so each is kept
+    on its own surface and redrawn only when its key changes: a resize, or a
+    new match bringing a different stage. Every other frame costs one blit.
+    """
+
+    def __init__(self):
+        self.backdrop = None
+        self.backdrop_key = None
+        self.stage = None
+        self.stage_key = None
+
+    @staticmethod
+    def platforms_key(platforms):
+        return tuple((platform.x, platform.y, platform.width, platform.height) for platform in platforms)
+
+    def invalidate(self):
+        self.backdrop_key = self.stage_key = None
+
+    def render_backdrop(self, size):
+        if self.backdrop_key != size:
+            # In the display's pixel format, so the blits below are plain copies
+            self.backdrop = pygame.Surface(size).convert()
+            draw_sky(self.backdrop)
+            draw_mountains(self.backdrop)
+            self.backdrop_key = size
+        return self.backdrop
+
+    def render_stage(self, size, platforms):
+        key = (size, self.platforms_key(platforms))
+        if self.stage_key != key:
+            backdrop = self.render_backdrop(size)
+            # A new surface, so DirtyRects sees the stage changed and repaints it all
+            self.stage = pygame.Surface(size).convert()
+            self.stage.blit(backdrop, (0, 0))
+            for platform in platforms:
+                draw_platform(self.stage, platform)
+            self.stage_key = key
+        return self.stage
+
+    def draw(self, screen, platforms=()):
+        """Covers the whole screen with the stage, so no fill is needed first."""
+        screen.blit(self.render_stage(screen.get_size(), platforms), (0, 0))
+
+
+class DirtyRects:
+    """Pushes only what changed since the last frame to the display.
+
+    A frame begins by painting the background back over everything drawn in
+    the previous one, and the bounds of everything drawn in this one are
+    added as it is drawn; present() then updates just those rectangles. The
+    whole window is repainted and flipped instead on the first frame, when
+    the background changes (a resize or a new stage), when the window was
+    exposed, when the rectangles add up to more than full_share of it, and
+    on frames that ask for it: a translucent overlay over the whole window
+    has to be blended onto a clean background every time. A frame whose key
+    is the same as the last one's is not drawn at all.
+    """
+
+    def __init__(self, mode=DIRTY, full_share=FULL_UPDATE_SHARE):
+        self.mode = mode
+        self.full_share = full_share
+        self.background = None
+        self.key = None
+        self.full = True
+        self.erased = []
+        self.drawn = []
+
+    def begin(self, screen, background, full=False, key=None):
+        """Clears what the last frame drew; False if the frame has the same key and needs no drawing.
+
+        The background is a surface the size of the screen or a colour.
+        """
+        # Exposed windows lose their contents on some platforms; the event stays queued for the caller
+        if pygame.event.peek((pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED)):
+            self.full = True
+        if background is not self.background or self.mode != DIRTY:
+            self.full = True
+        self.background = background
+        if key is not None and key == self.key and not self.full:
+            return False
+        self.key = key
+        self.full = self.full or full
+        if self.full:
+            self.erased = []
+            self.paint(screen, background, None)
+        else:
+            # Kept until presented, in case a frame was drawn and never shown
+            self.erased.extend(self.drawn)
+            for rect in self.drawn:
+                self.paint(screen, background, rect)
+        self.drawn = []
+        return True
+
+    @staticmethod
+    def paint(screen, background, rect):
+        if isinstance(background, pygame.Surface):
+            screen.blit(background, rect or (0, 0), rect)
+        else:
+            screen.fill(background, rect)
+
+    def add(self, rect):
+        """Records something drawn this frame, from the Rect a blit or draw call returned."""
+        if rect:
+            self.drawn.append(rect)
+        return rect
+
+    def present(self):
+        """Pushes the frame to the display; returns how many pixels were updated."""
+        screen = pygame.display.get_surface()
+        area = screen.get_width() * screen.get_height()
+        rects = self.erased + self.drawn
+        changed = sum(rect.width * rect.height for rect in rects)
+        if self.full or changed > area * self.full_share:
+            pygame.display.flip()
+            changed = area
+        elif rects:
+            pygame.display.update(rects)
+        self.full = False
+        self.erased = []
+        return changed
+
+
+class TextCache:
+    """Rendered strings, so the same text is rasterized once rather than every frame.
+
+    Keyed by (font, text, colour, antialias); colours must be tuples, as
+    pygame.Color cannot be hashed. Least recently used surfaces are dropped
+    once their pixels take more than max_bytes, so a counter that changes
+    every frame costs memory only up to the bound.
+    """
+
+    def __init__(self, max_bytes=TEXT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.surfaces = OrderedDict()
+        self.bytes = 0
+
+    def render(self, font, text, color, antialias=True):
+        """font.render(text, antialias, color), from the cache when it was drawn before. Never draw on it."""
+        key = (font, text, color, antialias)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+        surface = font.render(text, antialias, color)
+        self.surfaces[key] = surface
+        self.bytes += surface_bytes(surface)
+        while self.bytes > self.max_bytes and len(self.surfaces) > 1:
+            _, evicted = self.surfaces.popitem(last=False)
+            self.bytes -= surface_bytes(evicted)
+        return surface
+
+
+def surface_bytes(surface):
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+
+@functools.lru_cache(maxsize=WRAP_CACHE_SIZE)
+def wrap_text(font, text, width):
+    """The words of text as lines no wider than width in font."""
+    lines = []
+    line = ""
+    for word in text.split():
+        test_line = line + " " + word if line else word
+        if font.size(test_line)[0] <= width:
+            line = test_line
+        else:
+            lines.append(line)
+            line = word
+    if line:
+        lines.append(line)
+    return tuple(lines)
@@ -0,0 +1,321 @@
+import argparse
+import bisect
+import copy
+import logging
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+
+import protocol_fightinggame as protocol
+
+# A replay file is a header, a stream of records and, once the match is
+# over, an index of keyframe offsets followed by a fixed-size footer:
+#   header:  magic | version (u8) | seed (u32) | room id (u32) | tick rate (u16) | start tick (u32) |
+#            max rewind ticks (u16)
+#   record:  type (u8) | tick (u32) | player num (u8) | payload length (u32) | payload
+#   index:   (tick (u32) | offset (u64)) * count
+#   footer:  index offset (u64) | count (u32) | index magic
+# Inputs are stored as the protocol frames the clients sent; keyframes hold
+# the full room state as JSON so playback can start at any of them. Replays
+# get shared, so as with the network nothing in them is ever unpickled. Hits
+# depend on the rewind window, so the header keeps the one the match was
+# played with.
+MAGIC = b'FGRP'
+INDEX_MAGIC = b'FGIX'
+REPLAY_VERSION = 3
+HEADER = struct.Struct('!4sBIIHIH')
+RECORD = struct.Struct('!BIBI')
+INDEX_ENTRY = struct.Struct('!IQ')
+FOOTER = struct.Struct('!QI4s')
+
+REC_KEYFRAME = 1   # JSON room state at the start of the tick
+REC_INPUT = 2      # protocol frame of one client message, applied after the tick
+REC_CHARACTER = 3  # character id picked by a player
+REC_END = 4        # match over; payload is the winner (0 = abandoned)
+REC_SKIP = 5       # the server skipped ticks; payload is the tick before the gap
+SEQ = struct.Struct('!I')
+
+REPLAY_DIR = 'replays'
+# Five seconds at 20 Hz; seeking replays at most this many ticks
+KEYFRAME_INTERVAL = 100
+# Client messages that don't change the simulation
+UNRECORDED = frozenset(('snapshot_ack', 'keyframe_request', 'clock_ping'))
+
+
+def room_state(room):
+    return {
+        'game_state': room.game_state,
+        'match_started': room.match_started,
+        'history': room.position_history.window(room.tick_number),
+        # Merged inputs not applied yet, and the held flags they release on the next tick
+        'pending_actions': room.pending_actions
+    }
+
+
+class MatchRecorder:
+    """Appends one match of a room to a replay file."""
+
+    def __init__(self, path, room, tick_rate, keyframe_interval=KEYFRAME_INTERVAL, seed=None):
+        self.path = path
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.keyframe_interval = keyframe_interval
+        self.start_tick = room.tick_number
+        self.index = []
+        # Threaded servers record inputs from the client threads while the tick writes keyframes
+        self.lock = threading.Lock()
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, REPLAY_VERSION, self.seed, room.room_id, tick_rate, self.start_tick,
+                                    room.server.max_rewind_ticks))
+        for player_num, player in sorted(room.game_state['players'].items()):
+            self.write(REC_CHARACTER, self.start_tick, player_num,
+                       bytes((protocol.CHARACTER_IDS.get(player['character'], 0),)))
+
+    def write(self, record_type, tick, player_num, payload):
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(RECORD.pack(record_type, tick, player_num, len(payload)))
+            self.file.write(payload)
+
+    def keyframe_due(self, tick):
+        return (tick - self.start_tick) % self.keyframe_interval == 0
+
+    def keyframe(self, tick, room):
+        """Called with the room's input lock held, so no input slips between the state and the file."""
+        with self.lock:
+            self.index.append((tick, self.file.tell()))
+        self.write(REC_KEYFRAME, tick, 0, protocol.encode_control(room_state(room)))
+
+    def skip(self, tick, previous_tick):
+        self.write(REC_SKIP, tick, 0, SEQ.pack(previous_tick))
+
+    def input(self, tick, player_num, client_data):
+        if client_data.keys() <= UNRECORDED:
+            return
+        self.write(REC_INPUT, tick, player_num, protocol.encode_message(client_data))
+
+    def close(self, tick, winner=0):
+        self.write(REC_END, tick, 0, bytes((winner,)))
+        with self.lock:
+            index_offset = self.file.tell()
+            for entry in self.index:
+                self.file.write(INDEX_ENTRY.pack(*entry))
+            self.file.write(FOOTER.pack(index_offset, len(self.index), INDEX_MAGIC))
+            self.file.close()
+
+
+def open_recorder(replay_dir, room, tick_rate, logger):
+    """Starts recording the match about to begin in `room`, or returns None if replays are off."""
+    if not replay_dir:
+        return None
+    seed = random.getrandbits(32)
+    path = os.path.join(replay_dir, f"room{room.room_id}_{time.strftime('%Y%m%d-%H%M%S')}_{seed:08x}.fgr")
+    try:
+        os.makedirs(replay_dir, exist_ok=True)
+        recorder = MatchRecorder(path, room, tick_rate, seed=seed)
+    except OSError as e:
+        logger.error(f'Could not open replay file {path}: {str(e)}')
+        return None
+    logger.info(f'Room {room.room_id}: recording replay to {path}')
+    return recorder
+
+
+class ReplayReader:
+    """Memory-mapped view of a replay file; nothing is read until it is touched."""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.seed, self.room_id, self.tick_rate, self.start_tick,
+         self.max_rewind_ticks) = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != REPLAY_VERSION:
+            raise ValueError(f'{path} is not a version {REPLAY_VERSION} replay')
+
+        self.end = len(self.data)
+        self.index = []
+        if len(self.data) >= HEADER.size + FOOTER.size:
+            index_offset, count, index_magic = FOOTER.unpack_from(self.data, len(self.data) - FOOTER.size)
+            if index_magic == INDEX_MAGIC:
+                self.end = index_offset
+                self.index = [INDEX_ENTRY.unpack_from(self.data, index_offset + i * INDEX_ENTRY.size)
+                              for i in range(count)]
+        if not self.index:
+            # The server stopped mid-match: rebuild the index with one pass over the records
+            self.index = [(tick, offset) for offset, record_type, tick, _, _ in self.records(HEADER.size)
+                          if record_type == REC_KEYFRAME]
+        self.index_ticks = [tick for tick, _ in self.index]
+
+    def records(self, offset):
+        view = memoryview(self.data)
+        try:
+            while offset + RECORD.size <= self.end:
+                record_type, tick, player_num, length = RECORD.unpack_from(view, offset)
+                start = offset + RECORD.size
+                if start + length > self.end:
+                    break
+                yield offset, record_type, tick, player_num, view[start:start + length]
+                offset = start + length
+        finally:
+            view.release()
+
+    def keyframe_before(self, tick):
+        position = bisect.bisect_right(self.index_ticks, tick) - 1
+        if position < 0:
+            raise ValueError(f'No keyframe at or before tick {tick}')
+        return self.index[position]
+
+    def characters(self):
+        characters = {}
+        for _, record_type, _, player_num, payload in self.records(HEADER.size):
+            if record_type != REC_CHARACTER:
+                break
+            characters[player_num] = protocol.CHARACTERS[payload[0]]
+        return characters
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+class NullSocket:
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplayServer:
+    """Just enough of GameServer to run a GameRoom offline."""
+
+    def __init__(self, max_rewind_ticks):
+        self.logger = logging.getLogger('Replay')
+        self.max_rewind_ticks = max_rewind_ticks
+        self.winner = None
+        self.final_state = None
+
+    def record_match_start(self, room, player1_character, player2_character):
+        pass
+
+    def record_game_over(self, room, winner):
+        # The room resets its players right after this call
+        self.winner = winner
+        self.final_state = copy.deepcopy(room.game_state)
+
+    def open_replay(self, room):
+        return None
+
+
+class ReplayPlayer:
+    """Re-runs a recorded match through GameRoom, headless and as fast as possible."""
+
+    def __init__(self, reader):
+        import room_fightinggame as room_manager
+
+        self.reader = reader
+        self.server = ReplayServer(reader.max_rewind_ticks)
+        self.room = room_manager.GameRoom(self.server, reader.room_id)
+        self.offset = None
+        self.tick = None
+        self.finished = False
+
+    def restore(self, payload):
+        """Puts the room back as the keyframe found it; returns the inputs that were pending then."""
+        state = protocol.decode_control(bytes(payload))
+        self.room.reset()
+        self.room.game_state = copy.deepcopy(state['game_state'])
+        self.room.platforms = self.room.game_state['platforms']
+        self.room.match_started = state['match_started']
+        for tick, players in state['history']:
+            self.room.position_history.record(tick, players)
+        self.room.clients = {player_num: NullSocket() for player_num in self.room.game_state['players']}
+        return state['pending_actions']
+
+    def seek(self, tick):
+        """Jumps to the state after tick `tick` and the inputs that followed it."""
+        keyframe_tick, offset = self.reader.keyframe_before(tick)
+        for _, _, _, _, payload in self.reader.records(offset):
+            pending_actions = self.restore(payload)
+            self.offset = offset + RECORD.size + len(payload)
+            break
+        # The keyframe was taken after its tick applied the inputs before it, so
+        # the rest of that tick runs first and only then are the pending inputs back
+        self.tick = keyframe_tick
+        self.finished = False
+        self.room.tick(keyframe_tick)
+        self.room.pending_actions = pending_actions
+        return self.play(until=tick)
+
+    def play(self, until=None):
+        """Runs records up to and including tick `until`, or to the end of the match."""
+        if self.offset is None:
+            self.seek(self.reader.start_tick)
+        for offset, record_type, tick, player_num, payload in self.reader.records(self.offset):
+            if until is not None and tick > until:
+                break
+            self.offset = offset + RECORD.size + len(payload)
+            if record_type == REC_SKIP:
+                # The server dropped ticks here to catch up; don't simulate them either
+                self.advance(SEQ.unpack(payload)[0])
+                self.tick = tick - 1
+                continue
+            self.advance(tick)
+            if record_type == REC_END:
+                self.finished = True
+                break
+            if record_type == REC_INPUT and player_num in self.room.game_state['players']:
+                for client_data in protocol.FrameDecoder().feed(payload):
+                    self.room.handle_client_data(self.room.clients[player_num], player_num, client_data)
+        if until is not None and not self.finished:
+            self.advance(until)
+        return self.room.game_state
+
+    def advance(self, tick):
+        while self.tick < tick:
+            self.tick += 1
+            self.room.tick(self.tick)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Pokemon Fighting Game Replay Player')
+    parser.add_argument('replay', help='Replay file written by the server')
+    parser.add_argument('--seek', type=int, default=None,
+                        help='Only show the state this many ticks into the match')
+    return parser.parse_args()
+
+
+def describe(game_state):
+    return ', '.join(f"P{player_num} {player['character']} x={player['x']:.0f} y={player['y']:.0f} "
+                     f"hp={player['health']:.0f}" for player_num, player in sorted(game_state['players'].items()))
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.WARNING)
+    reader = ReplayReader(args.replay)
+    player = ReplayPlayer(reader)
+    print(f'room {reader.room_id}, seed {reader.seed:08x}, {reader.tick_rate} Hz, '
+          f'{len(reader.index)} keyframes, characters {reader.characters()}')
+
+    start = time.perf_counter()
+    if args.seek is not None:
+        player.seek(reader.start_tick + max(0, args.seek))
+        elapsed = time.perf_counter() - start
+        print(f'tick {player.tick - reader.start_tick} (found in {elapsed * 1000:.1f} ms): '
+              f'{describe(player.room.game_state)}')
+    else:
+        game_state = player.play()
+        ticks = player.tick - reader.start_tick
+        elapsed = time.perf_counter() - start
+        print(f'{ticks} ticks ({ticks / reader.tick_rate:.1f}s of play) replayed in {elapsed * 1000:.1f} ms '
+              f'({ticks / reader.tick_rate / max(elapsed, 1e-9):.0f}x real time)')
+        print(f'winner: {player.server.winner}, final: {describe(player.server.final_state or game_state)}')
+    print(f'{os.path.getsize(args.replay)} bytes')
+    reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,597 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import history_fightinggame as history
+import inputs_fightinggame as inputs
+import log_fightinggame as log
+import matchmaking_fightinggame as matchmaking
+import metrics_fightinggame as metrics
+import protocol_fightinggame as protocol
+import snapshot_fightinggame as snapshot
+import spectator_fightinggame as spectator
+
+PLAYERS_PER_ROOM = 2
+
+tick_seconds = metrics.histogram('fightinggame_tick_seconds', 'Time to tick every room of the process once')
+broadcast_seconds = metrics.histogram('fightinggame_broadcast_seconds', 'Time to capture and send one room snapshot')
+broadcast_bytes = metrics.histogram('fightinggame_broadcast_bytes', 'Bytes of one room snapshot sent to its players',
+                                    metrics.SIZE_BUCKETS)
+input_latency = metrics.histogram('fightinggame_input_latency_seconds',
+                                  'From a player input arriving to the first snapshot that includes it')
+client_rtt = metrics.histogram('fightinggame_client_rtt_seconds', 'From sending a snapshot to its ack arriving')
+client_messages = metrics.counter('fightinggame_client_messages_total', 'Messages received from players')
+inputs_coalesced = metrics.counter('fightinggame_inputs_coalesced_total',
+                                   'Player actions merged into another one that arrived in the same tick')
+matches_started = metrics.counter('fightinggame_matches_started_total', 'Matches started; each one saves its characters')
+
+
+class GameRoom:
+    """One 2-player match: its own players, game state, snapshots and tick."""
+
+    def __init__(self, server, room_id):
+        self.server = server
+        self.room_id = room_id
+        self.logger = server.logger
+        self.message_logger = logging.getLogger(log.MESSAGES)
+        self.clients = {}
+        # Players whose connection dropped; their slot is held until they resume or time out
+        self.detached = set()
+        self.game_state = {
+            'players': {},
+            'ready': 0
+        }
+
+        self.snapshots = snapshot.SnapshotEncoder()
+        self.snapshot_acks = {}
+        # Capturing moves the snapshot seq and baselines on, so only the tick does it;
+        # a change made by a client thread sets this and waits for the next tick
+        self.broadcast_due = False
+        # When each recent snapshot went out (by seq), and each player's oldest input not yet in one
+        self.sent_at = [0.0] * snapshot.HISTORY_SIZE
+        self.input_arrival = [0.0] * (PLAYERS_PER_ROOM + 1)
+        # Each player's actions since the last tick, merged into one that the next tick applies.
+        # Client threads merge into it while the tick thread takes it, so both hold input_lock
+        self.pending_actions = [None] * (PLAYERS_PER_ROOM + 1)
+        self.input_lock = threading.Lock()
+        self.tick_number = 0
+        # Tick whose inputs are being merged; a replay applies them after replaying that tick
+        self.input_tick = 0
+        self.position_history = history.PositionHistory(server.max_rewind_ticks + 1,
+                                                        range(1, PLAYERS_PER_ROOM + 1))
+        self.recorder = None
+        self.spectators = spectator.SpectatorGroup()
+
+        self.match_started = False
+        self.platforms = []
+        self.init_platforms()
+
+    def init_platforms(self):
+        self.platforms = [
+            {'x': 200, 'y': 600, 'width': 600, 'height': 20},
+            {'x': 400, 'y': 300, 'width': 100, 'height': 20},
+            {'x': 600, 'y': 450, 'width': 100, 'height': 20}
+        ]
+        self.game_state['platforms'] = self.platforms
+
+    def is_full(self):
+        return len(self.clients) + len(self.detached) >= PLAYERS_PER_ROOM
+
+    def is_empty(self):
+        return not self.clients and not self.detached
+
+    def free_player_num(self):
+        return next(num for num in range(1, PLAYERS_PER_ROOM + 1)
+                    if num not in self.clients and num not in self.detached)
+
+    def add_player(self, client_socket, player_num=None):
+        if player_num is None:
+            player_num = self.free_player_num()
+        self.logger.info(f'Player num: {player_num}')
+        self.clients[player_num] = client_socket
+        self.logger.info(f'client_socket: {client_socket}')
+
+        # self.game_state[player_num]= client_socket
+        self.game_state['players'][player_num] = {
+            'connected': True,
+            'character': None,
+            'x': 300 if player_num == 1 else 700,
+            'y': 580,
+            'health': 100,
+            'is_dead': False,
+            'is_attacking': False,
+            'is_special_attacking': False,
+            'facing_right': True if player_num == 2 else False,
+            'input_seq': 0
+        }
+
+        return player_num
+
+    def add_spectator(self, viewer):
+        return self.spectators.add(viewer)
+
+    def remove_spectator(self, viewer):
+        self.spectators.remove(viewer)
+
+    def handle_client_data(self, client_socket, player_num, client_data):
+        suppressed = log.message_limit.take() if self.message_logger.isEnabledFor(logging.INFO) else None
+        if suppressed is not None:
+            # Formatted on the log writer thread
+            self.message_logger.info('client data: %s', client_data, extra={'fields': {
+                'room': self.room_id, 'player': player_num, 'suppressed': suppressed}})
+        client_messages.inc()
+        with self.input_lock:
+            # Recorded and merged in one step, so a replay's keyframes hold exactly the inputs recorded before them
+            if self.recorder is not None:
+                self.recorder.input(self.input_tick, player_num, client_data)
+            if 'player_action' in client_data:
+                pending = self.pending_actions[player_num]
+                self.pending_actions[player_num] = inputs.coalesce(pending, client_data['player_action'])
+
+        #if 'action' in client_data:
+            #if client_data['action'] == 'login':
+                #username = client_data.get('username')
+                #password = client_data.get('password')
+                #self.logger.info(f'username: {username}')
+                #self.logger.info(f'password: {password}')
+                #login_result = self.db_handler.authenticate_user(username, password)
+                #self.logger.info(f'login result: {login_result}')
+
+                #client_socket.send(pickle.dumps({
+                    #'status': 'success' if login_result['success'] else 'error',
+                    #'message': login_result['message'],
+                    #'user_data': login_result.get('user_data')
+                #}))
+                #if login_result['success']:
+                    #self.authenticated_users[player_num] = login_result['user_data']
+                #continue
+
+            #elif client_data['action'] == 'register':
+                #username = client_data.get('username')
+                #password = client_data.get('password')
+                #self.logger.info(f'username: {username}')
+                #self.logger.info(f'password: {password}')
+
+                #register_result = self.db_handler.register_new_user(username, password)
+                #self.logger.info(f'register result: {register_result}')
+
+                #client_socket(pickle.dumps({
+                    #'status': 'success' if register_result['success'] else 'error',
+                    #'message': register_result['message']
+                #}))
+                #self.logger.info('einde register')
+                #continue
+
+        if 'player_action' in client_data:
+            if pending is not None:
+                inputs_coalesced.inc()
+            if self.match_started and not self.input_arrival[player_num]:
+                self.input_arrival[player_num] = time.perf_counter()
+
+        if 'player1_character' in client_data or 'player2_character' in client_data:
+            character = None
+            if 'player1_character' in client_data and player_num == 1:
+                character = client_data['player1_character']
+            elif 'player2_character' in client_data and player_num == 2:
+                character = client_data['player2_character']
+
+            if character:
+                self.game_state['players'][player_num]['character'] = character
+                self.logger.info(f'Player {player_num} selected character: {character}')
+
+            self.broadcast_due = True
+
+        if 'ready' in client_data and client_data['ready']:
+            self.game_state['ready'] += 1
+            self.logger.info(f"Player {player_num} is ready. Ready count: {self.game_state['ready']}")
+
+        if 'player_action' in client_data:
+            action = client_data['player_action']
+            player = self.game_state['players'][player_num]
+
+        if 'player_died' in client_data and client_data['player_died']:
+            self.game_state['players'][player_num]['is_dead'] = True
+            self.logger.info(f'Player {player_num} died!')
+
+        if 'snapshot_ack' in client_data:
+            seq = client_data['snapshot_ack']
+            if seq > self.snapshot_acks.get(player_num, 0):
+                self.snapshot_acks[player_num] = seq
+                if 0 <= self.snapshots.seq - seq < len(self.sent_at):
+                    client_rtt.observe(time.perf_counter() - self.sent_at[seq % len(self.sent_at)])
+
+        if 'keyframe_request' in client_data:
+            self.snapshot_acks.pop(player_num, None)
+
+        if 'clock_ping' in client_data:
+            # Answered straight away, so the round trip the client measures holds no tick wait
+            protocol.send_message(client_socket, {'status': 'clock_pong', 'ping': client_data['clock_ping'],
+                                                  'server_time': self.server.scheduler.timeline()})
+
+    def take_inputs(self, tick_number):
+        """Each player's actions merged since the last tick; input from here on is recorded under tick_number."""
+        with self.input_lock:
+            # The tick owns the merged actions from here on; later input starts a new one
+            actions = self.pending_actions
+            self.pending_actions = [None if action is None else inputs.released(action) for action in actions]
+            self.input_tick = tick_number
+        return actions
+
+    def apply_inputs(self, actions=None):
+        """Applies each player's actions since the last tick, however many there were, as one."""
+        if actions is None:
+            actions = self.take_inputs(self.tick_number)
+        for player_num, action in enumerate(actions):
+            if action is None or player_num not in self.game_state['players']:
+                continue
+            self.process_action(player_num, action)
+            if action.get('attack'):
+                self.handle_attack(player_num, action)
+
+    def handle_attack(self, attacker_num, action):
+        if not self.match_started:
+            return
+
+        attacker = self.game_state['players'][attacker_num]
+        defender_num = 1 if attacker_num == 2 else 2
+
+        if defender_num in self.game_state['players']:
+            defender = self.game_state['players'][defender_num]
+
+            # Judge the hit against where the attacker saw the defender, within the rewind window
+            defender_x = defender['x']
+            if action.get('view_tick'):
+                view_tick = max(action['view_tick'], self.tick_number - self.server.max_rewind_ticks)
+                if view_tick <= self.tick_number:
+                    rewound = self.position_history.position(defender_num, view_tick)
+                    if rewound is not None:
+                        defender_x = rewound[0]
+
+            distance = abs(attacker['x'] - defender_x)
+            if distance <= action.get('attack_range', 100):
+                damage = action.get('damage', 10)
+                defender['health'] = max(0, defender['health'] - damage)
+
+                if defender['health'] <= 0:
+                    defender['is_dead'] = True
+                    self.logger.info(f'Player {defender_num} defeated!')
+
+    def process_action(self, player_num, action):
+        player = self.game_state['players'][player_num]
+
+        #if player_num not in self.authenticate_users and self.require_authentication:
+            #self.logger.warning(f'Player {player_num} attempted action without authentication')
+
+        if 'x' in action:
+            player['x'] = action['x']
+        if 'y' in action:
+            player['y'] = action['y']
+
+        if 'facing_right' in action:
+            player['facing_right'] = action['facing_right']
+        if 'is_attacking' in action:
+            player['is_attacking'] = action['is_attacking']
+        if 'is_special_attacking' in action:
+            player['is_special_attacking'] = action['is_special_attacking']
+        # Echoed in snapshots so the client knows which of its predicted inputs are applied
+        if action.get('input_seq', 0) > player['input_seq']:
+            player['input_seq'] = action['input_seq']
+
+    def send_to_all(self, message):
+        data = protocol.encode_message(message)
+        for client_socket in self.clients.values():
+            client_socket.sendall(data)
+        self.spectators.fan_out(data, spectator.FRAME_CONTROL)
+
+    def broadcast_game_state(self):
+        start = time.perf_counter()
+        seq = self.snapshots.capture(self.game_state, self.tick_number)
+        self.sent_at[seq % len(self.sent_at)] = start
+        sent = 0
+        for player_num, client_socket in list(self.clients.items()):
+            try:
+                frame = self.snapshots.frame_for(self.snapshot_acks.get(player_num))
+                client_socket.sendall(frame)
+                sent += len(frame)
+            except Exception as e:
+                self.logger.error(f'Error sending game state: {str(e)}')
+        self.spectators.publish(self.snapshots)
+        end = time.perf_counter()
+        broadcast_seconds.observe(end - start)
+        broadcast_bytes.observe(sent)
+        for player_num, arrival in enumerate(self.input_arrival):
+            if arrival:
+                input_latency.observe(end - arrival)
+                self.input_arrival[player_num] = 0.0
+
+
+    def detach_player(self, player_num):
+        """The player's connection dropped: the match goes on with their input frozen until they resume."""
+        self.logger.info(f'Room {self.room_id}: player {player_num} dropped, holding their slot')
+        client_socket = self.clients.pop(player_num, None)
+        if client_socket is not None:
+            client_socket.close()
+        self.detached.add(player_num)
+        self.snapshot_acks.pop(player_num, None)
+        self.input_arrival[player_num] = 0.0
+        with self.input_lock:
+            self.pending_actions[player_num] = None
+        if player_num in self.game_state['players']:
+            self.game_state['players'][player_num]['connected'] = False
+        self.notify_others(player_num, {'status': 'player_dropped', 'player_num': player_num})
+
+    def attach_player(self, client_socket, player_num):
+        """A resumed session takes its slot back, or a newer connection replaces the one it had."""
+        self.logger.info(f'Room {self.room_id}: player {player_num} resumed')
+        resumed = player_num in self.detached
+        self.detached.discard(player_num)
+        self.clients[player_num] = client_socket
+        if player_num in self.game_state['players']:
+            self.game_state['players'][player_num]['connected'] = True
+        # Whatever the player missed: the match as it is now, then a keyframe on the next broadcast
+        self.snapshot_acks.pop(player_num, None)
+        protocol.send_message(client_socket, {'status': 'match_start' if self.match_started else 'game_state_update',
+                                              'game_state': self.game_state})
+        if resumed:
+            self.notify_others(player_num, {'status': 'player_resumed', 'player_num': player_num})
+
+    def notify_others(self, player_num, message):
+        for other_num, client_socket in list(self.clients.items()):
+            if other_num != player_num:
+                try:
+                    protocol.send_message(client_socket, message)
+                except Exception:
+                    pass
+
+    def handle_disconnect(self, player_num):
+        self.logger.info(f'Room {self.room_id}: player {player_num} disconnected')
+        self.detached.discard(player_num)
+        if player_num in self.clients:
+            try:
+                protocol.send_message(self.clients[player_num], {
+                    'status': 'server_error',
+                    'message': 'Server disconnection occurred'
+                })
+                self.clients[player_num].close()
+            except Exception:
+                pass
+            del self.clients[player_num]
+        self.snapshot_acks.pop(player_num, None)
+        self.input_arrival[player_num] = 0.0
+        with self.input_lock:
+            self.pending_actions[player_num] = None
+
+        if player_num in self.game_state['players']:
+            self.game_state['players'][player_num]['connected'] = False
+
+        other_player = 1 if player_num == 2 else 2
+        if other_player in self.clients:
+            try:
+                protocol.send_message(self.clients[other_player], {
+                    'status': 'server_error',
+                    'message': f'Player {player_num} disconnected'
+                })
+            except Exception:
+                pass
+
+        if self.match_started:
+            self.match_started = False
+            self.game_state['ready'] = 0
+            self.close_replay()
+            self.logger.info(f'Room {self.room_id}: match ended due to player disconnect')
+
+        if self.is_empty():
+            self.reset()
+
+    def close_replay(self, winner=0):
+        if self.recorder is not None:
+            self.recorder.close(self.tick_number, winner)
+            self.recorder = None
+
+    def reset(self):
+        self.close_replay()
+        self.spectators.close({'status': 'server_error', 'message': 'Match closed'})
+        self.game_state = {
+            'players': {},
+            'ready': 0
+        }
+        self.snapshots = snapshot.SnapshotEncoder()
+        self.snapshot_acks = {}
+        self.broadcast_due = False
+        self.detached.clear()
+        self.input_arrival[:] = [0.0] * len(self.input_arrival)
+        with self.input_lock:
+            self.pending_actions = [None] * len(self.pending_actions)
+        self.position_history.clear()
+        self.match_started = False
+        self.init_platforms()
+
+    def tick(self, tick_number=0):
+        # Before the tick number moves on: the inputs arrived during the previous tick
+        self.apply_inputs(self.take_inputs(tick_number))
+        previous_tick, self.tick_number = self.tick_number, tick_number
+        if self.recorder is None and not self.match_started and self.game_state['ready'] >= 2:
+            self.recorder = self.server.open_replay(self)
+        elif self.recorder is not None and tick_number != previous_tick + 1:
+            self.recorder.skip(tick_number, previous_tick)
+        if self.recorder is not None and self.recorder.keyframe_due(tick_number):
+            with self.input_lock:
+                self.recorder.keyframe(tick_number, self)
+        self.position_history.record(tick_number, self.game_state['players'])
+        if not self.match_started and self.game_state['ready'] >= 2:
+            self.logger.info(f'Room {self.room_id}: both players ready, starting match!')
+            self.match_started = True
+            matches_started.inc()
+
+            player1_character = self.game_state['players'][1].get('character')
+            player2_character = self.game_state['players'][2].get('character')
+
+            self.server.record_match_start(self, player1_character, player2_character)
+
+            self.send_to_all({
+                "status": "match_start",
+                "game_state": self.game_state
+            })
+
+        if self.match_started or self.broadcast_due:
+            self.broadcast_due = False
+            self.broadcast_game_state()
+
+        if self.match_started:
+            game_over = False
+            winner = None
+
+            for player_num, player_data in self.game_state['players'].items():
+                if player_data['is_dead']:
+                    game_over = True
+                    winner = 1 if player_num == 2 else 2
+                    break
+
+            if game_over:
+                self.logger.info(f'Room {self.room_id}: game over! Player {winner} wins!')
+                player1_character = self.game_state['players'][1].get('character')
+                player2_character = self.game_state['players'][2].get('character')
+
+                winner_num = winner
+                loser_num = 1 if winner == 2 else 2
+
+                self.server.record_game_over(self, winner)
+
+                self.send_to_all({
+                    "status": 'game_over',
+                    'winner': winner,
+                    'game_state': self.game_state
+                })
+
+                self.match_started = False
+                self.game_state['ready'] = 0
+                self.close_replay(winner)
+
+                for player_num, player in self.game_state['players'].items():
+                    player_x = 300 if player_num == 1 else 700
+                    player.update({'health': 100, 'is_dead': False, 'x': player_x, 'y': 580})
+                self.logger.info('Game reset for new match')
+
+
+class RoomManager:
+    """Admits players into free rooms and keeps track of which rooms need ticking.
+
+    A room waiting for its second player is always filled before an empty
+    room is opened, so two consecutive connections end up in the same match.
+    When every room is taken players wait in the matchmaking queue, and
+    place_queued() seats them as rooms free up.
+    """
+
+    def __init__(self, server, max_rooms, room_class=GameRoom, max_queued=matchmaking.MAX_QUEUED):
+        self.server = server
+        self.max_rooms = max_rooms
+        self.room_class = room_class
+        self.rooms = {}
+        self.open_rooms = OrderedDict()
+        self.idle_rooms = OrderedDict()
+        self.active_rooms = {}
+        self.next_room_id = 1
+        self.queue = matchmaking.MatchQueue()
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+
+    def admit(self, client_socket):
+        with self.lock:
+            # Nobody gets a seat ahead of players already waiting for one
+            if self.queue:
+                return None, None
+            if self.open_rooms:
+                room = next(iter(self.open_rooms.values()))
+            elif self.has_empty_room():
+                room = self.empty_room()
+            else:
+                return None, None
+
+            player_num = room.add_player(client_socket)
+            self.classify(room)
+            return room, player_num
+
+    def has_empty_room(self):
+        return bool(self.idle_rooms) or len(self.rooms) < self.max_rooms
+
+    def empty_room(self):
+        if self.idle_rooms:
+            _, room = self.idle_rooms.popitem()
+            return room
+        room = self.room_class(self.server, self.next_room_id)
+        self.rooms[room.room_id] = room
+        self.next_room_id += 1
+        return room
+
+    def enqueue(self, player, skill=None):
+        """Puts a player who found no seat in the queue; None if the queue is full too."""
+        with self.lock:
+            if len(self.queue) >= self.max_queued:
+                return None
+            return self.queue.push(player, skill)
+
+    def leave_queue(self, ticket):
+        with self.lock:
+            return self.queue.remove(ticket)
+
+    def place_queued(self):
+        """Seats queued players wherever a seat has freed up; returns (ticket, room, player_num) for each.
+
+        A lone player in a room gets whoever has waited longest. An empty room
+        gets the longest-waiting pair within skill tolerance, or the only
+        player waiting; if nobody is close enough yet it stays empty until
+        tolerances widen.
+        """
+        placed = []
+        with self.lock:
+            while self.queue:
+                if self.open_rooms:
+                    room = next(iter(self.open_rooms.values()))
+                    tickets = (self.queue.pop_oldest(),)
+                elif self.has_empty_room():
+                    tickets = self.queue.pop_pair() if len(self.queue) > 1 else (self.queue.pop_oldest(),)
+                    if tickets is None:
+                        break
+                    room = self.empty_room()
+                else:
+                    break
+                for ticket in tickets:
+                    placed.append((ticket, room, room.add_player(ticket.player.connection)))
+                self.classify(room)
+        return placed
+
+    def queue_positions(self):
+        """Queued tickets whose position changed since they were last told, and how many are waiting."""
+        with self.lock:
+            return list(self.queue.changed_positions()), len(self.queue)
+
+    def remove_player(self, room, player_num):
+        with self.lock:
+            room.handle_disconnect(player_num)
+            self.classify(room)
+
+    def detach_player(self, room, player_num):
+        with self.lock:
+            room.detach_player(player_num)
+            self.classify(room)
+
+    def attach_player(self, room, client_socket, player_num):
+        with self.lock:
+            room.attach_player(client_socket, player_num)
+            self.classify(room)
+
+    def classify(self, room):
+        self.open_rooms.pop(room.room_id, None)
+        self.active_rooms.pop(room.room_id, None)
+        self.idle_rooms.pop(room.room_id, None)
+        if room.is_empty():
+            self.idle_rooms[room.room_id] = room
+            return
+        self.active_rooms[room.room_id] = room
+        if not room.is_full():
+            self.open_rooms[room.room_id] = room
+
+    def snapshot_active(self):
+        with self.lock:
+            return list(self.active_rooms.values())
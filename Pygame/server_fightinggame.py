@@ -1,40 +1,92 @@
 import socket
-import pickle
 import threading
 import time
 import logging
 import argparse
 import fightinggame_database_file as db_handler
+import history_fightinggame as history
+import inputs_fightinggame as inputs
+import log_fightinggame as log
+import matchmaking_fightinggame as matchmaking
+import metrics_fightinggame as metrics
+import outbound_fightinggame as outbound
+import protocol_fightinggame as protocol
+import replay_fightinggame as replay
+import room_fightinggame as room_manager
+import session_fightinggame as session
+import spectator_fightinggame as spectator
+import tick_fightinggame as tick_clock
+import timers_fightinggame as timers
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Pokemon Fighting Game Server')
     parser.add_argument('--port', '-p', type=int, default=5555,
                         help='Port to listen on')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio', 'sharded'], default='threaded',
+                        help='Thread per client, one asyncio event loop, or an asyncio front with worker processes')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes in sharded mode (default: one per core)')
+    parser.add_argument('--max-rooms', type=int, default=100,
+                        help='Concurrent 2-player matches hosted by this process')
+    parser.add_argument('--tick-rate', type=int, default=tick_clock.TICK_RATE,
+                        help='Simulation and broadcast ticks per second (e.g. 30, 60, 120)')
+    parser.add_argument('--max-rewind', type=int, default=int(history.MAX_REWIND * 1000),
+                        help='Furthest back in ms an attack is judged against the view its client had')
+    parser.add_argument('--replay-dir', default=replay.REPLAY_DIR,
+                        help='Directory every match is recorded to (empty to disable)')
+    parser.add_argument('--spectator-port', type=int, default=5556,
+                        help='Port read-only spectators connect to (0 to disable)')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='Serve Prometheus metrics on 127.0.0.1 at this port (0 to disable)')
+    parser.add_argument('--metrics-interval', type=float, default=metrics.DUMP_INTERVAL,
+                        help='Seconds between metric dumps to the log (0 to disable)')
+    parser.add_argument('--reconnect-grace', type=float, default=session.RECONNECT_GRACE,
+                        help="Seconds a dropped player's slot is held for them to reconnect (0 to free it at once)")
+    parser.add_argument('--max-queue', type=int, default=matchmaking.MAX_QUEUED,
+                        help='Players waiting for a room before new connections are turned away')
+    log.add_arguments(parser)
     return parser.parse_args()
 
+connections = metrics.counter('fightinggame_connections_total', 'Player connections accepted', result='accepted')
+rejected_connections = metrics.counter('fightinggame_connections_total', 'Player connections turned away because the queue was full',
+                                       result='rejected')
+queued_connections = metrics.counter('fightinggame_connections_total', 'Player connections that waited in the queue for a room',
+                                     result='queued')
+resumed_connections = metrics.counter('fightinggame_connections_total', 'Player connections that took back a held slot',
+                                      result='resumed')
+expired_connections = metrics.counter('fightinggame_connections_total', 'Player connections with an unknown or expired session',
+                                      result='expired')
+rate_limited = metrics.counter('fightinggame_rate_limited_total', 'Players disconnected for sending faster than their budget')
+queue_wait = metrics.histogram('fightinggame_queue_wait_seconds', 'Time a queued player waited for a room',
+                               (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+
 class GameServer:
-    def __init__(self, host='0.0.0.0', port=5555):
-        logging.basicConfig(level=logging.INFO,
-                            format='%(asctime)s [SERVER] %(message)s',
-                            datefmt='%H:%M:%S')
+    def __init__(self, host='0.0.0.0', port=5555, max_rooms=100, tick_rate=tick_clock.TICK_RATE,
+                 max_rewind=history.MAX_REWIND, replay_dir=replay.REPLAY_DIR, spectator_port=None,
+                 metrics_port=None, metrics_interval=metrics.DUMP_INTERVAL, reconnect_grace=session.RECONNECT_GRACE,
+                 max_queued=matchmaking.MAX_QUEUED):
+        log.setup('SERVER')
         self.logger = logging.getLogger('GameServer')
 
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.clients = {}
-        self.logger.info(f'Clients: {self.clients}')
-        self.client_characters = {}
-        self.game_state = {
-            'players': {},
-            'ready': 0
-        }
-
-        self.match_started = False
-        self.platforms = []
-        self.init_platforms()
-        self.logger.info(f'Initializing server on {host}:{port}')
+        self.scheduler = tick_clock.TickScheduler(tick_rate)
+        # Heartbeats and idle timeouts of every connection, run by the tick loop
+        self.timers = timers.TimerWheel()
+        self.max_rewind_ticks = round(max_rewind * tick_rate)
+        self.replay_dir = replay_dir
+        self.spectator_port = spectator_port
+        self.spectator_socket = None
+        self.max_queued = max_queued
+        self.rooms = room_manager.RoomManager(self, max_rooms, max_queued=max_queued)
+        self.sessions = session.SessionTable(self.rooms, self.timers, reconnect_grace)
+        self.metrics_port = metrics_port
+        self.metrics_interval = metrics_interval
+        self.metrics_logger = logging.getLogger('metrics')
+        self.register_metrics()
+        self.logger.info(f'Initializing server on {host}:{port} ({max_rooms} rooms, {tick_rate} Hz)')
 
         self.db_handler = db_handler.ServerDatabaseHandler()
 
@@ -42,316 +94,362 @@ class GameServer:
         #self.require_authentication = True
         #self.authenticated_users = None
 
-    def init_platforms(self):
-        self.platforms = [
-            {'x': 200, 'y': 600, 'width': 600, 'height': 20},
-            {'x': 400, 'y': 300, 'width': 100, 'height': 20},
-            {'x': 600, 'y': 450, 'width': 100, 'height': 20}
-        ]
-        self.game_state['platforms'] = self.platforms
-
     def start(self):
         try:
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(2)
+            self.server_socket.listen(128)
             self.logger.info(f'Server started, listening on {self.host}:{self.port}')
+            self.start_metrics()
+            self.start_matchmaking()
             update_thread = threading.Thread(target=self.update_game_state)
             update_thread.daemon = True
             update_thread.start()
+            if self.spectator_port:
+                self.spectator_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.spectator_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.spectator_socket.bind((self.host, self.spectator_port))
+                self.spectator_socket.listen(128)
+                spectator_thread = threading.Thread(target=self.accept_spectators)
+                spectator_thread.daemon = True
+                spectator_thread.start()
 
-            #while True:
-            client_socket, address = self.server_socket.accept()
-            if len(self.clients)>= 2:
-                self.logger.info(f'Rejected connection from {address} - server full')
-                client_socket.send(pickle.dumps({'status': "error", "message": "Server full"}))
-                client_socket.close()
-                #continue
-            self.logger.info(f'Connection from {address} has been established')
-
-            player_num = len(self.clients) + 1
-            self.logger.info(f'Player num: {player_num}')
-            self.clients[player_num] = client_socket
-            self.logger.info(f'client_socket: {client_socket}')
-
-            # self.game_state[player_num]= client_socket
-            self.game_state['players'][player_num] = {
-                'connected': True,
-                'character': None,
-                'x': 300 if player_num == 1 else 700,
-                'y': 580,
-                'health': 100,
-                'is_dead': False,
-                'is_attacking': False,
-                'is_special_attacking': False,
-                'facing_right': True if player_num == 2 else False
-            }
-
-            client_socket.send(pickle.dumps({'status':'connected', 'player_num': player_num}))
-            client_thread = threading.Thread(target=self.handle_client, args=(client_socket, player_num))
-            client_thread.daemon = True
-            client_thread.start()
+            while True:
+                client_socket, address = self.server_socket.accept()
+                # Every send to this client is queued; only its writer thread ever blocks on it
+                client_socket = outbound.QueuedSocket(client_socket)
+                client_thread = threading.Thread(target=self.serve_client, args=(client_socket, address))
+                client_thread.daemon = True
+                client_thread.start()
 
         except Exception as e:
             self.logger.error(f'Error starting server: {str(e)}')
         finally:
             self.close_server()
 
-    def handle_client(self, client_socket, player_num):
+    def register_metrics(self):
+        # Read when the metrics are collected; nothing on the hot path keeps these up to date
+        metrics.gauge('fightinggame_active_rooms', 'Rooms with at least one player',
+                      lambda: len(self.rooms.active_rooms))
+        metrics.gauge('fightinggame_players', 'Connected players',
+                      lambda: sum(len(room.clients) for room in self.rooms.snapshot_active()))
+        metrics.gauge('fightinggame_players_dropped', 'Players whose slot is held for them to reconnect',
+                      lambda: sum(len(room.detached) for room in self.rooms.snapshot_active()))
+        metrics.gauge('fightinggame_queued_players', 'Players waiting in the matchmaking queue',
+                      lambda: len(self.rooms.queue))
+        metrics.gauge('fightinggame_spectators', 'Connected spectators',
+                      lambda: sum(len(room.spectators) for room in self.rooms.snapshot_active()))
+        metrics.gauge('fightinggame_outbound_backlog_bytes', 'Bytes queued for all players',
+                      lambda: self.outbound_stats()['backlog_bytes'])
+        metrics.gauge('fightinggame_outbound_max_backlog_bytes', 'Largest backlog any connected player has had',
+                      lambda: self.outbound_stats()['max_backlog_bytes'])
+        metrics.gauge('fightinggame_ticks_skipped_total', 'Ticks dropped to catch up after a stall',
+                      self.ticks_skipped, kind='counter')
+        metrics.gauge('fightinggame_timers_pending', 'Heartbeat and timeout timers waiting to fire',
+                      lambda: self.timers.pending)
+
+    def start_metrics(self):
+        if self.metrics_port:
+            metrics.serve(self.metrics_port)
+            self.logger.info(f'Serving metrics on http://127.0.0.1:{self.metrics_port}/metrics')
+        if self.metrics_interval:
+            self.timers.schedule(self.metrics_interval, self.dump_metrics)
+
+    def dump_metrics(self):
+        self.metrics_logger.info('metrics', extra={'fields': metrics.registry.summary()})
+        self.timers.schedule(self.metrics_interval, self.dump_metrics)
+
+    def start_matchmaking(self):
+        self.timers.schedule(matchmaking.MATCH_INTERVAL, self.match_players)
+        self.timers.schedule(matchmaking.POSITION_INTERVAL, self.update_queue_positions)
+
+    def match_players(self):
+        self.sessions.seat_queued(self.welcome_queued)
+        self.timers.schedule(matchmaking.MATCH_INTERVAL, self.match_players)
+
+    def update_queue_positions(self):
+        # Only players whose place moved hear about it
+        self.sessions.update_queued(self.send_queue_position)
+        self.timers.schedule(matchmaking.POSITION_INTERVAL, self.update_queue_positions)
+
+    def register_client(self, client_socket, address, hello):
+        """Seats a new player, or gives a returning one their slot back; None if the connection is turned away.
+
+        With every room taken a new player waits in the matchmaking queue and
+        is only turned away once the queue is full as well.
+        """
+        if hello.get('resume'):
+            return self.resume_client(client_socket, address, hello['resume'])
+        room, player_num = self.rooms.admit(client_socket)
+        if room is None:
+            return self.queue_client(client_socket, address, hello)
+        connections.inc()
+        player = self.sessions.open(room, player_num, client_socket)
+        self.logger.info(f'Connection from {address} has been established (room {room.room_id})')
+
+        protocol.send_message(client_socket, self.connected_message(player))
+        return player
+
+    def queue_client(self, client_socket, address, hello):
+        player = self.sessions.queue(client_socket, hello.get('skill'), self.send_queue_position)
+        if player is None:
+            rejected_connections.inc()
+            self.logger.info(f'Rejected connection from {address} - server full')
+            protocol.send_message(client_socket, {'status': "error", "message": "Server full"})
+            client_socket.close()
+            return None
+        queued_connections.inc()
+        self.logger.info(f'Connection from {address} queued for a room')
+        return player
+
+    def send_queue_position(self, player, position, waiting):
+        protocol.send_message(player.connection, {'status': 'queued', 'position': position, 'waiting': waiting})
+
+    def welcome_queued(self, player, ticket):
+        waited = self.rooms.queue.clock() - ticket.queued_at
+        queue_wait.observe(waited)
+        self.logger.info(f'Player {player.player_num} seated in room {player.room.room_id} '
+                         f'after {waited:.1f}s in the queue')
+        protocol.send_message(player.connection, self.connected_message(player))
+
+    def resume_client(self, client_socket, address, token):
+        def welcome(player):
+            protocol.send_message(client_socket, dict(self.connected_message(player), resumed=True))
+
+        player, previous = self.sessions.resume(token, client_socket, welcome)
+        if player is None:
+            expired_connections.inc()
+            self.logger.info(f'Connection from {address} tried to resume an unknown or expired session')
+            protocol.send_message(client_socket, {'status': 'error', 'message': 'Session expired'})
+            client_socket.close()
+            return None
+        resumed_connections.inc()
+        self.logger.info(f'Connection from {address} resumed player {player.player_num} (room {player.room.room_id})')
+        if previous is not None:
+            # The old connection had not noticed it was dead yet; its handler ends without touching the slot
+            previous.shutdown()
+        return player
+
+    def connected_message(self, player):
+        return {'status': 'connected', 'player_num': player.player_num, 'room_id': player.room.room_id,
+                'tick_rate': self.scheduler.rate, 'session': player.token, 'reconnect_grace': self.sessions.grace}
+
+    def add_spectator(self, client_socket, request):
+        room = spectator.pick_room(self.rooms.rooms, request.get('spectate', 0))
+        if room is None:
+            protocol.send_message(client_socket, {'status': 'error', 'message': 'No such match'})
+            return None, None
+        viewer = spectator.Spectator()
+        protocol.send_message(client_socket, {'status': 'spectating', 'room_id': room.room_id,
+                                              'tick_rate': self.scheduler.rate})
+        if not room.add_spectator(viewer):
+            protocol.send_message(client_socket, {'status': 'error', 'message': 'Too many spectators'})
+            return None, None
+        self.logger.info(f'Room {room.room_id}: spectator joined ({len(room.spectators)} watching)')
+        return room, viewer
+
+    def remove_spectator(self, room, viewer):
+        viewer.close()
+        room.remove_spectator(viewer)
+        self.logger.info(f'Room {room.room_id}: spectator left, {viewer.sent} frames sent, {viewer.dropped} dropped')
+
+    def accept_spectators(self):
+        self.logger.info(f'Accepting spectators on {self.host}:{self.spectator_port}')
+        while True:
+            try:
+                client_socket, address = self.spectator_socket.accept()
+            except OSError:
+                break
+            spectator_thread = threading.Thread(target=self.handle_spectator, args=(client_socket, address))
+            spectator_thread.daemon = True
+            spectator_thread.start()
 
-        heartbeat_thread = threading.Thread(target=self.send_heartbeats, args=(client_socket, player_num))
-        heartbeat_thread.daemon = True
-        heartbeat_thread.start()
-        self.logger.info(f'Client socket: {client_socket}')
+    def handle_spectator(self, client_socket, address):
+        decoder = protocol.FrameDecoder()
+        room = None
+        try:
+            client_socket.settimeout(5)
+            messages = []
+            while not messages:
+                messages = protocol.recv_messages(client_socket, decoder)
+                if messages is None:
+                    return
+            client_socket.settimeout(None)
+            room, viewer = self.add_spectator(client_socket, messages[0])
+            if room is None:
+                return
+
+            sender_thread = threading.Thread(target=self.send_spectator_frames, args=(client_socket, viewer))
+            sender_thread.daemon = True
+            sender_thread.start()
+            # Spectators are read-only; anything they send is ignored until they hang up
+            while not viewer.closed and protocol.recv_messages(client_socket, decoder) is not None:
+                pass
+        except Exception as e:
+            self.logger.info(f'Spectator {address} disconnected: {str(e)}')
+        finally:
+            if room is not None:
+                self.remove_spectator(room, viewer)
+            client_socket.close()
 
+    def send_spectator_frames(self, client_socket, viewer):
+        ready = threading.Event()
+        viewer.wakeup = ready.set
         try:
             while True:
-                data = client_socket.recv(4096)
-                if not data:
+                ready.wait()
+                ready.clear()
+                for frame in viewer.take():
+                    client_socket.sendall(frame)
+                if viewer.closed:
                     break
-                client_data = pickle.loads(data)
-                self.logger.info(f'client data: {client_data}')
-
-                #if 'action' in client_data:
-                    #if client_data['action'] == 'login':
-                        #username = client_data.get('username')
-                        #password = client_data.get('password')
-                        #self.logger.info(f'username: {username}')
-                        #self.logger.info(f'password: {password}')
-                        #login_result = self.db_handler.authenticate_user(username, password)
-                        #self.logger.info(f'login result: {login_result}')
-
-                        #client_socket.send(pickle.dumps({
-                            #'status': 'success' if login_result['success'] else 'error',
-                            #'message': login_result['message'],
-                            #'user_data': login_result.get('user_data')
-                        #}))
-                        #if login_result['success']:
-                            #self.authenticated_users[player_num] = login_result['user_data']
-                        #continue
-
-                    #elif client_data['action'] == 'register':
-                        #username = client_data.get('username')
-                        #password = client_data.get('password')
-                        #self.logger.info(f'username: {username}')
-                        #self.logger.info(f'password: {password}')
-
-                        #register_result = self.db_handler.register_new_user(username, password)
-                        #self.logger.info(f'register result: {register_result}')
-
-                        #client_socket(pickle.dumps({
-                            #'status': 'success' if register_result['success'] else 'error',
-                            #'message': register_result['message']
-                        #}))
-                        #self.logger.info('einde register')
-                        #continue
-
-                if 'player_action' in client_data:
-                    action = client_data['player_action']
-                    self.process_action(player_num, action)
-
-                    if 'attack' in action and action['attack']:
-                        self.handle_attack(player_num, action)
-
-                if 'player1_character' in client_data or 'player2_character' in client_data:
-                    character = None
-                    if 'player1_character' in client_data and player_num == 1:
-                        character = client_data['player1_character']
-                    elif 'player2_character' in client_data and player_num == 2:
-                        character = client_data['player2_character']
-
-                    if character:
-                        self.game_state['players'][player_num]['character'] = character
-                        self.logger.info(f'Player {player_num} selected character: {character}')
-
-                    self.broadcast_game_state()
-
-                if 'ready' in client_data and client_data['ready']:
-                    self.game_state['ready'] += 1
-                    self.logger.info(f"Player {player_num} is ready. Ready count: {self.game_state['ready']}")
-
-                if 'player_action' in client_data:
-                    action = client_data['player_action']
-                    player = self.game_state['players'][player_num]
-
-                if 'player_died' in client_data and client_data['player_died']:
-                    self.game_state['players'][player_num]['is_dead'] = True
-                    self.logger.info(f'Player {player_num} died!')
-
-
-        except Exception as e:
-            self.logger.info(f'Error handling client {player_num}:{str(e)}')
-            try:
-                error_msg = {'status': 'server_error', 'message': f'Server error: {str(e)}'}
-                client_socket.send(pickle.dumps(error_msg))
-            except:
-                pass
+        except OSError:
+            viewer.close()
         finally:
-            self.handle_disconnect(player_num)
-
-    def send_heartbeats(self, client_socket, player_num):
-        while player_num in self.clients:
-            self.logger.info(f'self.clients: {self.clients}')
+            # Unblocks the reading side once the spectator is done with
             try:
-                client_socket.send(pickle.dumps({'status': 'heartbeat'}))
-                self.logger.info(f'client socket: {client_socket}')
-                time.sleep(1)
-            except Exception as e:
-                self.logger.info(f'Heartbeat failed for player{player_num}: {str(e)}')
-                break
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
-    def handle_attack(self, attacker_num, action):
-        if not self.match_started:
+    def serve_client(self, client_socket, address):
+        # The first message says whether this is a new player or one coming back
+        decoder = protocol.FrameDecoder()
+        try:
+            client_socket.socket.settimeout(session.HELLO_TIMEOUT)
+            messages = []
+            while not messages:
+                messages = protocol.recv_messages(client_socket, decoder)
+                if messages is None:
+                    raise ConnectionError('closed before saying hello')
+            client_socket.socket.settimeout(None)
+        except (OSError, protocol.ProtocolError) as e:
+            self.logger.info(f'Dropped connection from {address}: {str(e)}')
+            client_socket.close()
             return
+        player = self.register_client(client_socket, address, messages.pop(0))
+        if player is not None:
+            self.handle_client(client_socket, player, decoder, messages)
 
-        attacker = self.game_state['players'][attacker_num]
-        defender_num = 1 if attacker_num == 2 else 2
-
-        if defender_num in self.game_state['players']:
-            defender = self.game_state['players'][defender_num]
-
-            distance = abs(attacker['x'] - defender['x'])
-            if distance <= action.get('attack_range', 100):
-                damage = action.get('damage', 10)
-                defender['health'] = max(0, defender['health'] - damage)
-
-                if defender['health'] <= 0:
-                    defender['is_dead'] = True
-                    self.logger.info(f'Player {defender_num} defeated!')
-
-    def process_action(self, player_num, action):
-        player = self.game_state['players'][player_num]
-
-        #if player_num not in self.authenticate_users and self.require_authentication:
-            #self.logger.warning(f'Player {player_num} attempted action without authentication')
-
-        if 'x' in action:
-            player['x'] = action['x']
-        if 'y' in action:
-            player['y'] = action['y']
-
-        if 'facing_right' in action:
-            player['facing_right'] = action['facing_right']
-        if 'is_attacking' in action:
-            player['is_attacking'] = action['is_attacking']
-        if 'is_special_attacking' in action:
-            player['is_special_attacking'] = action['is_special_attacking']
-
-    def broadcast_game_state(self):
-        game_state_data = pickle.dumps({"status": "game_state_update", "game_state": self.game_state})
-        for client_socket in self.clients.values():
-            try:
-                client_socket.send(game_state_data)
-            except Exception as e:
-                self.logger.error(f'Error sending game state: {str(e)}')
+    def handle_client(self, client_socket, player, decoder, messages):
+        keepalive = self.start_keepalive(client_socket, player)
+        budget = inputs.TokenBucket()
+        self.logger.info(f'Client socket: {client_socket}')
 
+        try:
+            while True:
+                for client_data in messages:
+                    # Until a queued player is seated there is no room to send anything to
+                    if client_data == protocol.HEARTBEAT or player.room is None:
+                        continue
+                    player.room.handle_client_data(client_socket, player.player_num, client_data)
+                messages = protocol.recv_messages(client_socket, decoder)
+                if messages is None:
+                    break
+                keepalive.received()
+                if not budget.take(len(messages)):
+                    self.over_budget(client_socket, player)
+                    break
 
-    def handle_disconnect(self, player_num):
-        self.logger.info(f'Player {player_num} disconnected')
-        if player_num in self.clients:
+        except Exception as e:
+            self.logger.info(f'Error handling client {player.player_num}:{str(e)}')
             try:
-                self.clients[player_num].send(pickle.dumps({
-                    'status': 'server_error',
-                    'message': 'Server disconnection occurred'
-                }))
-                self.clients[player_num].close()
-            except Exception:
+                error_msg = {'status': 'server_error', 'message': f'Server error: {str(e)}'}
+                protocol.send_message(client_socket, error_msg)
+            except:
                 pass
-            del self.clients[player_num]
+        finally:
+            keepalive.stop()
+            self.sessions.drop(player, client_socket)
+            self.logger.info(f'Player {player.player_num} outbound: {outbound.describe(client_socket.queue.stats())}, '
+                             f'{keepalive.heartbeats} heartbeats')
 
-        if player_num in self.game_state['players']:
-            self.game_state['players'][player_num]['connected'] = False
+    def over_budget(self, client_socket, player):
+        rate_limited.inc()
+        self.logger.info(f'Player {player.player_num} sent more than {inputs.MESSAGE_RATE:.0f} messages/s, disconnecting')
+        protocol.send_message(client_socket, {'status': 'server_error', 'message': 'Disconnected: too many messages'})
 
-        other_player = 1 if player_num == 2 else 2
-        if other_player in self.clients:
-            try:
-                self.clients[other_player].send(pickle.dumps({
-                    'status': 'server_error',
-                    'message': f'Player {player_num} disconnected'
-                }))
-            except Exception:
-                pass
+    def start_keepalive(self, client_socket, player):
+        def on_idle(idle):
+            self.logger.info(f'Player {player.player_num} sent nothing for {idle:.1f}s, disconnecting')
+            # The client's own thread or task sees the connection end and cleans up
+            client_socket.shutdown()
 
-        if self.match_started:
-            self.match_started = False
-            self.game_state['ready'] = 0
-            self.logger.info('Match ended due to player disconnect')
+        return timers.Keepalive(self.timers, client_socket, on_idle)
 
     def update_game_state(self):
+        self.scheduler.restart()
         while True:
-            if not self.match_started and self.game_state['ready'] >= 2:
-                self.logger.info('Both players ready, starting match!')
-                self.match_started = True
-
-                player1_character = self.game_state['players'][1].get('character')
-                player2_character = self.game_state['players'][2].get('character')
-
-                if player1_character and player2_character:
-                    success = self.db_handler.save_character_selection(player1_character, player2_character)
-                    self.logger.info(f'Character selection saved to database: {success}')
-
-                if 1 in self.game_state['players'] and 2 in self.game_state['players']:
-                    player1_character = self.game_state['players'][1].get('character')
-                    player2_character = self.game_state['players'][2].get('character')
+            time.sleep(self.scheduler.delay())
+            self.scheduler.run_due(self.tick)
 
-                    if player1_character:
-                        self.db_handler.db.save_player_selection(player1_character, player2_character)
+    def tick(self, tick_number):
+        with outbound.held_wakeups():
+            start = time.perf_counter()
+            for room in self.rooms.snapshot_active():
+                try:
+                    room.tick(tick_number)
+                except Exception as e:
+                    self.logger.error(f'Error ticking room {room.room_id}: {str(e)}')
+            room_manager.tick_seconds.observe(time.perf_counter() - start)
+            self.timers.run_due()
 
-                for client_socket in self.clients.values():
-                    client_socket.send(pickle.dumps({
-                        "status": "match_start",
-                        "game_state": self.game_state
-                    }))
+    def ticks_skipped(self):
+        return self.scheduler.skipped
 
-            if self.match_started:
-                self.broadcast_game_state()
-                game_over = False
-                winner = None
+    def outbound_stats(self):
+        return outbound.summarize(client_socket.queue for room in self.rooms.snapshot_active()
+                                  for client_socket in list(room.clients.values()))
 
-                for player_num, player_data in self.game_state['players'].items():
-                    if player_data['is_dead']:
-                        game_over = True
-                        winner = 1 if player_num == 2 else 2
-                        break
+    def record_match_start(self, room, player1_character, player2_character):
+        if player1_character and player2_character:
+            success = self.db_handler.save_character_selection(player1_character, player2_character)
+            self.logger.info(f'Character selection saved to database: {success}')
 
-                if game_over:
-                    self.logger.info(f'Game_over! Player {winner} wins!')
-                    player1_character = self.game_state['players'][1].get('character')
-                    player2_character = self.game_state['players'][2].get('character')
+        if player1_character:
+            self.db_handler.save_player_selection(player1_character, player2_character)
 
-                    winner_num = winner
-                    loser_num = 1 if winner == 2 else 2
+    def record_game_over(self, room, winner):
+        self.db_handler.handle_game_over(room.game_state, winner)
 
-                    self.db_handler.handle_game_over(self.game_state, winner)
-
-                    for client_socket in self.clients.values():
-                        client_socket.send(pickle.dumps({
-                            "status": 'game_over',
-                            'winner': winner,
-                            'game_state': self.game_state
-                        }))
-
-                    self.match_started = False
-                    self.game_state['ready'] = 0
-
-                    for player_num, player in self.game_state['players'].items():
-                        player_x = 300 if player_num == 1 else 700
-                        player.update({'health': 100, 'is_dead': False, 'x': player_x, 'y': 580})
-                    self.logger.info('Game reset for new match')
-
-            time.sleep(0.05)
+    def open_replay(self, room):
+        return replay.open_recorder(self.replay_dir, room, self.scheduler.rate, self.logger)
 
     def close_server(self):
         self.logger.info('Closing server')
-        for client_socket in self.clients.values():
-            try:
-                client_socket.close()
-            except Exception:
-                pass
+        for room in self.rooms.snapshot_active():
+            for client_socket in list(room.clients.values()):
+                try:
+                    client_socket.close()
+                except Exception:
+                    pass
+        if self.spectator_socket is not None:
+            self.spectator_socket.close()
         self.server_socket.close()
 
 def main():
     args = parse_arguments()
-    server = GameServer(port=args.port)
+    log.setup('SERVER', args.log_level, args.log_format)
+    max_rewind = args.max_rewind / 1000
+    if args.mode == 'sharded':
+        from shard_fightinggame import ShardedGameServer
+        server = ShardedGameServer(port=args.port, max_rooms=args.max_rooms, tick_rate=args.tick_rate,
+                                   max_rewind=max_rewind, replay_dir=args.replay_dir,
+                                   spectator_port=args.spectator_port, metrics_port=args.metrics_port,
+                                   metrics_interval=args.metrics_interval, reconnect_grace=args.reconnect_grace,
+                                   max_queued=args.max_queue, workers=args.workers)
+    elif args.mode == 'asyncio':
+        from async_server_fightinggame import AsyncGameServer
+        server = AsyncGameServer(port=args.port, max_rooms=args.max_rooms, tick_rate=args.tick_rate,
+                                 max_rewind=max_rewind, replay_dir=args.replay_dir,
+                                 spectator_port=args.spectator_port, metrics_port=args.metrics_port,
+                                 metrics_interval=args.metrics_interval, reconnect_grace=args.reconnect_grace,
+                                 max_queued=args.max_queue)
+    else:
+        server = GameServer(port=args.port, max_rooms=args.max_rooms, tick_rate=args.tick_rate,
+                            max_rewind=max_rewind, replay_dir=args.replay_dir,
+                            spectator_port=args.spectator_port, metrics_port=args.metrics_port,
+                            metrics_interval=args.metrics_interval, reconnect_grace=args.reconnect_grace,
+                            max_queued=args.max_queue)
     server.start()
 
 #def add_auth_handling_to_server(server):
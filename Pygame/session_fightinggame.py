@@ -0,0 +1,137 @@
+import secrets
+import threading
+
+# Seconds a dropped player's slot is held for them to reconnect (0 frees it at once)
+RECONNECT_GRACE = 15.0
+# Seconds a new connection has to say whether it joins or resumes
+HELLO_TIMEOUT = 5.0
+# Client backoff between reconnect attempts, doubling up to the maximum
+RECONNECT_DELAY = 0.25
+MAX_RECONNECT_DELAY = 2.0
+
+# The first message of every player connection: a fresh join, or {'resume': token}
+JOIN = {'join': True}
+
+
+class Session:
+    """One player slot, reclaimable by whoever presents its token.
+
+    A player still waiting in the matchmaking queue has no room yet, only its ticket.
+    """
+    __slots__ = ('token', 'room', 'player_num', 'connection', 'timer', 'ticket')
+
+    def __init__(self, token, room, player_num, connection):
+        self.token = token
+        self.room = room
+        self.player_num = player_num
+        self.connection = connection
+        self.timer = None
+        self.ticket = None
+
+
+class SessionTable:
+    """Every player slot by the token handed out on connect.
+
+    When a connection drops its slot is detached from the room instead of
+    freed, and a timer on the server's wheel frees it if nobody resumes the
+    session within the grace period. The lock is held across the room change
+    that goes with each step, so a reconnect can never be undone by the drop
+    it is racing with.
+    """
+
+    def __init__(self, rooms, timers, grace=RECONNECT_GRACE):
+        self.rooms = rooms
+        self.timers = timers
+        self.grace = grace
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def open(self, room, player_num, connection):
+        session = Session(secrets.token_hex(16), room, player_num, connection)
+        with self.lock:
+            self.sessions[session.token] = session
+        return session
+
+    def queue(self, connection, skill, notify):
+        """Opens a session that waits in the matchmaking queue for a seat; None if the queue is full.
+
+        notify(session, position, waiting) tells the player its place before
+        it can possibly be seated.
+        """
+        session = Session(secrets.token_hex(16), None, None, connection)
+        with self.lock:
+            session.ticket = self.rooms.enqueue(session, skill)
+            if session.ticket is None:
+                return None
+            self.sessions[session.token] = session
+            notify(session, session.ticket.position, len(self.rooms.queue))
+        return session
+
+    def update_queued(self, notify):
+        """notify(session, position, waiting) for every queued player whose place has moved."""
+        with self.lock:
+            tickets, waiting = self.rooms.queue_positions()
+            for ticket in tickets:
+                notify(ticket.player, ticket.position, waiting)
+
+    def seat_queued(self, welcome):
+        """Gives queued players the seats that freed up; welcome(session, ticket) tells each one where it sits.
+
+        Under the lock, so a player leaving the queue either goes before it
+        is seated or drops a seated player like any other.
+        """
+        with self.lock:
+            placed = self.rooms.place_queued()
+            for ticket, room, player_num in placed:
+                session = ticket.player
+                session.room, session.player_num, session.ticket = room, player_num, None
+                welcome(session, ticket)
+        return len(placed)
+
+    def resume(self, token, connection, welcome):
+        """Moves the session to `connection`; returns it and the connection it had, or (None, None).
+
+        welcome(session) is called first, so its reply reaches the client
+        before the room's catch-up state. Queued sessions have no slot to
+        take back and are not resumable.
+        """
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is None or session.room is None:
+                return None, None
+            if session.timer is not None:
+                session.timer.cancel()
+                session.timer = None
+            previous, session.connection = session.connection, connection
+            welcome(session)
+            self.rooms.attach_player(session.room, connection, session.player_num)
+        return session, previous
+
+    def drop(self, session, connection):
+        """The connection of a session ended. Does nothing if the session already moved on to another one."""
+        with self.lock:
+            if session.connection is not connection:
+                return
+            session.connection = None
+            if session.room is None:
+                # Still queued: the place in the queue is not held
+                del self.sessions[session.token]
+                self.rooms.leave_queue(session.ticket)
+            elif self.grace:
+                self.rooms.detach_player(session.room, session.player_num)
+                session.timer = self.timers.schedule(self.grace, lambda: self.expire(session))
+            else:
+                del self.sessions[session.token]
+                self.rooms.remove_player(session.room, session.player_num)
+
+    def expire(self, session):
+        with self.lock:
+            if session.connection is not None or self.sessions.get(session.token) is not session:
+                return
+            del self.sessions[session.token]
+            session.room.logger.info(f'Room {session.room.room_id}: player {session.player_num} '
+                                     f'did not reconnect within {self.grace:.0f}s')
+            self.rooms.remove_player(session.room, session.player_num)
+
+    def __len__(self):
+        return len(self.sessions)
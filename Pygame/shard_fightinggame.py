@@ -0,0 +1,534 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+
+import fightinggame_database_file as db_handler
+import history_fightinggame as history
+import log_fightinggame as log
+import matchmaking_fightinggame as matchmaking
+import metrics_fightinggame as metrics
+import protocol_fightinggame as protocol
+import replay_fightinggame as replay
+import room_fightinggame as room_manager
+import session_fightinggame as session
+import spectator_fightinggame as spectator
+import tick_fightinggame as tick_clock
+import timers_fightinggame as timers
+from async_server_fightinggame import AsyncGameServer
+
+# Everything crossing the front/worker pipes is a batch of binary records:
+#   op (u8) | room id (u32) | player num (u8) | payload length (u32) | payload
+# Client inputs and snapshots travel as the protocol frames they already are.
+RECORD = struct.Struct('!BIBI')
+
+OP_JOIN = 1        # front -> worker: new player in a room
+OP_LEAVE = 2       # front -> worker: player disconnected
+OP_INPUT = 3       # front -> worker: message type byte + protocol payload
+OP_RESTORE = 4     # front -> worker: re-home a room from its last checkpoint
+OP_ATTACH = 5      # front -> worker: reconnect a restored room's player without resetting it
+OP_SEND = 6        # worker -> front: encoded frame for one client
+OP_CLOSE = 7       # worker -> front: close one client's socket
+OP_CHECKPOINT = 8  # worker -> front: match_started byte + keyframe frame of the room
+OP_WATCH = 9       # front -> worker: the room has spectators, send them a keyframe next
+OP_UNWATCH = 10    # front -> worker: the room's last spectator left
+OP_SPECTATE = 11   # worker -> front: frame for all spectators of a room; player num is the frame kind
+OP_DETACH = 12     # front -> worker: player's connection dropped, hold their slot
+OP_RESUME = 13     # front -> worker: player is back on a new connection, send them the match as it is
+OP_STATS = 14      # worker -> front: ticks the worker has skipped so far; room id and player num are 0
+STATS = struct.Struct('!Q')
+
+# Seconds between checkpoints of a room
+CHECKPOINT_INTERVAL = 1.0
+SUPERVISOR_INTERVAL = 1.0
+# Batches a worker reads from its pipe before it checks whether a tick is due
+MAX_BATCHES_PER_PASS = 64
+
+
+def pack_record(op, room_id, player_num=0, payload=b''):
+    return RECORD.pack(op, room_id, player_num, len(payload)) + payload
+
+
+def iter_records(data):
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        op, room_id, player_num, length = RECORD.unpack_from(view, offset)
+        offset += RECORD.size
+        yield op, room_id, player_num, bytes(view[offset:offset + length])
+        offset += length
+
+
+def encode_checkpoint(room):
+    keyframe = protocol.encode_message({'status': 'game_state_update', 'game_state': room.game_state})
+    return bytes((room.match_started,)) + keyframe
+
+
+def decode_checkpoint(payload):
+    match_started = bool(payload[0])
+    message = protocol.FrameDecoder().feed(payload[1:])[0]
+    return match_started, message['game_state']
+
+
+class WorkerClient:
+    """Stands in for a client socket inside a worker; writes are queued for the front process."""
+
+    def __init__(self, worker, room_id, player_num):
+        self.worker = worker
+        self.room_id = room_id
+        self.player_num = player_num
+
+    def sendall(self, data):
+        self.worker.outbox.append(pack_record(OP_SEND, self.room_id, self.player_num, data))
+
+    def close(self):
+        self.worker.outbox.append(pack_record(OP_CLOSE, self.room_id, self.player_num))
+
+
+class SpectatorRelay:
+    """Stands in for all spectators of a room inside a worker; the front fans each frame out."""
+
+    def __init__(self, worker, room_id):
+        self.worker = worker
+        self.room_id = room_id
+        self.needs_keyframe = True
+        self.closed = False
+        self.dropped = 0
+
+    def push(self, frame, kind=spectator.FRAME_DELTA):
+        if kind == spectator.FRAME_DELTA and self.needs_keyframe:
+            return
+        if kind == spectator.FRAME_KEYFRAME:
+            self.needs_keyframe = False
+        self.worker.outbox.append(pack_record(OP_SPECTATE, self.room_id, kind, frame))
+
+    def close(self):
+        pass
+
+
+class ShardWorker:
+    """Runs the simulation of a subset of rooms in its own process and interpreter."""
+
+    def __init__(self, conn, worker_id, tick_rate=tick_clock.TICK_RATE, use_database=True,
+                 max_rewind=history.MAX_REWIND, replay_dir=None, log_options=None,
+                 metrics_interval=metrics.DUMP_INTERVAL):
+        # A spawned process starts with no logging set up; use the front's settings
+        log.setup(f'WORKER {worker_id}', *(log_options or ()))
+        self.logger = logging.getLogger(f'ShardWorker{worker_id}')
+        self.conn = conn
+        self.worker_id = worker_id
+        # Without a tick rate the worker ticks as fast as it can (benchmarks)
+        self.scheduler = tick_clock.TickScheduler(tick_rate) if tick_rate else None
+        self.checkpoint_ticks = max(1, round(CHECKPOINT_INTERVAL * (tick_rate or tick_clock.TICK_RATE)))
+        self.max_rewind_ticks = round(max_rewind * (tick_rate or tick_clock.TICK_RATE))
+        self.replay_dir = replay_dir
+        # Workers have no metrics endpoint of their own; they dump to their log every so many ticks
+        self.metrics_ticks = round(metrics_interval * (tick_rate or tick_clock.TICK_RATE))
+        self.metrics_logger = logging.getLogger('metrics')
+        self.db_handler = db_handler.ServerDatabaseHandler() if use_database else None
+        self.rooms = {}
+        self.relays = {}
+        self.outbox = []
+        self.ticks = 0
+
+    def run(self):
+        try:
+            while True:
+                # Waits for input at most until the next tick is due, then stops
+                # reading after a bounded batch so a busy front never starves the tick
+                timeout = self.scheduler.delay() if self.scheduler else 0
+                for _ in range(MAX_BATCHES_PER_PASS):
+                    if not self.conn.poll(timeout):
+                        break
+                    self.apply(self.conn.recv_bytes())
+                    timeout = 0
+                # Direct replies such as clock pongs must not wait for the tick
+                self.flush()
+                if self.scheduler:
+                    self.scheduler.run_due(self.tick)
+                else:
+                    self.tick(self.ticks + 1)
+        except (EOFError, BrokenPipeError, ConnectionResetError):
+            self.logger.info('Front process went away, worker exiting')
+
+    def room(self, room_id):
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = room_manager.GameRoom(self, room_id)
+            self.rooms[room_id] = room
+        return room
+
+    def apply(self, data):
+        for op, room_id, player_num, payload in iter_records(data):
+            if op == OP_JOIN:
+                self.room(room_id).add_player(WorkerClient(self, room_id, player_num), player_num)
+            elif op == OP_ATTACH:
+                self.room(room_id).clients[player_num] = WorkerClient(self, room_id, player_num)
+            elif op == OP_INPUT:
+                room = self.rooms.get(room_id)
+                if room is not None and player_num in room.clients:
+                    try:
+                        client_data = protocol.decode_payload(payload[0], payload[1:])
+                    except protocol.ProtocolError as e:
+                        # The front hands the frame over undecoded; it drops the connection on OP_CLOSE
+                        self.logger.info(f'Room {room_id}: dropping player {player_num}: {str(e)}')
+                        room.clients[player_num].close()
+                        continue
+                    room.handle_client_data(room.clients[player_num], player_num, client_data)
+            elif op == OP_DETACH:
+                room = self.rooms.get(room_id)
+                if room is not None:
+                    # Closing the stand-in would send OP_CLOSE, which could reach the player's next connection
+                    room.clients.pop(player_num, None)
+                    room.detach_player(player_num)
+            elif op == OP_RESUME:
+                self.room(room_id).attach_player(WorkerClient(self, room_id, player_num), player_num)
+            elif op == OP_LEAVE:
+                room = self.rooms.get(room_id)
+                if room is not None:
+                    room.handle_disconnect(player_num)
+                    if room.is_empty():
+                        del self.rooms[room_id]
+                        self.relays.pop(room_id, None)
+            elif op == OP_WATCH:
+                relay = self.relays.get(room_id)
+                if relay is None:
+                    relay = SpectatorRelay(self, room_id)
+                    self.relays[room_id] = relay
+                    self.room(room_id).add_spectator(relay)
+                relay.needs_keyframe = True
+            elif op == OP_UNWATCH:
+                relay = self.relays.pop(room_id, None)
+                if relay is not None and room_id in self.rooms:
+                    self.rooms[room_id].remove_spectator(relay)
+            elif op == OP_RESTORE:
+                room = self.room(room_id)
+                room.match_started, room.game_state = decode_checkpoint(payload)
+                room.platforms = room.game_state['platforms']
+                self.logger.info(f'Room {room_id} re-homed on worker {self.worker_id}')
+
+    def tick(self, tick_number):
+        self.ticks = tick_number
+        checkpoint = tick_number % self.checkpoint_ticks == 0
+        start = time.perf_counter()
+        for room_id, room in self.rooms.items():
+            try:
+                room.tick(tick_number)
+            except Exception as e:
+                self.logger.error(f'Error ticking room {room_id}: {str(e)}')
+            if checkpoint:
+                self.outbox.append(pack_record(OP_CHECKPOINT, room_id, 0, encode_checkpoint(room)))
+        if checkpoint and self.scheduler:
+            self.outbox.append(pack_record(OP_STATS, 0, 0, STATS.pack(self.scheduler.skipped)))
+        room_manager.tick_seconds.observe(time.perf_counter() - start)
+        if self.metrics_ticks and tick_number % self.metrics_ticks == 0:
+            self.metrics_logger.info('metrics', extra={'fields': metrics.registry.summary()})
+        self.flush()
+
+    def flush(self):
+        if self.outbox:
+            self.conn.send_bytes(b''.join(self.outbox))
+            self.outbox = []
+
+    def record_match_start(self, room, player1_character, player2_character):
+        if self.db_handler is None:
+            return
+        if player1_character and player2_character:
+            success = self.db_handler.save_character_selection(player1_character, player2_character)
+            self.logger.info(f'Character selection saved to database: {success}')
+
+        if player1_character:
+            self.db_handler.save_player_selection(player1_character, player2_character)
+
+    def record_game_over(self, room, winner):
+        if self.db_handler is not None:
+            self.db_handler.handle_game_over(room.game_state, winner)
+
+    def open_replay(self, room):
+        return replay.open_recorder(self.replay_dir, room, self.scheduler.rate if self.scheduler else 0, self.logger)
+
+
+def run_worker(conn, worker_id, tick_rate=tick_clock.TICK_RATE, use_database=True, max_rewind=history.MAX_REWIND,
+               replay_dir=None, log_options=None, metrics_interval=metrics.DUMP_INTERVAL):
+    ShardWorker(conn, worker_id, tick_rate, use_database, max_rewind, replay_dir, log_options,
+                metrics_interval).run()
+
+
+class WorkerHandle:
+    """The front's end of one worker's pipe.
+
+    A worker blocks writing to a full pipe and reads nothing until the front
+    drains it, so the event loop must never block writing to the worker in
+    turn: batches go to a writer thread and the loop only ever reads.
+    """
+
+    def __init__(self, worker_id, process, conn, logger):
+        self.worker_id = worker_id
+        self.process = process
+        self.conn = conn
+        self.logger = logger
+        self.room_ids = set()
+        self.pending = []
+        # As last reported by the worker
+        self.ticks_skipped = 0
+        # Batches for the writer thread; None stops it
+        self.outgoing = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.write_batches, name=f'worker{worker_id}-writer', daemon=True)
+        self.writer.start()
+
+    def send(self, data):
+        self.outgoing.put(data)
+
+    def write_batches(self):
+        while True:
+            data = self.outgoing.get()
+            if data is None:
+                return
+            try:
+                self.conn.send_bytes(data)
+            except (BrokenPipeError, OSError) as e:
+                # The supervisor restarts the worker; until then its batches are dropped
+                self.logger.error(f'Worker {self.worker_id} unreachable: {str(e)}')
+                return
+
+    def stop(self):
+        """Ends the writer thread; the pipe must stay open until this returns."""
+        self.outgoing.put(None)
+        self.writer.join()
+
+
+class RemoteRoom:
+    """Front-process stand-in for a room whose simulation runs in a worker."""
+
+    def __init__(self, server, room_id):
+        self.server = server
+        self.room_id = room_id
+        self.logger = server.logger
+        self.clients = {}
+        self.detached = set()
+        self.checkpoint = None
+        self.spectators = spectator.SpectatorGroup()
+        self.keyframe_requested = False
+        self.worker = server.assign_worker(self)
+
+    def is_full(self):
+        return len(self.clients) + len(self.detached) >= room_manager.PLAYERS_PER_ROOM
+
+    def is_empty(self):
+        return not self.clients and not self.detached
+
+    def free_player_num(self):
+        return next(num for num in range(1, room_manager.PLAYERS_PER_ROOM + 1)
+                    if num not in self.clients and num not in self.detached)
+
+    def add_player(self, client_socket, player_num=None):
+        if player_num is None:
+            player_num = self.free_player_num()
+        self.clients[player_num] = client_socket
+        self.server.send_to_worker(self.worker, pack_record(OP_JOIN, self.room_id, player_num))
+        return player_num
+
+    def add_spectator(self, viewer):
+        if not self.spectators.add(viewer):
+            return False
+        self.request_keyframe()
+        return True
+
+    def remove_spectator(self, viewer):
+        self.spectators.remove(viewer)
+        if not len(self.spectators) and not self.is_empty():
+            self.server.send_to_worker(self.worker, pack_record(OP_UNWATCH, self.room_id))
+
+    def request_keyframe(self):
+        self.keyframe_requested = True
+        self.server.send_to_worker(self.worker, pack_record(OP_WATCH, self.room_id))
+
+    def spectate(self, frame, kind):
+        self.spectators.fan_out(frame, kind)
+        if kind == spectator.FRAME_KEYFRAME:
+            self.keyframe_requested = False
+        elif not self.keyframe_requested and self.spectators.needs_keyframe():
+            # Someone fell behind and lost their queue
+            self.request_keyframe()
+
+    def forward(self, player_num, message_type, payload):
+        self.server.send_to_worker(self.worker, pack_record(OP_INPUT, self.room_id, player_num,
+                                                            bytes((message_type,)) + payload))
+
+    def detach_player(self, player_num):
+        self.logger.info(f'Room {self.room_id}: player {player_num} dropped, holding their slot')
+        client_socket = self.clients.pop(player_num, None)
+        self.detached.add(player_num)
+        self.server.send_to_worker(self.worker, pack_record(OP_DETACH, self.room_id, player_num))
+        if client_socket is not None:
+            client_socket.close()
+
+    def attach_player(self, client_socket, player_num):
+        self.logger.info(f'Room {self.room_id}: player {player_num} resumed')
+        self.detached.discard(player_num)
+        self.clients[player_num] = client_socket
+        self.server.send_to_worker(self.worker, pack_record(OP_RESUME, self.room_id, player_num))
+
+    def handle_disconnect(self, player_num):
+        self.logger.info(f'Room {self.room_id}: player {player_num} disconnected')
+        self.detached.discard(player_num)
+        client_socket = self.clients.pop(player_num, None)
+        self.server.send_to_worker(self.worker, pack_record(OP_LEAVE, self.room_id, player_num))
+        if client_socket is not None:
+            client_socket.close()
+        if self.is_empty():
+            self.checkpoint = None
+            self.spectators.close({'status': 'server_error', 'message': 'Match closed'})
+
+    def tick(self):
+        # Simulation happens in the worker; the front only routes bytes
+        pass
+
+
+class ShardedGameServer(AsyncGameServer):
+    """Front process that owns every socket and shards rooms across worker processes.
+
+    The front runs the asyncio accept/read/heartbeat loop and routes frames;
+    each worker ticks its own rooms on its own core. A supervisor restarts
+    crashed workers and re-homes their rooms from the last checkpoint.
+    """
+
+    def __init__(self, host='0.0.0.0', port=5555, max_rooms=100, tick_rate=tick_clock.TICK_RATE,
+                 max_rewind=history.MAX_REWIND, replay_dir=replay.REPLAY_DIR, spectator_port=None,
+                 metrics_port=None, metrics_interval=metrics.DUMP_INTERVAL, reconnect_grace=session.RECONNECT_GRACE,
+                 max_queued=matchmaking.MAX_QUEUED, workers=None):
+        super().__init__(host, port, max_rooms, tick_rate, max_rewind, replay_dir, spectator_port,
+                         metrics_port, metrics_interval, reconnect_grace, max_queued)
+        self.max_rewind = max_rewind
+        self.rooms = room_manager.RoomManager(self, max_rooms, room_class=RemoteRoom, max_queued=max_queued)
+        self.sessions = session.SessionTable(self.rooms, self.timers, reconnect_grace)
+        self.workers = [None] * (workers or os.cpu_count() or 1)
+        # Skipped ticks of workers that have since died, so the total never goes down
+        self.dead_workers_ticks_skipped = 0
+        # A forked worker would inherit every client socket and the other
+        # workers' pipes, keeping connections and orphaned workers alive
+        self.process_context = multiprocessing.get_context('spawn')
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        for worker_id in range(len(self.workers)):
+            self.start_worker(worker_id)
+        await super().serve()
+
+    def start_worker(self, worker_id):
+        front_conn, worker_conn = self.process_context.Pipe()
+        process = self.process_context.Process(target=run_worker, daemon=True,
+                                               args=(worker_conn, worker_id, self.scheduler.rate, True,
+                                                     self.max_rewind, self.replay_dir, log.options,
+                                                     self.metrics_interval))
+        process.start()
+        worker_conn.close()
+        self.workers[worker_id] = WorkerHandle(worker_id, process, front_conn, self.logger)
+        self.loop.add_reader(front_conn.fileno(), self.read_worker, worker_id)
+        self.logger.info(f'Worker {worker_id} started (pid {process.pid})')
+
+    def assign_worker(self, room):
+        handle = min((handle for handle in self.workers if handle is not None),
+                     key=lambda handle: len(handle.room_ids))
+        handle.room_ids.add(room.room_id)
+        return handle.worker_id
+
+    def send_to_worker(self, worker_id, record):
+        handle = self.workers[worker_id]
+        if not handle.pending:
+            self.loop.call_soon(self.flush_worker, handle)
+        handle.pending.append(record)
+
+    def flush_worker(self, handle):
+        handle.send(b''.join(handle.pending))
+        handle.pending = []
+
+    def handle_frame(self, client_socket, room, player_num, message_type, payload):
+        room.forward(player_num, message_type, payload)
+
+    def read_worker(self, worker_id):
+        handle = self.workers[worker_id]
+        try:
+            data = handle.conn.recv_bytes()
+        except (EOFError, OSError):
+            self.loop.remove_reader(handle.conn.fileno())
+            return
+
+        for op, room_id, player_num, payload in iter_records(data):
+            if op == OP_STATS:
+                handle.ticks_skipped = STATS.unpack(payload)[0]
+                continue
+            room = self.rooms.rooms.get(room_id)
+            if room is None:
+                continue
+            if op == OP_CHECKPOINT:
+                room.checkpoint = payload
+                continue
+            if op == OP_SPECTATE:
+                room.spectate(payload, player_num)
+                continue
+            client_socket = room.clients.get(player_num)
+            if client_socket is None:
+                continue
+            if op == OP_SEND:
+                client_socket.sendall(payload)
+            elif op == OP_CLOSE:
+                client_socket.close()
+
+    def ticks_skipped(self):
+        # The front's own scheduler never runs; the rooms' ticks are the workers'
+        return self.dead_workers_ticks_skipped + sum(handle.ticks_skipped for handle in self.workers
+                                                     if handle is not None)
+
+    async def update_game_state(self):
+        # Rooms tick inside the workers; the front's periodic jobs are the
+        # connection timers and supervision
+        next_check = self.loop.time() + SUPERVISOR_INTERVAL
+        while True:
+            await asyncio.sleep(timers.SLOT_WIDTH)
+            self.timers.run_due()
+            if self.loop.time() < next_check:
+                continue
+            next_check += SUPERVISOR_INTERVAL
+            for worker_id, handle in enumerate(self.workers):
+                if not handle.process.is_alive():
+                    self.restart_worker(worker_id)
+
+    def restart_worker(self, worker_id):
+        handle = self.workers[worker_id]
+        self.logger.error(f'Worker {worker_id} died (exit code {handle.process.exitcode}), restarting')
+        self.dead_workers_ticks_skipped += handle.ticks_skipped
+        # The dead worker's end is closed, so whatever is still queued fails fast
+        handle.stop()
+        try:
+            self.loop.remove_reader(handle.conn.fileno())
+            handle.conn.close()
+        except (OSError, ValueError):
+            pass
+        self.start_worker(worker_id)
+
+        for room_id in handle.room_ids:
+            room = self.rooms.rooms.get(room_id)
+            if room is None:
+                continue
+            if room.is_empty():
+                self.workers[worker_id].room_ids.add(room_id)
+                continue
+            room.worker = self.assign_worker(room)
+            if room.checkpoint is not None:
+                self.send_to_worker(room.worker, pack_record(OP_RESTORE, room_id, 0, room.checkpoint))
+                for player_num in room.clients:
+                    self.send_to_worker(room.worker, pack_record(OP_ATTACH, room_id, player_num))
+            else:
+                for player_num in room.clients:
+                    self.send_to_worker(room.worker, pack_record(OP_JOIN, room_id, player_num))
+            for player_num in room.detached:
+                if room.checkpoint is None:
+                    self.send_to_worker(room.worker, pack_record(OP_JOIN, room_id, player_num))
+                self.send_to_worker(room.worker, pack_record(OP_DETACH, room_id, player_num))
+            if len(room.spectators):
+                room.request_keyframe()
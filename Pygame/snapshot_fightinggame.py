@@ -0,0 +1,164 @@
+from collections import OrderedDict
+from types import MappingProxyType
+
+import protocol_fightinggame as protocol
+
+# At the 20 Hz broadcast rate this is a keyframe every two seconds
+KEYFRAME_INTERVAL = 40
+# Deltas are only built against snapshots both sides still remember
+HISTORY_SIZE = 32
+
+
+def capture(game_state):
+    return {
+        'ready': game_state.get('ready', 0),
+        'players': {player_num: dict(player) for player_num, player in game_state['players'].items()}
+    }
+
+
+def diff(base, current):
+    players = {}
+    for player_num, player in current['players'].items():
+        old = base['players'].get(player_num)
+        if old is None:
+            changes = dict(player)
+        else:
+            changes = {field: value for field, value in player.items() if old.get(field) != value}
+        if changes:
+            players[player_num] = changes
+    delta = {'players': players}
+    if current['ready'] != base['ready']:
+        delta['ready'] = current['ready']
+    return delta
+
+
+class SnapshotEncoder:
+    """Server side: numbers every broadcast and encodes it against each client's last ack."""
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL, history_size=HISTORY_SIZE):
+        self.keyframe_interval = keyframe_interval
+        self.history_size = history_size
+        self.history = OrderedDict()
+        self.platforms = []
+        self.seq = 0
+        self.tick = 0
+        self.frames = {}
+
+    def capture(self, game_state, tick=0):
+        self.seq += 1
+        self.tick = tick
+        self.history[self.seq] = capture(game_state)
+        while len(self.history) > self.history_size:
+            self.history.popitem(last=False)
+        self.platforms = game_state.get('platforms', [])
+        self.frames = {}
+        return self.seq
+
+    def is_keyframe_due(self):
+        return self.seq % self.keyframe_interval == 0
+
+    def frame_for(self, acked_seq):
+        base_seq = acked_seq
+        if base_seq not in self.history or base_seq == self.seq or self.is_keyframe_due():
+            base_seq = None
+
+        data = self.frames.get(base_seq)
+        if data is None:
+            data = protocol.encode_message(self.message_for(base_seq))
+            self.frames[base_seq] = data
+        return data
+
+    def message_for(self, base_seq):
+        current = self.history[self.seq]
+        if base_seq is None:
+            game_state = {'players': current['players'], 'ready': current['ready'], 'platforms': self.platforms}
+            return {'status': 'game_state_update', 'game_state': game_state, 'seq': self.seq, 'tick': self.tick}
+
+        delta = diff(self.history[base_seq], current)
+        delta.update({'status': 'game_state_delta', 'seq': self.seq, 'tick': self.tick, 'base_seq': base_seq})
+        return delta
+
+
+class SnapshotReceiver:
+    """Client side: rebuilds full game states from keyframes and deltas."""
+
+    def __init__(self, history_size=HISTORY_SIZE):
+        self.history_size = history_size
+        self.history = OrderedDict()
+        self.platforms = []
+        self.latest_seq = None
+        self.latest_tick = None
+        self.keyframe_requested = False
+
+    def apply(self, message):
+        if message['status'] == 'game_state_update':
+            game_state = message['game_state']
+            self.platforms = game_state.get('platforms', [])
+            snapshot = capture(game_state)
+            self.keyframe_requested = False
+        else:
+            base = self.history.get(message['base_seq'])
+            if base is None:
+                return None
+            snapshot = {
+                'ready': message.get('ready', base['ready']),
+                'players': {player_num: dict(player) for player_num, player in base['players'].items()}
+            }
+            for player_num, changes in message['players'].items():
+                snapshot['players'].setdefault(player_num, {}).update(changes)
+
+        self.latest_seq = message['seq']
+        self.latest_tick = message.get('tick')
+        self.history[self.latest_seq] = snapshot
+        while len(self.history) > self.history_size:
+            self.history.popitem(last=False)
+        return self.game_state(self.latest_seq)
+
+    def game_state(self, seq):
+        snapshot = self.history[seq]
+        return {
+            'players': {player_num: dict(player) for player_num, player in snapshot['players'].items()},
+            'ready': snapshot['ready'],
+            'platforms': self.platforms
+        }
+
+
+def freeze(game_state, platforms=None):
+    """A read-only view of a decoded game state; platforms, if given, are an already frozen tuple."""
+    if platforms is None:
+        platforms = tuple(MappingProxyType(platform) for platform in game_state.get('platforms', ()))
+    return MappingProxyType({
+        'players': MappingProxyType({player_num: MappingProxyType(player)
+                                     for player_num, player in game_state['players'].items()}),
+        'ready': game_state.get('ready', 0),
+        'platforms': platforms
+    })
+
+
+class LatestSnapshot:
+    """Client side: hands decoded game states from the receive thread to the game loop.
+
+    The receive thread publishes each state as a read-only view and never
+    touches it again; the game loop takes the newest once per frame and
+    draws the whole frame from it. Publishing replaces one reference, which
+    is atomic, so neither thread ever waits for the other and the game loop
+    never sees a state half updated. Like a triple buffer, states the game
+    loop skipped are simply dropped, and one it still holds stays intact.
+    """
+
+    def __init__(self):
+        # Frozen once per stage rather than once per snapshot
+        self.platforms_source = None
+        self.platforms = ()
+        self.latest = freeze({'players': {}}, self.platforms)
+
+    def publish(self, game_state):
+        platforms = game_state.get('platforms', [])
+        if platforms is not self.platforms_source:
+            self.platforms_source = platforms
+            self.platforms = tuple(MappingProxyType(platform) for platform in platforms)
+        self.latest = freeze(game_state, self.platforms)
+        return self.latest
+
+    def take(self):
+        return self.latest
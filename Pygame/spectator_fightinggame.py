@@ -0,0 +1,141 @@
+import threading
+from collections import deque
+
+import protocol_fightinggame as protocol
+
+# Viewers one match accepts; more are turned away
+MAX_SPECTATORS = 500
+# Frames a spectator may fall behind by, 1.6 s at 20 Hz. A full queue is
+# thrown away and the spectator resumes from the next keyframe.
+MAX_QUEUED_FRAMES = 32
+# Resyncs in a row without ever catching up before a spectator is dropped
+MAX_OVERFLOWS = 5
+
+# Kinds of frames a room publishes to its spectators
+FRAME_DELTA = 0
+FRAME_KEYFRAME = 1
+FRAME_CONTROL = 2
+
+
+class Spectator:
+    """One read-only viewer: a bounded queue of frames shared with every other viewer.
+
+    The tick only appends references to already encoded frames; the
+    connection's own thread or task drains the queue at whatever pace the
+    socket allows. A spectator that falls MAX_QUEUED_FRAMES behind loses
+    its queue and skips ahead to the next keyframe instead of slowing the
+    match down, and one that keeps falling behind is disconnected.
+    """
+
+    def __init__(self, max_frames=MAX_QUEUED_FRAMES, max_overflows=MAX_OVERFLOWS):
+        self.frames = deque()
+        self.max_frames = max_frames
+        self.max_overflows = max_overflows
+        self.lock = threading.Lock()
+        self.needs_keyframe = True
+        self.overflows = 0
+        self.dropped = 0
+        self.sent = 0
+        self.closed = False
+        self.wakeup = lambda: None
+
+    def push(self, frame, kind=FRAME_DELTA):
+        with self.lock:
+            if self.closed:
+                return
+            if kind == FRAME_DELTA and self.needs_keyframe:
+                # Deltas are useless until the spectator has a state to apply them to
+                return
+            if len(self.frames) >= self.max_frames:
+                self.dropped += len(self.frames)
+                self.frames.clear()
+                self.needs_keyframe = True
+                self.overflows += 1
+                if self.overflows >= self.max_overflows:
+                    self.closed = True
+                if self.closed or kind == FRAME_DELTA:
+                    self.wakeup()
+                    return
+            if kind == FRAME_KEYFRAME:
+                self.needs_keyframe = False
+            self.frames.append(frame)
+        self.wakeup()
+
+    def take(self):
+        with self.lock:
+            frames = list(self.frames)
+            self.frames.clear()
+            if frames:
+                self.overflows = 0
+            self.sent += len(frames)
+            return frames
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.wakeup()
+
+
+class SpectatorGroup:
+    """Everyone watching one room. Each frame is encoded once and the same bytes go to all of them."""
+
+    def __init__(self, max_spectators=MAX_SPECTATORS):
+        self.max_spectators = max_spectators
+        self.lock = threading.Lock()
+        # Replaced rather than mutated, so the tick can iterate without locking
+        self.spectators = ()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.spectators)
+
+    def add(self, spectator):
+        with self.lock:
+            if len(self.spectators) >= self.max_spectators:
+                return False
+            self.spectators = self.spectators + (spectator,)
+            return True
+
+    def remove(self, spectator):
+        with self.lock:
+            self.spectators = tuple(other for other in self.spectators if other is not spectator)
+            self.dropped += spectator.dropped
+
+    def needs_keyframe(self):
+        return any(spectator.needs_keyframe for spectator in self.spectators)
+
+    def publish(self, encoder):
+        """Hands the snapshot the encoder just captured to every spectator."""
+        spectators = self.spectators
+        if not spectators:
+            return
+        # Spectators never ack; each frame is a delta against the one before it
+        delta = encoder.frame_for(encoder.seq - 1)
+        keyframe = encoder.frame_for(None) if any(spectator.needs_keyframe for spectator in spectators) else None
+        for spectator in spectators:
+            if spectator.needs_keyframe:
+                spectator.push(keyframe, FRAME_KEYFRAME)
+            else:
+                spectator.push(delta)
+
+    def fan_out(self, frame, kind):
+        for spectator in self.spectators:
+            spectator.push(frame, kind)
+
+    def send_message(self, message):
+        if self.spectators:
+            self.fan_out(protocol.encode_message(message), FRAME_CONTROL)
+
+    def close(self, message=None):
+        if message is not None:
+            self.send_message(message)
+        for spectator in self.spectators:
+            spectator.close()
+
+
+def pick_room(rooms, room_id):
+    """The room a spectate request is for; 0 picks the first match that has both players."""
+    if room_id:
+        room = rooms.get(room_id)
+        return room if room is not None and not room.is_empty() else None
+    return next((room for room in rooms.values() if room.is_full()), None)
@@ -1,21 +1,18 @@
 import pygame
 from pygame.locals import *
 from Characters_fightinggame import CharacterManager
+import assets_fightinggame as assets
+import render_fightinggame as render
 import sys
 
 def create_sprite_surface(width, height):
     return pygame.surface.Surface((width, height), pygame.SRCALPHA)
 
-def load_pixel_art(image_path, scale_factor=3):
-
-    try:
-        image = pygame.image.load(image_path)
-        width = image.get_width() * scale_factor
-        height = image.get_height() * scale_factor
-        return pygame.transform.scale(image, (width, height))
-    except Exception as e:
-        print(f"Error loading pixel art: {str(e)}")
+def load_pixel_art(asset, scale_factor=3):
+    image = assets.manager.load(asset)
+    if image is None:
         return None
+    return assets.manager.surface(asset, (image.get_width() * scale_factor, image.get_height() * scale_factor))
 
 class Platform:
     def __init__(self, x, y, width, height):
@@ -55,40 +52,12 @@ class Stadium:
 
         self.platforms = []
         self.init_platforms()
+        # Sky, mountains and platforms, drawn once and blitted every frame
+        self.layers = render.StaticLayers()
 
         self.font = pygame.font.Font(None, 74)
         self.small_font = pygame.font.Font(None, 36)
-
-    def draw_background(self):
-        for y in range(self.SCREEN_HEIGHT):
-            color = (
-                self.DARK_BLUE[0] + (self.BLUE[0] - self.DARK_BLUE[0]) * y // self.SCREEN_HEIGHT,
-                self.DARK_BLUE[1] + (self.BLUE[1] - self.DARK_BLUE[1]) * y // self.SCREEN_HEIGHT,
-                self.DARK_BLUE[2] + (self.BLUE[2] - self.DARK_BLUE[2]) * y // self.SCREEN_HEIGHT
-            )
-            pygame.draw.line(self.screen, color, (0, y), (self.SCREEN_WIDTH, y))
-
-        pygame.draw.polygon(self.screen, self.GRAY, [(0, self.SCREEN_HEIGHT), (300, 500), (500, self.SCREEN_HEIGHT)])
-        pygame.draw.polygon(self.screen, self.GRAY, [(500, self.SCREEN_HEIGHT), (700, 400), (900, self.SCREEN_HEIGHT)])
-
-    def draw_platform(self):
-        platform_width1 = 600
-        platform_height = 20
-        platform_x1 = (self.SCREEN_WIDTH - platform_width1) // 2
-        platform_y1 = 600
-        platform_width2 = 100
-        platform_x2 = (self.SCREEN_WIDTH - platform_width2) // 2.25
-        platform_y2 = 300
-        platform_x3 = (self.SCREEN_WIDTH - platform_width2) // 1.75
-        platform_y3 = 450
-
-        #platforms of the stadium
-        pygame.draw.rect(self.screen, self.DARK_BLUE, (platform_x1, platform_y1, platform_width1, platform_height))
-        pygame.draw.rect(self.screen, self.WHITE, (platform_x1, platform_y1, platform_width1, 5))
-        pygame.draw.rect(self.screen, self.DARK_BLUE, (platform_x2, platform_y2, platform_width2, platform_height))
-        pygame.draw.rect(self.screen, self.WHITE, (platform_x2, platform_y2, platform_width2, 5))
-        pygame.draw.rect(self.screen, self.DARK_BLUE, (platform_x3, platform_y3, platform_width2, platform_height))
-        pygame.draw.rect(self.screen, self.WHITE, (platform_x3, platform_y3, platform_width2, 5))
+        self.text = render.TextCache()
 
     def init_platforms(self):
         platform_width1 = 600
@@ -122,11 +91,11 @@ class Stadium:
                 winner_text = "PLAYER 1 WINS!"
 
         if winner_text:
-            text = self.font.render(winner_text, True, self.GREEN)
+            text = self.text.render(self.font, winner_text, self.GREEN)
             text_rect = text.get_rect(center=(self.SCREEN_WIDTH/2, self.SCREEN_HEIGHT/2))
             self.screen.blit(text, text_rect)
 
-        exit_text = self.small_font.render("Press ESC to exit", True, self.WHITE)
+        exit_text = self.text.render(self.small_font, "Press ESC to exit", self.WHITE)
         exit_rect = exit_text.get_rect(center=(self.SCREEN_WIDTH/2, self.SCREEN_HEIGHT/2 + 60))
         self.screen.blit(exit_text, exit_rect)
 
@@ -148,9 +117,7 @@ class Stadium:
             keys = pygame.key.get_pressed()
             self.character_manager.update(keys, self.platforms, current_time)
 
-            self.screen.fill(self.BLACK)
-            self.draw_background()
-            self.draw_platform()
+            self.layers.draw(self.screen, self.platforms)
 
             self.character_manager.draw(self.screen)
 
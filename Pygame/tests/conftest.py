@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The game's modules are flat files one directory up, imported by name as the game itself does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
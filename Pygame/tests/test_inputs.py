@@ -0,0 +1,115 @@
+import logging
+
+import inputs_fightinggame as inputs
+import room_fightinggame as room_manager
+
+
+def merge(*actions):
+    pending = None
+    for action in actions:
+        pending = inputs.coalesce(pending, action)
+    return pending
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_single_action_is_copied():
+    action = {'x': 10.0, inputs.RELEASE: {'is_attacking'}}
+    pending = merge(action)
+    assert pending == {'x': 10.0}
+    assert pending is not action
+    assert inputs.released(pending) is None
+
+
+def test_later_movement_wins():
+    assert merge({'x': 1.0, 'facing_right': True}, {'x': 2.0}, {'x': 3.0, 'facing_right': False}) == {
+        'x': 3.0, 'facing_right': False, inputs.RELEASE: set()}
+
+
+def test_attack_between_ticks_is_kept():
+    pending = merge({'x': 1.0, 'attack': True}, {'x': 2.0, 'attack': False}, {'x': 3.0})
+    assert pending['attack'] is True
+    assert pending['x'] == 3.0
+
+
+def test_held_flag_pressed_and_released_shows_for_one_tick():
+    pending = merge({'is_attacking': True}, {'is_attacking': False})
+    assert pending['is_attacking'] is True
+    assert inputs.released(pending) == {'is_attacking': False}
+    # released() takes the bookkeeping out of the action the tick applies
+    assert inputs.RELEASE not in pending
+
+
+def test_held_flag_pressed_again_is_not_released():
+    pending = merge({'is_special_attacking': True}, {'is_special_attacking': False},
+                    {'is_special_attacking': True})
+    assert pending['is_special_attacking'] is True
+    assert inputs.released(pending) is None
+
+
+def test_clients_cannot_ask_for_releases():
+    pending = merge({'x': 1.0}, {'x': 2.0, inputs.RELEASE: ['is_attacking']})
+    assert inputs.released(pending) is None
+
+
+def test_released_follow_up_merges_with_the_next_input():
+    pending = merge({'is_attacking': True}, {'is_attacking': False})
+    follow_up = inputs.released(pending)
+    pending = merge(follow_up, {'x': 5.0})
+    assert pending['is_attacking'] is False and pending['x'] == 5.0
+    assert inputs.released(pending) is None
+
+
+def test_token_bucket_allows_burst_then_rate():
+    clock = FakeClock()
+    bucket = inputs.TokenBucket(rate=10.0, burst=5, clock=clock)
+    assert all(bucket.take() for _ in range(5))
+    assert not bucket.take()
+    # Over budget the debt has to be paid back first
+    clock.now += 0.1
+    assert not bucket.take()
+    clock.now += 0.2
+    assert bucket.take()
+
+
+def test_token_bucket_refills_only_to_burst():
+    clock = FakeClock()
+    bucket = inputs.TokenBucket(rate=10.0, burst=5, clock=clock)
+    clock.now += 60.0
+    assert bucket.take(5)
+    assert not bucket.take()
+
+
+def test_token_bucket_counts_batches():
+    clock = FakeClock()
+    bucket = inputs.TokenBucket(rate=100.0, burst=10, clock=clock)
+    assert bucket.take(10)
+    assert not bucket.take(1)
+
+
+class NullSocket:
+    def sendall(self, data):
+        pass
+
+
+class FakeServer:
+    logger = logging.getLogger('test')
+    max_rewind_ticks = 4
+
+
+def test_room_input_after_the_tick_takes_its_actions_starts_a_new_one():
+    room = room_manager.GameRoom(FakeServer(), 1)
+    room.add_player(NullSocket(), 1)
+    room.handle_client_data(None, 1, {'player_action': {'x': 1.0, 'attack': True}})
+    taken = room.take_inputs(1)
+    room.handle_client_data(None, 1, {'player_action': {'x': 2.0}})
+    # A late input must not land in the action the tick is applying, or its attack would apply twice
+    assert taken[1] == {'x': 1.0, 'attack': True}
+    assert room.pending_actions[1] == {'x': 2.0}
+    assert room.input_tick == 1
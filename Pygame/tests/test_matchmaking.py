@@ -0,0 +1,103 @@
+import matchmaking_fightinggame as matchmaking
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_queue():
+    clock = FakeClock()
+    return matchmaking.MatchQueue(bucket_width=100, max_skill=3000, widen_interval=5.0,
+                                  any_opponent_after=30.0, clock=clock), clock
+
+
+def players(pair):
+    return pair and (pair[0].player, pair[1].player)
+
+
+def test_same_bucket_pairs_at_once():
+    queue, _ = make_queue()
+    queue.push('a', 1010)
+    queue.push('b', 1090)
+    assert players(queue.pop_pair()) == ('a', 'b')
+    assert len(queue) == 0
+    assert queue.pop_pair() is None
+
+
+def test_nobody_within_tolerance():
+    queue, _ = make_queue()
+    queue.push('a', 1000)
+    queue.push('b', 1200)
+    assert queue.pop_pair() is None
+    assert len(queue) == 2
+
+
+def test_tolerance_widens_with_waiting():
+    queue, clock = make_queue()
+    queue.push('a', 1000)
+    queue.push('b', 1200)
+    clock.now = 9.9
+    assert queue.pop_pair() is None
+    clock.now = 10.0
+    assert players(queue.pop_pair()) == ('a', 'b')
+
+
+def test_anyone_after_the_longest_wait():
+    queue, clock = make_queue()
+    queue.push('a', 0)
+    queue.push('b', 3000)
+    clock.now = 29.9
+    assert queue.pop_pair() is None
+    clock.now = 30.0
+    assert players(queue.pop_pair()) == ('a', 'b')
+
+
+def test_longest_waiting_head_goes_first():
+    queue, clock = make_queue()
+    queue.push('old', 2000)
+    clock.now = 1.0
+    queue.push('x', 1000)
+    queue.push('y', 1000)
+    clock.now = 6.0
+    queue.push('near old', 2100)
+    # 'x' and 'y' share a bucket, but 'old' has waited longer and can now reach one bucket away
+    assert players(queue.pop_pair()) == ('old', 'near old')
+    assert players(queue.pop_pair()) == ('x', 'y')
+
+
+def test_closest_bucket_wins_and_ties_go_to_the_longer_wait():
+    queue, clock = make_queue()
+    queue.push('head', 1500)
+    queue.push('far', 1700)
+    queue.push('above', 1600)
+    queue.push('below', 1400)
+    clock.now = 10.0
+    # 'above' and 'below' are both one bucket away; 'above' has waited longer
+    assert players(queue.pop_pair()) == ('head', 'above')
+    # 'below' is now the oldest head: 'far' is three buckets away, so it has to wait
+    assert queue.pop_pair() is None
+    clock.now = 15.0
+    assert players(queue.pop_pair()) == ('far', 'below')
+
+
+def test_remove():
+    queue, _ = make_queue()
+    a = queue.push('a', 1000)
+    queue.push('b', 1000)
+    queue.push('c', 1000)
+    assert queue.remove(a)
+    assert not queue.remove(a)
+    assert len(queue) == 2
+    assert players(queue.pop_pair()) == ('b', 'c')
+
+
+def test_unusable_skill_gets_the_default_bucket():
+    queue, _ = make_queue()
+    assert queue.push('a', 'strong').bucket == matchmaking.DEFAULT_SKILL // 100
+    assert queue.push('b', None).bucket == matchmaking.DEFAULT_SKILL // 100
+    assert queue.push('c', 10 ** 9).bucket == 30
+    assert queue.push('d', -5).bucket == 0
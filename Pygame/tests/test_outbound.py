@@ -0,0 +1,185 @@
+import socket
+
+import outbound_fightinggame as outbound
+import protocol_fightinggame as protocol
+
+HIGH = 100
+LOW = 40
+LIMIT = 1000
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def snapshot_frame(fill=b's'):
+    # 40 bytes with the frame header
+    return protocol.frame(protocol.MSG_STATE_DELTA, fill * 34)
+
+
+def control_frame(fill=b'c'):
+    return protocol.frame(protocol.MSG_CONTROL, fill * 34)
+
+
+def make_queue():
+    clock = FakeClock()
+    return outbound.OutboundQueue(HIGH, LOW, LIMIT, clock=clock), clock
+
+
+def queued(queue):
+    return [frame for frame, _, _ in queue.frames]
+
+
+def test_below_the_high_watermark_every_frame_is_kept():
+    queue, _ = make_queue()
+    frames = [snapshot_frame(b'1'), control_frame(), snapshot_frame(b'2')]
+    for frame in frames:
+        queue.put(frame)
+    assert queued(queue) == frames
+    assert queue.backlog() == 120
+    assert not queue.congested
+
+
+def test_newest_snapshot_replaces_queued_ones_above_the_high_watermark():
+    queue, _ = make_queue()
+    for fill in (b'1', b'2', b'3'):
+        queue.put(snapshot_frame(fill))
+    queue.put(control_frame())
+    queue.put(snapshot_frame(b'4'))
+    # Control messages are never dropped; only the newest snapshot is worth sending
+    assert queued(queue) == [control_frame(), snapshot_frame(b'4')]
+    assert queue.congested
+    assert queue.coalesced == 3
+    assert queue.backlog() == 80
+
+
+def test_taken_frames_count_until_done_and_congestion_ends_at_the_low_watermark():
+    queue, clock = make_queue()
+    for fill in (b'1', b'2', b'3'):
+        queue.put(snapshot_frame(fill))
+    batch = queue.take()
+    assert len(batch) == 3
+    assert queue.backlog() == 120
+    queue.put(snapshot_frame(b'4'))
+    assert queue.congested
+
+    clock.now = 0.5
+    queue.done(batch)
+    # 40 bytes left is the low watermark itself
+    assert queue.backlog() == LOW
+    assert not queue.congested
+    assert queue.sent_frames == 3 and queue.sent_bytes == 120
+    assert queue.max_latency == 0.5
+
+    queue.put(snapshot_frame(b'5'))
+    assert queued(queue) == [snapshot_frame(b'4'), snapshot_frame(b'5')]
+
+
+def test_congestion_holds_between_the_watermarks():
+    queue, _ = make_queue()
+    for fill in (b'1', b'2', b'3'):
+        queue.put(snapshot_frame(fill))
+    queue.put(control_frame())
+    batch = queue.take()
+    queue.put(snapshot_frame(b'4'))
+    queue.put(snapshot_frame(b'5'))
+    assert queued(queue) == [snapshot_frame(b'5')]
+    queue.done(batch[:1])
+    # 160 bytes still queued or in flight: above the low watermark, still congested
+    assert queue.backlog() == 160
+    assert queue.congested
+
+
+def test_overflow_closes_the_queue():
+    queue, _ = make_queue()
+    wakeups = []
+    queue.wakeup = lambda: wakeups.append(True)
+    for _ in range(LIMIT // 40):
+        queue.put(control_frame())
+    assert not queue.closed
+    queue.put(control_frame())
+    assert queue.closed and queue.overflowed
+    queue.put(control_frame())
+    assert len(queue.frames) == LIMIT // 40 + 1
+    assert len(wakeups) == LIMIT // 40 + 1
+
+
+def test_held_wakeups_wake_each_queue_once_at_the_end():
+    first, _ = make_queue()
+    second, _ = make_queue()
+    wakeups = []
+    first.wakeup = lambda: wakeups.append('first')
+    second.wakeup = lambda: wakeups.append('second')
+    with outbound.held_wakeups():
+        for _ in range(3):
+            first.put(control_frame())
+            second.put(control_frame())
+        assert wakeups == []
+    assert sorted(wakeups) == ['first', 'second']
+    first.put(control_frame())
+    assert wakeups[-1] == 'first'
+
+
+def test_overflow_wakes_at_once_even_when_held():
+    queue, _ = make_queue()
+    wakeups = []
+    queue.wakeup = lambda: wakeups.append(True)
+    with outbound.held_wakeups():
+        for _ in range(LIMIT // 40 + 1):
+            queue.put(control_frame())
+        assert wakeups == [True]
+
+
+class TrickleSocket:
+    """Accepts at most a few bytes per sendmsg(), like a full socket buffer."""
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.data = bytearray()
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        sent = 0
+        for buffer in buffers:
+            part = bytes(buffer[:self.chunk - sent])
+            self.data += part
+            sent += len(part)
+            if sent == self.chunk:
+                break
+        return sent
+
+
+def test_send_vectored_resumes_partial_writes():
+    buffers = [b'abc', b'defgh', b'', b'ij', b'klmnopq']
+    sock = TrickleSocket(4)
+    outbound.send_vectored(sock, buffers)
+    assert bytes(sock.data) == b''.join(buffers)
+    assert sock.calls == 5
+
+
+def test_queued_socket_delivers_in_order_and_flushes_on_close():
+    left, right = socket.socketpair()
+    try:
+        queued_socket = outbound.QueuedSocket(left)
+        messages = [{'status': 'heartbeat'}, {'status': 'clock_pong', 'ping': 1.5, 'server_time': 2.0}]
+        for message in messages * 50:
+            queued_socket.sendall(protocol.encode_message(message))
+        queued_socket.close()
+        right.settimeout(5)
+        decoder = protocol.FrameDecoder()
+        received = []
+        while True:
+            data = right.recv(65536)
+            if not data:
+                break
+            received.extend(decoder.feed(data))
+        queued_socket.writer.join(5)
+        assert received == messages * 50
+        assert queued_socket.queue.stats()['sent_frames'] == 100
+    finally:
+        right.close()
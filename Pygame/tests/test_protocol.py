@@ -0,0 +1,101 @@
+import pickle
+
+import pytest
+
+import protocol_fightinggame as protocol
+
+
+def player(x=300.0, character='Lucario'):
+    return {'connected': True, 'is_dead': False, 'is_attacking': False, 'is_special_attacking': True,
+            'facing_right': True, 'character': character, 'x': x, 'y': 580.0, 'health': 87.5, 'input_seq': 12}
+
+
+def game_state():
+    return {'players': {1: player(), 2: player(700.0, 'Mewtwo')}, 'ready': 2,
+            'platforms': [{'x': 200, 'y': 600, 'width': 600, 'height': 20}]}
+
+
+MESSAGES = [
+    protocol.HEARTBEAT,
+    {'snapshot_ack': 41},
+    {'player_action': {'x': 310.5, 'facing_right': False, 'attack': True, 'input_seq': 7, 'view_tick': 90}},
+    {'status': 'game_state_update', 'game_state': game_state()},
+    {'status': 'game_state_update', 'game_state': game_state(), 'seq': 40, 'tick': 812},
+    {'status': 'game_state_delta', 'seq': 41, 'tick': 813, 'base_seq': 39, 'ready': 2,
+     'players': {2: {'x': 690.0, 'is_attacking': True, 'input_seq': 13}}},
+    {'status': 'connected', 'player_num': 2, 'room_id': 5, 'tick_rate': 20, 'session': 'ab12', 'reconnect_grace': 15.0},
+    {'status': 'match_start', 'game_state': game_state()},
+    {'status': 'game_over', 'winner': 1, 'game_state': dict(game_state(), extra={'note': None})},
+]
+
+
+def frames_of(messages):
+    return b''.join(protocol.encode_message(message) for message in messages)
+
+
+@pytest.mark.parametrize('message', MESSAGES)
+def test_round_trip(message):
+    assert protocol.FrameDecoder().feed(protocol.encode_message(message)) == [message]
+
+
+def test_hot_messages_use_binary_records():
+    types = [protocol.HEADER.unpack_from(protocol.encode_message(message))[1] for message in MESSAGES[:6]]
+    assert types == [protocol.MSG_HEARTBEAT, protocol.MSG_SNAPSHOT_ACK, protocol.MSG_PLAYER_ACTION,
+                     protocol.MSG_GAME_STATE_UPDATE, protocol.MSG_STATE_KEYFRAME, protocol.MSG_STATE_DELTA]
+
+
+def test_control_messages_keep_player_numbers():
+    message = protocol.FrameDecoder().feed(protocol.encode_message(MESSAGES[7]))[0]
+    assert sorted(message['game_state']['players']) == [1, 2]
+
+
+def test_frames_split_across_reads():
+    data = frames_of(MESSAGES)
+    decoder = protocol.FrameDecoder()
+    received = []
+    for index in range(len(data)):
+        received.extend(decoder.feed(data[index:index + 1]))
+    assert received == MESSAGES
+    assert not decoder.buffer
+
+
+def test_frames_merged_within_reads():
+    data = frames_of(MESSAGES * 3)
+    decoder = protocol.FrameDecoder()
+    # Chunks that end in the middle of headers and payloads alike
+    received = []
+    for start in range(0, len(data), 37):
+        received.extend(decoder.feed(data[start:start + 37]))
+    assert received == MESSAGES * 3
+
+
+def test_partial_frame_waits_for_the_rest():
+    data = protocol.encode_message(MESSAGES[3])
+    decoder = protocol.FrameDecoder()
+    assert decoder.feed(data[:-1]) == []
+    assert decoder.feed(data[-1:]) == [MESSAGES[3]]
+
+
+@pytest.mark.parametrize('data', [
+    protocol.frame(protocol.MSG_CONTROL, pickle.dumps({'status': 'connected'})),
+    protocol.frame(protocol.MSG_CONTROL, b'[1, 2]'),
+    protocol.frame(protocol.MSG_CONTROL, b'\xff\xfe'),
+    protocol.frame(protocol.MSG_PLAYER_ACTION, b'\x00\x01'),
+    protocol.frame(protocol.MSG_SNAPSHOT_ACK, b''),
+    protocol.frame(protocol.MSG_STATE_DELTA, protocol.encode_message(MESSAGES[5])[protocol.HEADER.size:-3]),
+    protocol.frame(protocol.MSG_GAME_STATE_UPDATE, protocol.STATE_HEADER.pack(0, 1, 0)
+                   + protocol.PLAYER_RECORD.pack(1, 0, 200, 0.0, 0.0, 0.0, 0)),
+    protocol.frame(99),
+])
+def test_malformed_frames_raise_protocol_error(data):
+    with pytest.raises(protocol.ProtocolError):
+        protocol.FrameDecoder().feed(data)
+
+
+def test_wrong_version_and_oversized_frames_are_rejected():
+    data = bytearray(protocol.encode_message(protocol.HEARTBEAT))
+    data[0] = protocol.PROTOCOL_VERSION - 1
+    with pytest.raises(protocol.ProtocolError):
+        protocol.FrameDecoder().feed(bytes(data))
+    with pytest.raises(protocol.ProtocolError):
+        protocol.FrameDecoder(max_frame_size=16).feed(protocol.encode_message(MESSAGES[3]))
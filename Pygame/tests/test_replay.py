@@ -0,0 +1,122 @@
+import copy
+import logging
+import random
+
+import protocol_fightinggame as protocol
+import replay_fightinggame as replay
+import room_fightinggame as room_manager
+
+# Not the default window, so a player that ignored the header would judge hits differently
+MAX_REWIND_TICKS = 7
+KEYFRAME_INTERVAL = 10
+
+
+class RecordingServer(replay.ReplayServer):
+    def __init__(self, path):
+        super().__init__(MAX_REWIND_TICKS)
+        self.logger = logging.getLogger('test')
+        self.path = path
+
+    def open_replay(self, room):
+        return replay.MatchRecorder(self.path, room, 20, KEYFRAME_INTERVAL, seed=1)
+
+
+def random_inputs(seed):
+    rng = random.Random(seed)
+    xs = {1: 300.0, 2: 700.0}
+
+    def inputs(tick):
+        for _ in range(rng.randint(0, 3)):
+            player_num = rng.choice((1, 2))
+            xs[player_num] += rng.choice((-15.0, 15.0))
+            action = {'x': xs[player_num], 'is_attacking': rng.random() < 0.3, 'input_seq': tick}
+            if rng.random() < 0.15:
+                action.update({'attack': True, 'damage': 9, 'attack_range': 380,
+                               'view_tick': max(1, tick - rng.randint(0, 12))})
+            yield player_num, action
+    return inputs
+
+
+def record_match(path, inputs, ticks=150):
+    """Plays a match with the inputs sent after each tick; returns the live state after every tick."""
+    server = RecordingServer(path)
+    room = room_manager.GameRoom(server, 1)
+    for player_num, character in ((1, 'Lucario'), (2, 'Mewtwo')):
+        room.add_player(replay.NullSocket(), player_num)
+        room.handle_client_data(None, player_num, {f'player{player_num}_character': character})
+        room.handle_client_data(None, player_num, {'ready': True})
+    states = {}
+    tick = 0
+    for _ in range(ticks):
+        # One gap, so the recording has a skip in it
+        tick += 4 if tick == 60 else 1
+        room.tick(tick)
+        states[tick] = copy.deepcopy(room.game_state)
+        if room.recorder is None and tick > 1:
+            break
+        for player_num, action in inputs(tick):
+            room.handle_client_data(None, player_num, {'player_action': action})
+    room.close_replay()
+    return server, states
+
+
+def linear_states(reader, ticks):
+    player = replay.ReplayPlayer(reader)
+    states = {}
+    for tick in ticks:
+        states[tick] = copy.deepcopy(player.play(until=tick))
+        if player.finished:
+            break
+    return player, states
+
+
+def test_seek_matches_linear_playback(tmp_path):
+    path = str(tmp_path / 'match.fgr')
+    server, live = record_match(path, random_inputs(3))
+    reader = replay.ReplayReader(path)
+    try:
+        assert reader.max_rewind_ticks == MAX_REWIND_TICKS
+        assert len(reader.index) > 3
+
+        linear, states = linear_states(reader, sorted(live))
+        assert linear.server.max_rewind_ticks == MAX_REWIND_TICKS
+        assert server.winner is not None
+        assert linear.server.winner == server.winner
+        for tick, state in states.items():
+            if not linear.finished or tick < max(states):
+                assert state == live[tick], tick
+
+        for tick in sorted(states)[:-1]:
+            if tick >= reader.start_tick:
+                assert replay.ReplayPlayer(reader).seek(tick) == states[tick], tick
+    finally:
+        reader.close()
+
+
+def test_seek_restores_a_pending_release(tmp_path):
+    keyframe_tick = 1 + KEYFRAME_INTERVAL
+
+    def inputs(tick):
+        # Pressed and let go between two ticks, just before a keyframe, then nothing
+        if tick == keyframe_tick - 1:
+            yield 1, {'is_attacking': True}
+            yield 1, {'is_attacking': False}
+
+    path = str(tmp_path / 'match.fgr')
+    _, live = record_match(path, inputs, ticks=keyframe_tick + 3)
+    reader = replay.ReplayReader(path)
+    try:
+        records = reader.records(reader.keyframe_before(keyframe_tick)[1])
+        _, _, tick, _, payload = next(records)
+        state = protocol.decode_control(bytes(payload))
+        # The mmap only closes once every view of it is released
+        payload.release()
+        records.close()
+        assert tick == keyframe_tick
+        assert state['pending_actions'][1] == {'is_attacking': False}
+
+        assert live[keyframe_tick]['players'][1]['is_attacking'] is True
+        assert live[keyframe_tick + 1]['players'][1]['is_attacking'] is False
+        assert replay.ReplayPlayer(reader).seek(keyframe_tick + 1) == live[keyframe_tick + 1]
+    finally:
+        reader.close()
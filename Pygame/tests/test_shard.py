@@ -0,0 +1,144 @@
+import logging
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+# The shard module reaches the database module, which needs the MySQL driver
+pytest.importorskip('mysql.connector')
+
+import protocol_fightinggame as protocol
+import shard_fightinggame as shard
+
+# Enough pings that both the inputs and their pongs overflow a pipe's buffers
+FLOOD_PINGS = 1 << 15
+
+
+def input_record(room_id, player_num, message):
+    frame = protocol.encode_message(message)
+    return shard.pack_record(shard.OP_INPUT, room_id, player_num, bytes((frame[1],)) + frame[protocol.HEADER.size:])
+
+
+def received(conn):
+    records = []
+    while conn.poll():
+        records.extend(shard.iter_records(conn.recv_bytes()))
+    return records
+
+
+def sent_statuses(records, op=shard.OP_SEND):
+    return [(player_num, protocol.FrameDecoder().feed(payload)[0].get('status'))
+            for record_op, _, player_num, payload in records if record_op == op]
+
+
+def make_worker():
+    front, back = multiprocessing.Pipe()
+    return front, shard.ShardWorker(back, 0, use_database=False)
+
+
+def start_match(worker, room_id=1):
+    worker.apply(shard.pack_record(shard.OP_JOIN, room_id, 1) + shard.pack_record(shard.OP_JOIN, room_id, 2) +
+                 input_record(room_id, 1, {'player1_character': 'Lucario'}) +
+                 input_record(room_id, 2, {'player2_character': 'Mewtwo'}) +
+                 input_record(room_id, 1, {'ready': True}) + input_record(room_id, 2, {'ready': True}))
+
+
+def test_records_round_trip():
+    data = shard.pack_record(shard.OP_JOIN, 7, 1) + shard.pack_record(shard.OP_INPUT, 2 ** 32 - 1, 2, b'\x02abc')
+    assert list(shard.iter_records(data)) == [(shard.OP_JOIN, 7, 1, b''),
+                                              (shard.OP_INPUT, 2 ** 32 - 1, 2, b'\x02abc')]
+
+
+def test_tick_sends_each_player_their_frames():
+    front, worker = make_worker()
+    start_match(worker)
+    worker.tick(1)
+    statuses = sent_statuses(received(front))
+    assert (1, 'match_start') in statuses and (2, 'match_start') in statuses
+    assert {player_num for player_num, _ in statuses} == {1, 2}
+
+
+def test_malformed_input_closes_only_its_player():
+    front, worker = make_worker()
+    start_match(worker)
+    worker.apply(shard.pack_record(shard.OP_INPUT, 1, 1, bytes((protocol.MSG_PLAYER_ACTION,)) + b'short'))
+    worker.flush()
+    closes = [(room_id, player_num) for op, room_id, player_num, _ in received(front) if op == shard.OP_CLOSE]
+    assert closes == [(1, 1)]
+    assert set(worker.rooms[1].clients) == {1, 2}
+
+
+def test_checkpoint_re_homes_room_without_resetting_it():
+    front, worker = make_worker()
+    start_match(worker)
+    worker.apply(input_record(1, 1, {'player_action': {'x': 420.0, 'input_seq': 3}}))
+    for tick_number in range(1, worker.checkpoint_ticks + 1):
+        worker.tick(tick_number)
+    records = received(front)
+    checkpoints = [payload for op, room_id, _, payload in records if op == shard.OP_CHECKPOINT and room_id == 1]
+    stats = [payload for op, _, _, payload in records if op == shard.OP_STATS]
+    assert len(checkpoints) == 1
+    assert shard.STATS.unpack(stats[0]) == (0,)
+
+    match_started, game_state = shard.decode_checkpoint(checkpoints[0])
+    assert match_started
+    assert game_state['players'][1]['x'] == 420.0
+
+    # The room moves to a fresh worker, as after a crash
+    new_front, new_worker = make_worker()
+    new_worker.apply(shard.pack_record(shard.OP_RESTORE, 1, 0, checkpoints[0]) +
+                     shard.pack_record(shard.OP_ATTACH, 1, 1) + shard.pack_record(shard.OP_ATTACH, 1, 2))
+    room = new_worker.rooms[1]
+    assert room.match_started
+    assert set(room.clients) == {1, 2}
+    assert room.game_state['players'][1]['x'] == 420.0
+    assert room.game_state['players'][1]['character'] == 'Lucario'
+
+    new_worker.tick(worker.checkpoint_ticks + 1)
+    statuses = sent_statuses(received(new_front))
+    # Play carries on where the checkpoint left it: no new match start
+    assert statuses and all(status != 'match_start' for _, status in statuses)
+    assert room.game_state['players'][1]['x'] == 420.0
+
+
+def test_leave_drops_empty_room():
+    front, worker = make_worker()
+    start_match(worker)
+    worker.apply(shard.pack_record(shard.OP_LEAVE, 1, 1))
+    assert 1 in worker.rooms
+    worker.apply(shard.pack_record(shard.OP_LEAVE, 1, 2))
+    assert 1 not in worker.rooms
+
+
+def test_full_pipes_both_ways_do_not_deadlock():
+    front, back = multiprocessing.Pipe()
+    worker = shard.ShardWorker(back, 0, use_database=False)
+    worker_thread = threading.Thread(target=worker.run, daemon=True)
+    worker_thread.start()
+    handle = shard.WorkerHandle(0, None, front, logging.getLogger('test'))
+    try:
+        handle.send(shard.pack_record(shard.OP_JOIN, 1, 1) + shard.pack_record(shard.OP_JOIN, 1, 2))
+        flood = input_record(1, 1, {'clock_ping': 1.5}) * FLOOD_PINGS
+        handle.send(flood)
+        # The worker is now stuck writing more pongs than the pipe holds, and
+        # reads nothing until the front does; sending more must not wait for it
+        assert front.poll(30)
+        # On its own thread, so a send that blocks fails the test instead of hanging it
+        sender = threading.Thread(target=handle.send, args=(flood,), daemon=True)
+        sender.start()
+        sender.join(5)
+        assert not sender.is_alive()
+
+        pongs = 0
+        deadline = time.monotonic() + 60
+        while pongs < 2 * FLOOD_PINGS and time.monotonic() < deadline:
+            if front.poll(0.5):
+                pongs += sum(status == 'clock_pong' for _, status in
+                             sent_statuses(shard.iter_records(front.recv_bytes())))
+        assert pongs == 2 * FLOOD_PINGS
+    finally:
+        handle.stop()
+        front.close()
+        worker_thread.join(5)
+    assert not worker_thread.is_alive()
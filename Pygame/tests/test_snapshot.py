@@ -0,0 +1,110 @@
+import logging
+
+import protocol_fightinggame as protocol
+import room_fightinggame as room_manager
+import snapshot_fightinggame as snapshot
+
+
+def game_state(x1=300.0, x2=700.0, ready=2):
+    def player(x, character):
+        return {'connected': True, 'is_dead': False, 'is_attacking': False, 'is_special_attacking': False,
+                'facing_right': True, 'character': character, 'x': x, 'y': 580.0, 'health': 100.0, 'input_seq': 0}
+    return {'players': {1: player(x1, 'Lucario'), 2: player(x2, 'Zeraora')}, 'ready': ready,
+            'platforms': [{'x': 200, 'y': 600, 'width': 600, 'height': 20}]}
+
+
+def receive(receiver, data):
+    message = protocol.FrameDecoder().feed(data)[0]
+    return message, receiver.apply(message)
+
+
+def test_deltas_rebuild_the_server_state():
+    encoder = snapshot.SnapshotEncoder()
+    receiver = snapshot.SnapshotReceiver()
+    acked = 0
+    for step in range(20):
+        state = game_state(300.0 + step, 700.0 - 2 * step)
+        state['players'][2]['is_attacking'] = step % 3 == 0
+        encoder.capture(state, tick=100 + step)
+        message, rebuilt = receive(receiver, encoder.frame_for(acked))
+        assert message['status'] == ('game_state_update' if step == 0 else 'game_state_delta')
+        assert rebuilt == state
+        assert receiver.latest_tick == 100 + step
+        acked = message['seq']
+
+
+def test_delta_carries_only_changes():
+    encoder = snapshot.SnapshotEncoder()
+    encoder.capture(game_state())
+    encoder.capture(game_state(x1=320.0))
+    message = encoder.message_for(1)
+    assert message['players'] == {1: {'x': 320.0}}
+    assert 'ready' not in message
+
+
+def test_unknown_base_is_dropped_and_a_keyframe_recovers():
+    encoder = snapshot.SnapshotEncoder()
+    receiver = snapshot.SnapshotReceiver()
+    encoder.capture(game_state())
+    receive(receiver, encoder.frame_for(0))
+    encoder.capture(game_state(x1=310.0))
+    encoder.capture(game_state(x1=320.0))
+    # The client never saw seq 2, so a delta against it cannot be applied
+    orphan = encoder.message_for(2)
+    assert receiver.apply(orphan) is None
+    assert receiver.latest_seq == 1
+    # An ack the server no longer remembers gets a keyframe
+    message, rebuilt = receive(receiver, encoder.frame_for(999))
+    assert message['status'] == 'game_state_update'
+    assert rebuilt == game_state(x1=320.0)
+
+
+def test_keyframes_at_interval_and_after_history_runs_out():
+    encoder = snapshot.SnapshotEncoder(keyframe_interval=5, history_size=3)
+    statuses = []
+    for step in range(1, 11):
+        encoder.capture(game_state(x1=300.0 + step))
+        statuses.append(protocol.FrameDecoder().feed(encoder.frame_for(step - 1))[0]['status'])
+    assert [status == 'game_state_update' for status in statuses] == [
+        True, False, False, False, True, False, False, False, False, True]
+    # seq 6 fell out of a three-entry history
+    assert protocol.FrameDecoder().feed(encoder.frame_for(6))[0]['status'] == 'game_state_update'
+
+
+def test_frames_are_encoded_once_per_base():
+    encoder = snapshot.SnapshotEncoder()
+    encoder.capture(game_state())
+    encoder.capture(game_state(x1=310.0))
+    assert encoder.frame_for(1) is encoder.frame_for(1)
+    assert encoder.frame_for(0) is encoder.frame_for(12345)
+
+
+class RecordingSocket:
+    def __init__(self):
+        self.frames = []
+
+    def sendall(self, data):
+        self.frames.append(data)
+
+
+class FakeServer:
+    logger = logging.getLogger('test')
+    max_rewind_ticks = 4
+
+
+def test_client_changes_are_broadcast_by_the_tick():
+    room = room_manager.GameRoom(FakeServer(), 1)
+    client_socket = RecordingSocket()
+    room.add_player(client_socket, 1)
+    room.handle_client_data(client_socket, 1, {'player1_character': 'Lucario'})
+    # A client thread capturing here would race the tick for the seq and baselines
+    assert room.snapshots.seq == 0
+    assert client_socket.frames == []
+
+    room.tick(1)
+    assert room.snapshots.seq == 1
+    message = protocol.FrameDecoder().feed(client_socket.frames[0])[0]
+    assert message['game_state']['players'][1]['character'] == 'Lucario'
+    room.tick(2)
+    # Before the match starts, only a change is broadcast
+    assert room.snapshots.seq == 1
@@ -0,0 +1,97 @@
+import tick_fightinggame as tick_clock
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def scheduler(clock, rate=4, max_catch_up=5):
+    # A quarter second is exact in binary, so slot boundaries compare cleanly
+    return tick_clock.TickScheduler(rate, max_catch_up, clock)
+
+
+def run(scheduler):
+    ticks = []
+    scheduler.run_due(ticks.append)
+    return ticks
+
+
+def test_one_tick_per_interval():
+    clock = FakeClock()
+    ticks = scheduler(clock)
+    assert run(ticks) == [1]
+    assert ticks.delay() == 0.25
+    clock.now += 0.125
+    assert run(ticks) == []
+    assert ticks.delay() == 0.125
+    clock.now += 0.125
+    assert run(ticks) == [2]
+
+
+def test_work_time_does_not_stretch_the_period():
+    clock = FakeClock()
+    ticks = scheduler(clock)
+
+    def work(tick):
+        clock.now += 0.2
+
+    for _ in range(10):
+        clock.now += ticks.delay()
+        ticks.run_due(work)
+    # Sleep-after-work would be at 100 + 10 * 0.45 by now
+    assert ticks.tick == 10
+    assert ticks.tick_time(10) == 100.0 + 9 * 0.25
+
+
+def test_short_stall_catches_up():
+    clock = FakeClock()
+    ticks = scheduler(clock)
+    run(ticks)
+    clock.now += 0.875
+    assert run(ticks) == [2, 3, 4]
+    assert ticks.skipped == 0
+    assert ticks.delay() == 0.125
+
+
+def test_long_stall_skips_all_but_max_catch_up():
+    clock = FakeClock()
+    ticks = scheduler(clock)
+    run(ticks)
+    clock.now += 19 * 0.25
+    # Ticks 2 to 20 were due; the first fourteen are dropped, the last five run
+    assert run(ticks) == [16, 17, 18, 19, 20]
+    assert ticks.skipped == 14
+    assert ticks.stats()['skipped'] == 14
+    # Tick numbers stay on the wall-clock timeline
+    assert ticks.tick_time(20) == 100.0 + 19 * 0.25
+    assert ticks.delay() == 0.25
+
+
+def test_restart_keeps_numbering_from_now():
+    clock = FakeClock()
+    ticks = scheduler(clock)
+    run(ticks)
+    clock.now += 60.0
+    ticks.restart()
+    assert run(ticks) == [2]
+    assert ticks.skipped == 0
+    assert ticks.timeline() == 2 * 0.25
+
+
+def test_stats_track_duration_and_jitter():
+    clock = FakeClock()
+    ticks = scheduler(clock)
+
+    def work(tick):
+        clock.now += 0.01
+
+    clock.now += 0.05
+    ticks.run_due(work)
+    stats = ticks.stats()
+    assert stats['tick'] == 1
+    assert abs(stats['max_tick_duration'] - 0.01) < 1e-9
+    assert abs(stats['max_jitter'] - 0.05) < 1e-9
@@ -0,0 +1,166 @@
+import outbound_fightinggame as outbound
+import timers_fightinggame as timers
+
+# Exact in binary, so slot arithmetic has no rounding surprises
+SLOT = 0.125
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_wheel(slots=16):
+    clock = FakeClock()
+    return timers.TimerWheel(SLOT, slots, clock=clock), clock
+
+
+def run_until(wheel, clock, until, step=SLOT):
+    while clock.now < until:
+        clock.now = min(clock.now + step, until)
+        wheel.run_due()
+
+
+def test_timer_fires_at_its_deadline_and_not_before():
+    wheel, clock = make_wheel()
+    fired = []
+    wheel.schedule(0.3, lambda: fired.append(clock.now))
+    run_until(wheel, clock, 0.25)
+    assert fired == []
+    run_until(wheel, clock, 0.375)
+    # Rounded up to the slot after the deadline
+    assert fired == [0.375]
+    assert wheel.pending == 0
+    assert wheel.fired == 1
+
+
+def test_zero_delay_waits_for_the_next_slot():
+    wheel, clock = make_wheel()
+    fired = []
+    wheel.schedule(0, lambda: fired.append(clock.now))
+    assert wheel.run_due() == 0
+    run_until(wheel, clock, SLOT)
+    assert fired == [SLOT]
+
+
+def test_cancelled_timer_never_fires_and_is_dropped():
+    wheel, clock = make_wheel()
+    fired = []
+    timer = wheel.schedule(0.5, lambda: fired.append('cancelled'))
+    wheel.schedule(0.5, lambda: fired.append('kept'))
+    timer.cancel()
+    run_until(wheel, clock, 1.0)
+    assert fired == ['kept']
+    assert wheel.pending == 0
+
+
+def test_timers_beyond_one_turn_wait_for_their_turn():
+    wheel, clock = make_wheel(slots=8)
+    fired = []
+    # 20 slots out on an 8-slot wheel: shares a slot with 4 and 12
+    wheel.schedule(20 * SLOT, lambda: fired.append(clock.now))
+    wheel.schedule(4 * SLOT, lambda: fired.append(clock.now))
+    run_until(wheel, clock, 19 * SLOT)
+    assert fired == [4 * SLOT]
+    run_until(wheel, clock, 20 * SLOT)
+    assert fired == [4 * SLOT, 20 * SLOT]
+
+
+def test_stall_longer_than_a_turn_fires_everything_due_once():
+    wheel, clock = make_wheel(slots=8)
+    fired = []
+    for slot in range(1, 20):
+        wheel.schedule(slot * SLOT, lambda slot=slot: fired.append(slot))
+    wheel.schedule(100 * SLOT, lambda: fired.append('later'))
+    clock.now = 50 * SLOT
+    assert wheel.run_due() == 19
+    assert sorted(fired) == list(range(1, 20))
+    run_until(wheel, clock, 100 * SLOT)
+    assert fired[-1] == 'later'
+
+
+def test_failing_callback_does_not_stop_the_others():
+    wheel, clock = make_wheel()
+    fired = []
+
+    def fail():
+        raise RuntimeError('boom')
+    wheel.schedule(SLOT, fail)
+    wheel.schedule(SLOT, lambda: fired.append(True))
+    run_until(wheel, clock, SLOT)
+    assert fired == [True]
+    assert wheel.fired == 2
+
+
+class FakeConnection:
+    def __init__(self, clock):
+        self.queue = outbound.OutboundQueue(clock=clock)
+
+    def sendall(self, data):
+        self.queue.put(data)
+
+
+def make_keepalive(heartbeat_interval=1.0, idle_timeout=4.0):
+    wheel, clock = make_wheel(slots=64)
+    connection = FakeConnection(clock)
+    idle = []
+    keepalive = timers.Keepalive(wheel, connection, idle.append, heartbeat_interval, idle_timeout)
+    return keepalive, wheel, clock, connection, idle
+
+
+def test_quiet_connection_gets_a_heartbeat_every_interval():
+    keepalive, wheel, clock, connection, idle = make_keepalive()
+    for second in (1.0, 2.0, 3.0):
+        run_until(wheel, clock, second - SLOT)
+        keepalive.received()
+        assert keepalive.heartbeats == second - 1
+        run_until(wheel, clock, second)
+        assert keepalive.heartbeats == second
+    assert idle == []
+    assert all(frame == timers.HEARTBEAT_FRAME for frame, _, _ in connection.queue.frames)
+
+
+def test_busy_connection_gets_no_heartbeat():
+    keepalive, wheel, clock, connection, idle = make_keepalive()
+    for step in range(1, 25):
+        run_until(wheel, clock, step * 0.5)
+        connection.sendall(b'snapshot')
+        keepalive.received()
+    assert keepalive.heartbeats == 0
+    assert idle == []
+    # One timer per connection, however long it lives
+    assert wheel.pending == 1
+
+
+def test_silent_client_times_out_once():
+    keepalive, wheel, clock, connection, idle = make_keepalive()
+    run_until(wheel, clock, 3.875)
+    assert idle == []
+    run_until(wheel, clock, 4.0)
+    assert idle == [4.0]
+    run_until(wheel, clock, 10.0)
+    assert idle == [4.0]
+    assert keepalive.heartbeats == 3
+    assert wheel.pending == 0
+
+
+def test_received_data_pushes_the_timeout_back():
+    keepalive, wheel, clock, connection, idle = make_keepalive()
+    run_until(wheel, clock, 3.0)
+    keepalive.received()
+    run_until(wheel, clock, 6.875)
+    assert idle == []
+    run_until(wheel, clock, 7.0)
+    assert idle == [4.0]
+
+
+def test_stop_cancels_the_timer():
+    keepalive, wheel, clock, connection, idle = make_keepalive()
+    keepalive.stop()
+    run_until(wheel, clock, 10.0)
+    assert keepalive.heartbeats == 0
+    assert idle == []
+    assert wheel.pending == 0
@@ -0,0 +1,90 @@
+import time
+
+TICK_RATE = 20
+# After a stall the scheduler runs at most this many ticks back to back and
+# drops the rest, so a long pause never turns into a burst of catch-up ticks
+MAX_CATCH_UP = 5
+# Weight of the newest sample in the smoothed duration/jitter figures
+SMOOTHING = 0.05
+
+
+class TickScheduler:
+    """Fixed-timestep tick clock on a monotonic timer.
+
+    Ticks are scheduled at start + n * interval instead of "sleep after the
+    work", so the period doesn't stretch with the time spent ticking. Every
+    tick gets a number that snapshots and inputs can refer to.
+    """
+
+    def __init__(self, rate=TICK_RATE, max_catch_up=MAX_CATCH_UP, clock=time.monotonic):
+        self.rate = rate
+        self.interval = 1.0 / rate
+        self.max_catch_up = max_catch_up
+        self.clock = clock
+        self.tick = 0
+        self.next_tick = clock()
+        # Clock time of tick 0; only moves when the schedule restarts
+        self.origin = self.next_tick - self.interval
+        self.skipped = 0
+        self.tick_duration = 0.0
+        self.max_tick_duration = 0.0
+        self.jitter = 0.0
+        self.max_jitter = 0.0
+
+    def restart(self):
+        self.next_tick = self.clock()
+        self.origin = self.next_tick - (self.tick + 1) * self.interval
+
+    def delay(self):
+        return max(0.0, self.next_tick - self.clock())
+
+    def due(self):
+        behind = self.clock() - self.next_tick
+        if behind < 0:
+            return 0
+        count = int(behind / self.interval) + 1
+        if count > self.max_catch_up:
+            dropped = count - self.max_catch_up
+            self.skipped += dropped
+            self.tick += dropped
+            self.next_tick += dropped * self.interval
+            count = self.max_catch_up
+        return count
+
+    def run_due(self, callback):
+        for _ in range(self.due()):
+            self.run_tick(callback)
+
+    def run_tick(self, callback):
+        start = self.clock()
+        self.tick += 1
+        lateness = start - self.next_tick
+        self.next_tick += self.interval
+        try:
+            callback(self.tick)
+        finally:
+            duration = self.clock() - start
+            self.tick_duration += (duration - self.tick_duration) * SMOOTHING
+            self.max_tick_duration = max(self.max_tick_duration, duration)
+            self.jitter += (abs(lateness) - self.jitter) * SMOOTHING
+            self.max_jitter = max(self.max_jitter, abs(lateness))
+
+    def tick_time(self, tick):
+        """Clock time tick number `tick` is (or was) scheduled for."""
+        return self.next_tick - (self.tick + 1 - tick) * self.interval
+
+    def timeline(self):
+        """Seconds since tick 0 was due, so tick n is at n / rate. Safe to read from any thread."""
+        return self.clock() - self.origin
+
+    def stats(self):
+        return {
+            'tick': self.tick,
+            'origin': self.tick_time(0),
+            'rate': self.rate,
+            'skipped': self.skipped,
+            'tick_duration': self.tick_duration,
+            'max_tick_duration': self.max_tick_duration,
+            'jitter': self.jitter,
+            'max_jitter': self.max_jitter
+        }
@@ -0,0 +1,138 @@
+import logging
+import math
+import threading
+import time
+
+import protocol_fightinggame as protocol
+
+# Width of one wheel slot in seconds (one tick at 20 Hz) and slots per turn;
+# timers further out than one turn wait in their slot for later turns
+SLOT_WIDTH = 0.05
+WHEEL_SLOTS = 512
+# A client that hears nothing for this long gets a heartbeat
+HEARTBEAT_INTERVAL = 1.0
+# A client that sends nothing for this long is disconnected. Clients answer
+# every heartbeat, so only a dead or hung client gets here.
+IDLE_TIMEOUT = 10.0
+
+HEARTBEAT_FRAME = protocol.encode_message(protocol.HEARTBEAT)
+
+
+class Timer:
+    __slots__ = ('slot', 'callback', 'cancelled')
+
+    def __init__(self, slot, callback):
+        self.slot = slot
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Every connection's timers in one hashed timing wheel.
+
+    Scheduling and cancelling are O(1); a cancelled timer is only dropped
+    when its slot comes round. run_due() is called from the server's own
+    periodic loop and only looks at the slots that passed since the last
+    call, so the wheel needs no thread of its own.
+    """
+
+    def __init__(self, slot_width=SLOT_WIDTH, slots=WHEEL_SLOTS, clock=time.monotonic):
+        self.slot_width = slot_width
+        self.clock = clock
+        self.slots = [[] for _ in range(slots)]
+        self.current = int(clock() / slot_width)
+        self.pending = 0
+        self.fired = 0
+        # Threaded servers schedule from client threads while the tick thread runs timers
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('Timers')
+
+    def schedule(self, delay, callback):
+        # Rounded up, so a timer never fires before its deadline
+        timer = Timer(math.ceil((self.clock() + delay) / self.slot_width), callback)
+        with self.lock:
+            # A timer is never put in a slot that has already been run
+            timer.slot = max(timer.slot, self.current + 1)
+            self.slots[timer.slot % len(self.slots)].append(timer)
+            self.pending += 1
+        return timer
+
+    def run_due(self):
+        now = int(self.clock() / self.slot_width)
+        due = []
+        with self.lock:
+            # After a stall longer than a turn every slot only needs one visit
+            for slot in range(self.current + 1, min(now, self.current + len(self.slots)) + 1):
+                bucket = self.slots[slot % len(self.slots)]
+                if not bucket:
+                    continue
+                kept = []
+                for timer in bucket:
+                    if timer.cancelled:
+                        self.pending -= 1
+                    elif timer.slot <= now:
+                        self.pending -= 1
+                        due.append(timer)
+                    else:
+                        kept.append(timer)
+                self.slots[slot % len(self.slots)] = kept
+            self.current = max(self.current, now)
+        for timer in due:
+            if timer.cancelled:
+                continue
+            self.fired += 1
+            try:
+                timer.callback()
+            except Exception as e:
+                self.logger.error(f'Timer callback failed: {str(e)}')
+        return len(due)
+
+
+class Keepalive:
+    """Heartbeats and the idle timeout of one client connection, on a single timer.
+
+    Receiving only stores a timestamp. When the timer fires it checks what
+    was sent and received since it was set: a heartbeat only goes out if
+    nothing else did for a whole interval, so a connection that is getting
+    snapshots never gets one, and the timer re-arms for whichever of the
+    two deadlines is next.
+    """
+
+    def __init__(self, timers, connection, on_idle, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.timers = timers
+        self.connection = connection
+        self.on_idle = on_idle
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.last_received = timers.clock()
+        self.heartbeats = 0
+        self.stopped = False
+        self.timer = timers.schedule(min(heartbeat_interval, idle_timeout), self.expire)
+
+    def received(self):
+        self.last_received = self.timers.clock()
+
+    def expire(self):
+        if self.stopped:
+            return
+        now = self.timers.clock()
+        idle = now - self.last_received
+        if idle >= self.idle_timeout:
+            self.stopped = True
+            self.on_idle(idle)
+            return
+        quiet = now - self.connection.queue.last_put
+        if quiet >= self.heartbeat_interval:
+            self.connection.sendall(HEARTBEAT_FRAME)
+            self.heartbeats += 1
+            quiet = 0.0
+        self.timer = self.timers.schedule(min(self.heartbeat_interval - quiet, self.idle_timeout - idle),
+                                          self.expire)
+
+    def stop(self):
+        self.stopped = True
+        self.timer.cancel()
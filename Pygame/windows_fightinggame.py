@@ -1,7 +1,8 @@
 import pygame
 import pygame_menu
-import os
+import io
 import sys
+import assets_fightinggame as assets
 from stadium_fightinggame import Stadium
 
 
@@ -32,34 +33,18 @@ class GameMenu:
         self.player2_character = selected_value[0][0]
         print(f'Player 2 character selected: {self.player2_character}')
 
-    def add_baseimage(self, image_path, scale=(50, 50)):
-        """Load and scale an image, with error handling"""
-        try:
-            # Check if file exists
-            if not os.path.exists(image_path):
-                print(f"Image file not found: {image_path}")
-                # Return a colored rectangle as fallback
-                surface = pygame.Surface(scale)
-                surface.fill((255, 0, 0))  # Red rectangle as placeholder
-                return pygame_menu.BaseImage(surface)
-
-                # Load and convert the image
-                image = pygame.image.load(image_path).convert_alpha()
-                # Scale the image
-                scaled_image = pygame.transform.scale(image, scale)
-                # Create surface and blit the image
-                surface = pygame.Surface(scale, pygame.SRCALPHA)
-                surface.blit(scaled_image, (0, 0))
-
-                return pygame_menu.BaseImage(surface)
-        except Exception as e:
-            print(f"Error loading image {image_path}: {str(e)}")
-            # Return a colored rectangle as fallback
-            surface = pygame.Surface(scale)
-            surface.fill((255, 0, 0))  # Red rectangle as placeholder
-            return pygame_menu.BaseImage(surface)
+    def add_baseimage(self, character_name, scale=assets.MENU_SIZE):
+        """The character's sprite as a menu image, a coloured block if it cannot be loaded"""
+        # BaseImage only takes files, so the cached sprite goes in as a small in-memory PNG
+        buffer = io.BytesIO()
+        pygame.image.save(assets.character_sprite(character_name, scale), buffer, 'png')
+        buffer.seek(0)
+        return pygame_menu.BaseImage(buffer)
 
     def run(self):
+        # Sprites for the menu now, and at match size for the stadium it starts
+        assets.preload(self.screen, sizes=(assets.MENU_SIZE, assets.SPRITE_SIZE))
+
         # Create menu theme
         mytheme = pygame_menu.themes.THEME_DARK.copy()
         mytheme.widget_font_size = 20
@@ -74,10 +59,10 @@ class GameMenu:
         try:
             # Load character images
             characters = [
-                ('Lucario', self.add_baseimage("sprites/lucario_sprite.png")),
-                ('Cinderace', self.add_baseimage("sprites/cinderace_sprite.png")),
-                ('Zeraora', self.add_baseimage("sprites/zeraora_sprite.png")),
-                ('Mewtwo', self.add_baseimage("sprites/mewtwo_sprite.png"))
+                ('Lucario', self.add_baseimage('Lucario')),
+                ('Cinderace', self.add_baseimage('Cinderace')),
+                ('Zeraora', self.add_baseimage('Zeraora')),
+                ('Mewtwo', self.add_baseimage('Mewtwo'))
             ]
 
             # Add widgets to the menu